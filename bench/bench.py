@@ -0,0 +1,353 @@
+"""
+YBT Benchmarks.
+
+Starts a throwaway ybt_srv (in test mode, against a temporary fs folder), generates folders of made-up files,
+and backs them up with the real ybt_cl. Every folder is uploaded twice: once from scratch ("cold"), then again
+with nothing changed ("warm").
+
+For every upload this reports files/s, MB/s, request latency (p50/p99), time spent updating the manifest, and the
+peak memory use of both the client and the server, as JSON.
+
+The made-up files come from a fixed seed, so every run uploads exactly the same bytes.
+
+ex.
+    python bench/bench.py --scale small
+    python bench/bench.py --scale full --store chunk --output results.json
+"""
+import os
+import sys
+import json
+import math
+import time
+import random
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+import urllib.request
+import urllib.error
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+
+USERNAME = "bench"
+PASSWORD = "bench"
+
+MB = 1024 * 1024
+
+# How big each generated folder is, per --scale.
+#   tiny: (files, largest file in bytes)   deep: (levels, files per level)
+#   wide: files in one folder              large: (files, size of each in bytes)
+SCALES = {
+    "small": {"tiny": (2_000, 4096), "deep": (32, 4), "wide": 2_000, "large": (2, 64 * MB)},
+    "full": {"tiny": (100_000, 4096), "deep": (256, 8), "wide": 50_000, "large": (3, 2048 * MB)},
+}
+
+
+def write_file(path: str, rand: random.Random, size: int) -> None:
+    """
+    Write `size` random bytes to `path`, a MB at a time so big files don't need to fit in memory.
+    """
+    with open(path, "wb") as f:
+        while size > 0:
+            piece = min(size, MB)
+            f.write(rand.randbytes(piece))
+            size -= piece
+
+
+def make_tiny(root: str, rand: random.Random, spec) -> None:
+    """
+    Lots of small files, 100 to a folder.
+    """
+    count, largest = spec
+    for i in range(count):
+        folder = os.path.join(root, f"d{i // 100:04}")
+        os.makedirs(folder, exist_ok=True)
+        write_file(os.path.join(folder, f"f{i:06}.txt"), rand, rand.randint(0, largest))
+
+
+def make_deep(root: str, rand: random.Random, spec) -> None:
+    """
+    One long chain of nested folders, with a few files in each.
+    """
+    levels, per_level = spec
+    folder = root
+    for level in range(levels):
+        folder = os.path.join(folder, f"level{level:03}")
+        os.makedirs(folder, exist_ok=True)
+        for i in range(per_level):
+            write_file(os.path.join(folder, f"f{i}.bin"), rand, rand.randint(0, 16 * 1024))
+
+
+def make_wide(root: str, rand: random.Random, spec) -> None:
+    """
+    A single folder with a huge amount of files in it.
+    """
+    os.makedirs(root, exist_ok=True)
+    for i in range(spec):
+        write_file(os.path.join(root, f"f{i:06}.dat"), rand, rand.randint(0, 2048))
+
+
+def make_large(root: str, rand: random.Random, spec) -> None:
+    """
+    A few very large files.
+    """
+    count, size = spec
+    os.makedirs(root, exist_ok=True)
+    for i in range(count):
+        write_file(os.path.join(root, f"large{i}.img"), rand, size)
+
+
+GENERATORS = {
+    "tiny": make_tiny,
+    "deep": make_deep,
+    "wide": make_wide,
+    "large": make_large,
+}
+
+
+def tree_size(root: str) -> tuple[int, int]:
+    """
+    Returns (files, bytes) for a folder.
+    """
+    files = size = 0
+    for path, subdirs, names in os.walk(root):
+        for name in names:
+            files += 1
+            size += os.path.getsize(os.path.join(path, name))
+    return files, size
+
+
+def percentile(values: list[float], p: float) -> float | None:
+    """
+    Nearest-rank percentile. None if there are no values.
+    """
+    if not values:
+        return None
+    values = sorted(values)
+    return round(values[max(math.ceil(p / 100 * len(values)) - 1, 0)], 2)
+
+
+def peak_rss(pid: int) -> int | None:
+    """
+    The most memory `pid` has used, in bytes. Linux only, None elsewhere.
+    """
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def reset_peak_rss(pid: int) -> bool:
+    """
+    Start counting a process' peak memory use from now. Returns False if that isn't supported.
+    """
+    try:
+        with open(f"/proc/{pid}/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+class Server:
+    """
+    A ybt_srv running in the background for the benchmarks.
+    """
+    def __init__(self, python: str, workdir: str, port: int, store: str) -> None:
+        self.url = f"http://127.0.0.1:{port}/api/"
+        self.timing_log = os.path.join(workdir, "timing.jsonl")
+        self.__log = open(os.path.join(workdir, "server.log"), "wb")
+        self.process = subprocess.Popen(
+            [python, os.path.join(SRC, "ybt_srv.py"), "--test", "--port", str(port), "--store", store,
+             "--fs", os.path.join(workdir, "fs"), "--timing-log", self.timing_log],
+            stdout=self.__log, stderr=subprocess.STDOUT
+        )
+
+    def wait(self, timeout: float = 30) -> None:
+        """
+        Wait until the server answers.
+        """
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError("ybt_srv exited early, see server.log")
+            try:
+                urllib.request.urlopen(self.url, timeout=1).close()
+                return
+            except (urllib.error.URLError, ConnectionError):
+                time.sleep(0.1)
+        raise RuntimeError("ybt_srv did not start in time")
+
+    def createUser(self, usr: str, psw: str) -> None:
+        request = urllib.request.Request(f"{self.url}users/create?usr={usr}&psw={psw}", method="POST")
+        urllib.request.urlopen(request).close()
+
+    def timingOffset(self) -> int:
+        """
+        Where the timing log currently ends. Pass it to timings() to get only the requests made after now.
+        """
+        try:
+            return os.path.getsize(self.timing_log)
+        except FileNotFoundError:
+            return 0
+
+    def timings(self, offset: int) -> list[dict]:
+        try:
+            with open(self.timing_log) as f:
+                f.seek(offset)
+                return [json.loads(line) for line in f if line.strip()]
+        except FileNotFoundError:
+            return []
+
+    def stop(self) -> None:
+        self.process.terminate()
+        try:
+            self.process.wait(10)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+        self.__log.close()
+
+
+def run_client(python: str, home: str, server: Server, path: str, jobs: int, log) -> tuple[int, float, int | None]:
+    """
+    Back up `path` with ybt_cl.
+
+    Returns (exit code, seconds taken, peak memory use in bytes).
+    """
+    env = dict(os.environ, YBT_HOME=home, YBT_SERVER_IP=server.url)
+    start = time.perf_counter()
+    process = subprocess.Popen([python, os.path.join(SRC, "ybt_cl.py"), path, "-j", str(jobs)],
+                               env=env, stdout=log, stderr=subprocess.STDOUT, stdin=subprocess.DEVNULL)
+
+    if hasattr(os, "wait4"):
+        # wait4 also tells us the most memory the client used.
+        _, status, usage = os.wait4(process.pid, 0)
+        elapsed = time.perf_counter() - start
+        process.returncode = os.waitstatus_to_exitcode(status)
+        # Kilobytes on Linux, bytes on macOS.
+        rss = usage.ru_maxrss if sys.platform == "darwin" else usage.ru_maxrss * 1024
+        return process.returncode, elapsed, rss
+
+    code = process.wait()
+    return code, time.perf_counter() - start, None
+
+
+def summarize(name: str, run: str, files: int, size: int, code: int, elapsed: float,
+              client_rss: int | None, server_rss: int | None, timings: list[dict]) -> dict:
+    latencies = [t["time"] * 1000 for t in timings]
+    manifest = [t["phases"]["manifest"] * 1000 for t in timings if "manifest" in t["phases"]]
+    endpoints: dict[str, int] = {}
+    for t in timings:
+        endpoints[f"{t['method']} {t['path']}"] = endpoints.get(f"{t['method']} {t['path']}", 0) + 1
+
+    return {
+        "scenario": name,
+        "run": run,
+        "ok": code == 0 and all(t["status"] < 400 for t in timings),
+        "exit_code": code,
+        "files": files,
+        "bytes": size,
+        "seconds": round(elapsed, 3),
+        "files_per_s": round(files / elapsed, 1) if elapsed else None,
+        "mb_per_s": round(size / MB / elapsed, 2) if elapsed else None,
+        "requests": len(timings),
+        "errors": sum(1 for t in timings if t["status"] >= 400),
+        "endpoints": endpoints,
+        "latency_ms": {
+            "p50": percentile(latencies, 50),
+            "p99": percentile(latencies, 99),
+            "max": round(max(latencies), 2) if latencies else None,
+        },
+        "manifest_ms": {
+            "total": round(sum(manifest), 2),
+            "p50": percentile(manifest, 50),
+            "p99": percentile(manifest, 99),
+        },
+        "client_peak_rss": client_rss,
+        "server_peak_rss": server_rss,
+    }
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Benchmark ybt_cl and ybt_srv end to end.")
+    parser.add_argument("--scale", choices=SCALES.keys(), default="small", help="How much data to generate. Defaults to small.")
+    parser.add_argument("--scenarios", default=",".join(GENERATORS), help=f"Comma separated scenarios to run. Defaults to {','.join(GENERATORS)}.")
+    parser.add_argument("--large-size", type=int, metavar="MB", help="Override how big each large file is.")
+    parser.add_argument("--store", choices=["mirror", "chunk"], default="mirror", help="Server storage to benchmark. Defaults to mirror.")
+    parser.add_argument("-j", "--jobs", type=int, default=4, help="ybt_cl --jobs. Defaults to 4.")
+    parser.add_argument("--port", type=int, default=8765, help="Port for the benchmark server. Defaults to 8765.")
+    parser.add_argument("--seed", type=int, default=1, help="Seed for the generated files. Defaults to 1.")
+    parser.add_argument("--python", default=sys.executable, help="Python to run ybt_cl and ybt_srv with.")
+    parser.add_argument("--workdir", help="Where to put the generated files and server data. Defaults to a temporary folder, removed afterwards.")
+    parser.add_argument("-o", "--output", help="Write the results here instead of stdout.")
+    args = parser.parse_args()
+
+    scale = dict(SCALES[args.scale])
+    if args.large_size:
+        scale["large"] = (scale["large"][0], args.large_size * MB)
+    scenarios = [name.strip() for name in args.scenarios.split(",") if name.strip()]
+    for name in scenarios:
+        if name not in GENERATORS:
+            parser.error(f"unknown scenario '{name}'")
+
+    workdir = os.path.abspath(args.workdir or tempfile.mkdtemp(prefix="ybt-bench-"))
+    os.makedirs(workdir, exist_ok=True)
+    home = os.path.join(workdir, "client")
+    os.makedirs(home, exist_ok=True)
+    with open(os.path.join(home, "ybt.json"), "w") as f:
+        json.dump({"username": USERNAME, "password": PASSWORD}, f, indent=2)
+
+    results = []
+    server = Server(args.python, workdir, args.port, args.store)
+    try:
+        server.wait()
+        server.createUser(USERNAME, PASSWORD)
+
+        with open(os.path.join(workdir, "client.log"), "wb") as log:
+            for name in scenarios:
+                tree = os.path.join(workdir, "data", name)
+                print(f"Generating {name}...", file=sys.stderr)
+                if os.path.exists(tree):
+                    shutil.rmtree(tree)
+                os.makedirs(tree)
+                GENERATORS[name](tree, random.Random(f"{args.seed}-{name}"), scale[name])
+                files, size = tree_size(tree)
+
+                for run in ["cold", "warm"]:
+                    print(f"Uploading {name} ({run})...", file=sys.stderr)
+                    reset = reset_peak_rss(server.process.pid)
+                    offset = server.timingOffset()
+                    code, elapsed, client_rss = run_client(args.python, home, server, tree, args.jobs, log)
+                    server_rss = peak_rss(server.process.pid) if reset else None
+                    results.append(summarize(name, run, files, size, code, elapsed, client_rss, server_rss, server.timings(offset)))
+    finally:
+        server.stop()
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        "scale": args.scale,
+        "store": args.store,
+        "jobs": args.jobs,
+        "seed": args.seed,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "results": results,
+    }
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+    return 0 if all(result["ok"] for result in results) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
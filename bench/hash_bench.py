@@ -0,0 +1,151 @@
+"""
+YBT Hashing Benchmark.
+
+Generates a folder of made-up files (a few large ones and lots of small ones) and hashes all of it the way ybt_cl
+does, reporting GB/s as JSON:
+
+  baseline: one thread, reading every file in blocks. (how ybt_cl used to hash)
+  workers:  the Hasher with each --workers count, memory mapping large files.
+  cached:   the Hasher again, with the hash cache filled in by an earlier run. Only stats the files.
+
+The files were just written, so they are (most likely) in the page cache and this measures hashing, not the disk.
+Drop the page cache between runs (or use files bigger than memory) to see what the disk can do.
+
+ex.
+    python bench/hash_bench.py
+    python bench/hash_bench.py --large 4 --large-size 1024 --workers 1,2,4,8 -o hashing.json
+"""
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import platform
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import fileindex
+from fileindex import hash_file
+from hasher import Hasher, HashCache
+
+MB = 1024 * 1024
+
+
+def write_file(path: str, rand: random.Random, size: int) -> None:
+    with open(path, "wb") as f:
+        while size > 0:
+            piece = min(size, MB)
+            f.write(rand.randbytes(piece))
+            size -= piece
+
+
+def make_tree(root: str, seed: int, large: int, large_size: int, small: int) -> list[str]:
+    """
+    Write `large` files of `large_size` bytes and `small` files of up to 64 KB. Returns their paths.
+    """
+    rand = random.Random(seed)
+    paths = []
+    os.makedirs(os.path.join(root, "large"), exist_ok=True)
+    for i in range(large):
+        paths.append(os.path.join(root, "large", f"large{i}.img"))
+        write_file(paths[-1], rand, large_size)
+    for i in range(small):
+        folder = os.path.join(root, "small", f"d{i // 100:04}")
+        os.makedirs(folder, exist_ok=True)
+        paths.append(os.path.join(folder, f"f{i:06}.dat"))
+        write_file(paths[-1], rand, rand.randint(0, 64 * 1024))
+
+    # Old enough to be memory mapped. (see fileindex.MMAP_MIN_AGE)
+    old = time.time() - fileindex.MMAP_MIN_AGE * 2
+    for path in paths:
+        os.utime(path, (old, old))
+    return paths
+
+
+def result(name: str, workers: int, size: int, seconds: float, digests: list[str], expected: list[str]) -> dict:
+    return {
+        "run": name,
+        "workers": workers,
+        "seconds": round(seconds, 3),
+        "gb_per_s": round(size / seconds / 1024 ** 3, 3) if seconds else None,
+        "ok": digests == expected,
+    }
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Benchmark how fast ybt_cl hashes files.")
+    parser.add_argument("--large", type=int, default=4, help="How many large files to hash. Defaults to 4.")
+    parser.add_argument("--large-size", type=int, default=256, metavar="MB", help="How big each large file is. Defaults to 256.")
+    parser.add_argument("--small", type=int, default=5_000, help="How many small (up to 64 KB) files to hash. Defaults to 5000.")
+    parser.add_argument("--workers", default=f"2,4,{os.cpu_count() or 1}", help="Comma separated worker counts to try. Defaults to 2, 4 and the number of CPUs.")
+    parser.add_argument("--seed", type=int, default=1, help="Seed for the generated files. Defaults to 1.")
+    parser.add_argument("--workdir", help="Where to put the generated files. Defaults to a temporary folder, removed afterwards.")
+    parser.add_argument("-o", "--output", help="Write the results here instead of stdout.")
+    args = parser.parse_args()
+
+    try:
+        counts = sorted({int(count) for count in args.workers.split(",") if count.strip()})
+    except ValueError:
+        parser.error("--workers must be numbers separated by commas")
+
+    workdir = os.path.abspath(args.workdir or tempfile.mkdtemp(prefix="ybt-hash-bench-"))
+    results = []
+    try:
+        print("Generating files...", file=sys.stderr)
+        paths = make_tree(os.path.join(workdir, "data"), args.seed, args.large, args.large_size * MB, args.small)
+        stats = [os.stat(path) for path in paths]
+        size = sum(st.st_size for st in stats)
+
+        print("Hashing (baseline)...", file=sys.stderr)
+        start = time.perf_counter()
+        expected = [hash_file(path, use_mmap=False) for path in paths]
+        results.append(result("baseline", 1, size, time.perf_counter() - start, expected, expected))
+
+        for workers in counts:
+            print(f"Hashing ({workers} workers)...", file=sys.stderr)
+            hasher = Hasher(workers)
+            start = time.perf_counter()
+            digests = [digest for item, digest in hasher.imap((None, path, st) for path, st in zip(paths, stats))]
+            results.append(result("workers", workers, size, time.perf_counter() - start, digests, expected))
+
+        print("Hashing (cached)...", file=sys.stderr)
+        cache_path = os.path.join(workdir, "hashes.json")
+        hasher = Hasher(max(counts), HashCache(cache_path))
+        list(hasher.imap((None, path, st) for path, st in zip(paths, stats)))
+        hasher.save()
+
+        hasher = Hasher(max(counts), HashCache(cache_path))
+        start = time.perf_counter()
+        digests = [digest for item, digest in hasher.imap((None, path, os.stat(path)) for path in paths)]
+        results.append(result("cached", max(counts), size, time.perf_counter() - start, digests, expected))
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    baseline = results[0]["seconds"]
+    for entry in results:
+        entry["speedup"] = round(baseline / entry["seconds"], 2) if entry["seconds"] else None
+
+    report = {
+        "files": len(paths),
+        "bytes": size,
+        "cpus": os.cpu_count(),
+        "seed": args.seed,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "results": results,
+    }
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+    return 0 if all(entry["ok"] for entry in results) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
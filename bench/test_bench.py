@@ -0,0 +1,46 @@
+"""
+Tests for the benchmark suite's helpers. (see bench)
+"""
+import os
+import random
+
+import bench
+
+
+def read_tree(root: str) -> dict[str, bytes]:
+    files = {}
+    for path, subdirs, names in os.walk(root):
+        for name in names:
+            with open(os.path.join(path, name), "rb") as f:
+                files[os.path.relpath(os.path.join(path, name), root)] = f.read()
+    return files
+
+
+def test_generated_folders_are_the_same_every_run(tmp_path):
+    spec = {"tiny": (150, 512), "deep": (3, 2), "wide": 20, "large": (1, bench.MB + 1)}
+    for name, generate in bench.GENERATORS.items():
+        generate(str(tmp_path / "a" / name), random.Random(name), spec[name])
+        generate(str(tmp_path / "b" / name), random.Random(name), spec[name])
+
+    assert read_tree(str(tmp_path / "a")) == read_tree(str(tmp_path / "b"))
+    assert bench.tree_size(str(tmp_path / "a" / "tiny"))[0] == 150
+    assert bench.tree_size(str(tmp_path / "a" / "large")) == (1, bench.MB + 1)
+
+
+def test_percentile():
+    assert bench.percentile([], 50) is None
+    assert bench.percentile([3.0, 1.0, 2.0], 50) == 2.0
+    assert bench.percentile(list(map(float, range(1, 101))), 99) == 99.0
+    assert bench.percentile([5.0], 99) == 5.0
+
+
+def test_summary_counts_failed_requests():
+    timings = [{"method": "PUT", "path": "/api/fs/file", "status": 200, "time": 0.010, "phases": {"manifest": 0.002}},
+               {"method": "PUT", "path": "/api/fs/file", "status": 503, "time": 0.030, "phases": {}}]
+
+    result = bench.summarize("tiny", "cold", 2, 2 * bench.MB, 0, 2.0, None, None, timings)
+    assert not result["ok"]
+    assert result["errors"] == 1
+    assert result["endpoints"] == {"PUT /api/fs/file": 2}
+    assert result["mb_per_s"] == 1.0
+    assert result["manifest_ms"]["total"] == 2.0
@@ -0,0 +1,128 @@
+"""
+Auth Module.
+
+Account lookups and login tokens for ybt_srv.
+
+Accounts live in `fs/manifest.json`. Rather than reading it for every request, `Accounts` keeps it in memory
+(by username) and only reads it again when the file changes. Logging in gives a `Tokens` token, so later
+requests can skip the password hash as well.
+"""
+import os
+import hmac
+import json
+import time
+import secrets
+import hashlib
+import threading
+
+
+def hash_password(psw: str) -> str:
+    return hashlib.sha384(psw.encode()).hexdigest()
+
+
+class Accounts:
+    """
+    The server's accounts, loaded from `path` and kept in memory.
+    """
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.__lock = threading.Lock()
+        # username -> password hash
+        self.__users: dict[str, str] = {}
+        # (mtime, size) of the file when it was loaded.
+        self.__stamp: tuple[int, int] | None = None
+
+    def __reload(self) -> None:
+        """
+        Read the file again if it changed since it was last loaded. Must hold the lock.
+        """
+        st = os.stat(self.path)
+        stamp = (st.st_mtime_ns, st.st_size)
+        if stamp == self.__stamp:
+            return
+
+        with open(self.path, "r") as f:
+            data = json.load(f)
+        self.__users = {user["username"]: user["password"] for user in data["users"]}
+        self.__stamp = stamp
+
+    def exists(self, usr: str) -> bool:
+        with self.__lock:
+            self.__reload()
+            return usr in self.__users
+
+    def check(self, usr: str, psw: str) -> bool:
+        """
+        Returns True if the username and password is correct.
+        """
+        with self.__lock:
+            self.__reload()
+            stored = self.__users.get(usr)
+
+        return stored is not None and hmac.compare_digest(stored, hash_password(psw))
+
+    def add(self, usr: str, psw: str) -> bool:
+        """
+        Create an account.
+
+        Returns False if an account with the same name already exists.
+        """
+        with self.__lock:
+            self.__reload()
+            if usr in self.__users:
+                return False
+
+            users = [{"username": name, "password": stored} for name, stored in self.__users.items()]
+            users.append({"username": usr, "password": hash_password(psw)})
+
+            tmp = self.path + ".tmp"
+            with open(tmp, "w") as f:
+                json.dump({"users": users}, f, indent=2)
+            os.replace(tmp, self.path)
+
+            self.__users[usr] = users[-1]["password"]
+            st = os.stat(self.path)
+            self.__stamp = (st.st_mtime_ns, st.st_size)
+            return True
+
+
+class Tokens:
+    """
+    Login tokens, kept in memory only. Restarting the server logs everyone out.
+
+    A token expires once it goes unused for `ttl` seconds.
+    """
+    def __init__(self, ttl: float) -> None:
+        self.ttl = ttl
+        self.__lock = threading.Lock()
+        # token -> [username, expiry]
+        self.__tokens: dict[str, list] = {}
+
+    def issue(self, usr: str) -> str:
+        """
+        Returns a new token for `usr`.
+        """
+        token = secrets.token_urlsafe(32)
+        now = time.time()
+        with self.__lock:
+            # Drop expired tokens while we're here, so they can't pile up.
+            for old in [t for t, (name, expiry) in self.__tokens.items() if expiry < now]:
+                del self.__tokens[old]
+            self.__tokens[token] = [usr, now + self.ttl]
+        return token
+
+    def resolve(self, token: str) -> str | None:
+        """
+        Returns the username a token was issued to, or None if it is unknown or expired.
+        """
+        now = time.time()
+        with self.__lock:
+            entry = self.__tokens.get(token)
+            if entry is None:
+                return None
+            if entry[1] < now:
+                del self.__tokens[token]
+                return None
+
+            entry[1] = now + self.ttl
+            return entry[0]
@@ -0,0 +1,78 @@
+"""
+Chunker Module.
+
+Splits data into content-defined chunks, so the same data always ends up in the same chunks no matter
+where it sits inside a file. Used by both ybt_cl and ybt_srv, so both sides must agree on the settings below.
+"""
+import zlib
+import hashlib
+from typing import BinaryIO, Iterator
+
+# Chunks are never smaller than MIN_SIZE (unless the data runs out) or larger than MAX_SIZE.
+MIN_SIZE = 256 * 1024
+MAX_SIZE = 4 * 1024 * 1024
+
+# Hash used for chunk names.
+HASH_NAME = "sha256"
+
+# A boundary can only come right after an ANCHOR byte, and only if the WINDOW bytes ending there hash to
+# a value with BOUNDARY_BITS zero bits. Since only local content matters, inserting or removing data
+# only changes the chunks around it.
+#
+# Looking for the anchor with bytes.find and hashing with crc32 keeps all the per-byte work in C.
+# For binary data this averages a boundary every 2**(8+BOUNDARY_BITS) bytes after MIN_SIZE.
+ANCHOR = 0x0A
+WINDOW = 48
+BOUNDARY_BITS = 11
+_BOUNDARY = (1 << BOUNDARY_BITS) - 1
+
+
+def find_boundary(data: bytes | bytearray) -> int:
+    """
+    Find where the first chunk in `data` ends.
+
+    Returns the length of the chunk. If no boundary is found, this is either MAX_SIZE or len(data).
+    """
+    size = len(data)
+    if size <= MIN_SIZE:
+        return size
+    end = min(size, MAX_SIZE)
+
+    # Nothing before MIN_SIZE can be a boundary, so don't bother looking there.
+    i = data.find(ANCHOR, MIN_SIZE, end)
+    while i != -1:
+        if not zlib.crc32(data[i - WINDOW + 1:i + 1]) & _BOUNDARY:
+            return i + 1
+        i = data.find(ANCHOR, i + 1, end)
+    return end
+
+
+def iter_chunks(stream: BinaryIO) -> Iterator[bytes]:
+    """
+    Read `stream` to the end, yielding one chunk at a time.
+
+    At most MAX_SIZE*2 bytes are held in memory.
+    """
+    buffer = bytearray()
+    eof = False
+    while True:
+        while not eof and len(buffer) < MAX_SIZE:
+            contents = stream.read(MAX_SIZE)
+            if not contents:
+                eof = True
+                break
+            buffer += contents
+
+        if not buffer:
+            return
+
+        cut = find_boundary(buffer)
+        yield bytes(buffer[:cut])
+        del buffer[:cut]
+
+
+def hash_chunk(data: bytes) -> str:
+    """
+    Returns the name (hex digest) of a chunk.
+    """
+    return hashlib.new(HASH_NAME, data).hexdigest()
@@ -0,0 +1,261 @@
+"""
+Compression Module.
+
+Compresses uploads between ybt_cl and ybt_srv, and (optionally) files kept by ybt_srv.
+
+zlib and lzma come with Python. zstd is used if the `zstandard` package is installed, since it is both quicker and
+smaller than zlib. The server lists the codecs it can read (see `/api/info`), and the client picks one they both have.
+A compressed request body says which codec it uses in its `Content-Encoding` header.
+
+Files that are already compressed (ex. JPEG, MP4, ZIP) only get bigger, so they are sent and kept as they are.
+"""
+import os
+import lzma
+import zlib
+from typing import BinaryIO, Iterator
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Every codec that is available here, best first. lzma is the smallest but by far the slowest, so it is only
+# used when asked for.
+CODECS = (["zstd"] if zstandard is not None else []) + ["zlib", "lzma"]
+
+# Compression level for each codec. (the library defaults)
+LEVELS = {"zstd": 3, "zlib": 6, "lzma": 6}
+
+# Types that are already compressed. Compressing them again only burns CPU.
+SKIP_EXTENSIONS = {
+    # Images
+    ".jpg", ".jpeg", ".png", ".gif", ".webp", ".heic", ".heif", ".avif",
+    # Audio and video
+    ".mp3", ".m4a", ".aac", ".ogg", ".opus", ".flac", ".mp4", ".m4v", ".mkv", ".mov", ".avi", ".webm", ".wmv",
+    # Archives
+    ".zip", ".gz", ".tgz", ".bz2", ".xz", ".zst", ".7z", ".rar", ".lz4", ".jar", ".apk", ".deb", ".rpm",
+    # Documents that are zip files inside
+    ".docx", ".xlsx", ".pptx", ".odt", ".ods", ".odp", ".epub",
+}
+# If a sample of a file doesn't shrink to at least this fraction of its size, it isn't worth compressing.
+MIN_SAVING = 0.9
+# How much of a file to look at when deciding.
+SAMPLE_SIZE = 64 * 1024
+
+# Decoder yields decompressed data in pieces of at most this size, by default. (bytes)
+PIECE_SIZE = 1024 * 1024
+# zstd can't be asked to stop early, so a Decoder feeds it this much at a time instead. Nothing decompresses to more
+# than 32768 times its size with zstd (a 128 KB block of one byte repeated takes 4 bytes), so a step never holds
+# more than 32 MB. (bytes)
+ZSTD_FEED = 1024
+
+
+def worth_compressing(name: str, sample: bytes | None = None) -> bool:
+    """
+    Returns True if a file called `name` is likely to get smaller when compressed.
+
+    If `sample` (ex. the start of the file) is given, it is test compressed too.
+    """
+    if os.path.splitext(name)[1].lower() in SKIP_EXTENSIONS:
+        return False
+    if sample:
+        return len(zlib.compress(sample[:SAMPLE_SIZE], 1)) < len(sample[:SAMPLE_SIZE]) * MIN_SAVING
+    return True
+
+
+def check(codec: str) -> None:
+    """
+    Raises ValueError if `codec` isn't available here.
+    """
+    if codec not in CODECS:
+        raise ValueError(f"Unsupported compression '{codec}'.")
+
+
+class Encoder:
+    """
+    Streaming compressor. Pass pieces of data to `compress`, then call `flush` once for the rest.
+    """
+    def __init__(self, codec: str) -> None:
+        check(codec)
+        self.codec = codec
+        if codec == "zstd":
+            self.__encoder = zstandard.ZstdCompressor(level=LEVELS["zstd"]).compressobj() # type: ignore
+        elif codec == "zlib":
+            self.__encoder = zlib.compressobj(LEVELS["zlib"])
+        else:
+            self.__encoder = lzma.LZMACompressor(preset=LEVELS["lzma"])
+
+    def compress(self, data: bytes) -> bytes:
+        return self.__encoder.compress(data)
+
+    def flush(self) -> bytes:
+        return self.__encoder.flush()
+
+
+class Decoder:
+    """
+    Streaming decompressor. `codec` None passes data through as is.
+
+    Decompresses in bounded steps, so a few KB that expand to gigabytes (a decompression bomb) never have to fit in
+    memory at once.
+    """
+    def __init__(self, codec: str | None) -> None:
+        self.codec = codec
+        if codec is None:
+            self.__decoder = None
+            return
+
+        check(codec)
+        if codec == "zstd":
+            self.__decoder = zstandard.ZstdDecompressor().decompressobj() # type: ignore
+        elif codec == "zlib":
+            self.__decoder = zlib.decompressobj()
+        else:
+            self.__decoder = lzma.LZMADecompressor()
+
+    def decompress(self, data: bytes, size: int = PIECE_SIZE) -> Iterator[bytes]:
+        """
+        Yields `data` decompressed, in pieces of at most `size` bytes.
+
+        Raises ValueError if the data is not valid.
+        """
+        if self.__decoder is None:
+            for offset in range(0, len(data), size):
+                yield data[offset:offset + size]
+            return
+        try:
+            if self.codec == "zlib":
+                while True:
+                    piece = self.__decoder.decompress(data, size)
+                    data = self.__decoder.unconsumed_tail
+                    if piece:
+                        yield piece
+                    # A full piece may have more waiting behind it, even once all the input is in.
+                    if not data and len(piece) < size:
+                        break
+            elif self.codec == "lzma":
+                piece = self.__decoder.decompress(data, size)
+                while True:
+                    if piece:
+                        yield piece
+                    if self.__decoder.eof or self.__decoder.needs_input:
+                        break
+                    piece = self.__decoder.decompress(b"", size)
+            else:
+                for offset in range(0, len(data), ZSTD_FEED):
+                    output = self.__decoder.decompress(data[offset:offset + ZSTD_FEED])
+                    for start in range(0, len(output), size):
+                        yield output[start:start + size]
+        except Exception as e:
+            # zlib.error, lzma.LZMAError and zstandard.ZstdError share no base class.
+            raise ValueError(f"Invalid {self.codec} data: {e}")
+
+    def close(self) -> bytes:
+        """
+        Returns whatever is left. Raises ValueError if the data was cut short.
+        """
+        if self.__decoder is None:
+            return b""
+        rest = self.__decoder.flush() if self.codec == "zlib" else b""
+        # Every codec's decompressor knows whether it saw the end of the stream.
+        if not self.__decoder.eof:
+            raise ValueError(f"Compressed ({self.codec}) data was cut short.")
+        return rest
+
+
+def compress(codec: str, data: bytes) -> bytes:
+    """
+    Compress `data` in one go.
+    """
+    encoder = Encoder(codec)
+    return encoder.compress(data) + encoder.flush()
+
+
+def decompress(codec: str | None, data: bytes, limit: int) -> bytes:
+    """
+    Decompress `data` in one go. `codec` None returns it as is.
+
+    Raises ValueError if the data is invalid, cut short, or would be bigger than `limit` bytes once decompressed.
+    """
+    if codec is None:
+        return data
+
+    decoder = Decoder(codec)
+    result = bytearray()
+    for piece in decoder.decompress(data, limit + 1):
+        result += piece
+        if len(result) > limit:
+            raise ValueError("Decompressed data is too large.")
+    result += decoder.close()
+    if len(result) > limit:
+        raise ValueError("Decompressed data is too large.")
+    return bytes(result)
+
+
+class Reader:
+    """
+    Read-only file object with the decompressed contents of `stream`.
+    """
+    def __init__(self, stream: BinaryIO, codec: str) -> None:
+        check(codec)
+        self.__stream = stream
+        if codec == "zstd":
+            self.__reader = zstandard.ZstdDecompressor().stream_reader(stream) # type: ignore
+        elif codec == "lzma":
+            self.__reader = lzma.LZMAFile(stream)
+        else:
+            self.__reader = None
+            self.__decoder = zlib.decompressobj()
+            self.__buffer = b""
+
+    def read(self, size: int = -1) -> bytes:
+        if self.__reader is not None:
+            return self.__reader.read(size)
+
+        # zlib has no file object of its own. Only ever decompress as much as was asked for, so a small file that
+        # expands to a huge one can't fill up memory.
+        while size < 0 or len(self.__buffer) < size:
+            data = self.__decoder.unconsumed_tail
+            if not data:
+                if self.__decoder.eof:
+                    break
+                data = self.__stream.read(1024 * 1024)
+                if not data:
+                    break
+            if size < 0:
+                self.__buffer += self.__decoder.decompress(data)
+            else:
+                self.__buffer += self.__decoder.decompress(data, size - len(self.__buffer))
+
+        if size < 0:
+            size = len(self.__buffer)
+        data, self.__buffer = self.__buffer[:size], self.__buffer[size:]
+        return data
+
+    def close(self) -> None:
+        if self.__reader is not None:
+            self.__reader.close()
+        self.__stream.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def iter_decompressed(path: str, codec: str, start: int = 0, end: int | None = None) -> Iterator[bytes]:
+    """
+    Yields the bytes in [start, end) of a compressed file, once decompressed, a MB at a time.
+
+    Everything before `start` has to be decompressed to get there, so this gets slower the further in it starts.
+    """
+    with Reader(open(path, "rb"), codec) as f:
+        offset = 0
+        while end is None or offset < end:
+            data = f.read(1024 * 1024)
+            if not data:
+                return
+            if offset + len(data) > start:
+                yield data[max(start - offset, 0):None if end is None else end - offset]
+            offset += len(data)
@@ -0,0 +1,156 @@
+"""
+Delta Module.
+
+Sends a new version of a large file as its changes from the version the server already has, in the style of rsync.
+
+The server describes its copy with a signature: the length and hash of each of its chunks. The client cuts its own
+copy into chunks the same way and sends a delta, where every chunk the server already has becomes a reference into
+the old file and everything else is sent as is. The server rebuilds the new version from the old one and the delta.
+
+Chunks are content-defined (see chunker), so their boundaries are found with a rolling hash and follow the data
+wherever it moves. Inserting a few bytes only changes the chunks around them, not every block after them.
+
+Used by both ybt_cl and ybt_srv.
+
+Format
+---
+A delta is a list of operations, each starting with a one byte code:
+
+`C` offset length: Copy `length` bytes from `offset` in the old file. (8 byte unsigned big endian numbers)
+
+`L` length: `length` bytes (an 8 byte number) of new data, which follow right after.
+"""
+import os
+import struct
+import hashlib
+from typing import BinaryIO, Iterator
+
+import chunker
+
+COPY = b"C"
+LITERAL = b"L"
+
+_COPY = struct.Struct(">cQQ")
+_LITERAL = struct.Struct(">cQ")
+
+
+def signature(stream: BinaryIO) -> list[list]:
+    """
+    Returns the signature of the contents of `stream`: [length, hash] of each chunk, in order.
+    """
+    return [[len(data), chunker.hash_chunk(data)] for data in chunker.iter_chunks(stream)]
+
+
+def encode(stream: BinaryIO, blocks: list[list]) -> Iterator[bytes]:
+    """
+    Yields the delta that turns the file with the signature `blocks` into the contents of `stream`.
+
+    Chunks that follow each other in the old file are sent as a single copy.
+    """
+    # Where each chunk of the old file starts.
+    offsets: dict[str, int] = {}
+    offset = 0
+    for length, digest in blocks:
+        offsets.setdefault(digest, offset)
+        offset += length
+
+    # The copy being built up, as [offset, length].
+    copy = None
+    for data in chunker.iter_chunks(stream):
+        start = offsets.get(chunker.hash_chunk(data))
+        if start is not None and copy is not None and copy[0] + copy[1] == start:
+            copy[1] += len(data)
+            continue
+
+        if copy is not None:
+            yield _COPY.pack(COPY, *copy)
+            copy = None
+        if start is None:
+            yield _LITERAL.pack(LITERAL, len(data))
+            yield data
+        else:
+            copy = [start, len(data)]
+
+    if copy is not None:
+        yield _COPY.pack(COPY, *copy)
+
+
+class Patcher:
+    """
+    Rebuilds a file from its old version (`base`, which must be seekable) and a delta, written to `out`.
+
+    The delta can be fed in pieces of any size as it arrives. The new file is hashed on the way through.
+    """
+    def __init__(self, base: BinaryIO, out: BinaryIO, hash_name: str = "sha256") -> None:
+        self.base = base
+        self.out = out
+        # Bytes of the new file that came from the old one, and that were sent.
+        self.copied = 0
+        self.literal = 0
+
+        # Private
+        self.__hash = hashlib.new(hash_name)
+        self.__buffer = bytearray()
+        # Bytes of the current literal that haven't arrived yet.
+        self.__remaining = 0
+
+        base.seek(0, os.SEEK_END)
+        self.__base_size = base.tell()
+
+    def feed(self, data: bytes) -> None:
+        """
+        Apply the next piece of the delta.
+
+        Raises ValueError if the delta is invalid.
+        """
+        self.__buffer += data
+        while self.__buffer:
+            if self.__remaining:
+                piece = bytes(self.__buffer[:self.__remaining])
+                del self.__buffer[:len(piece)]
+                self.__remaining -= len(piece)
+                self.literal += len(piece)
+                self.__write(piece)
+                continue
+
+            code = self.__buffer[:1]
+            if code == COPY:
+                if len(self.__buffer) < _COPY.size:
+                    return
+                _, offset, length = _COPY.unpack_from(self.__buffer)
+                del self.__buffer[:_COPY.size]
+                self.__copy(offset, length)
+            elif code == LITERAL:
+                if len(self.__buffer) < _LITERAL.size:
+                    return
+                _, self.__remaining = _LITERAL.unpack_from(self.__buffer)
+                del self.__buffer[:_LITERAL.size]
+            else:
+                raise ValueError("Invalid delta.")
+
+    def close(self) -> str:
+        """
+        Check that the whole delta arrived. Returns the hex digest of the new file.
+
+        Raises ValueError if the delta was cut short.
+        """
+        if self.__buffer or self.__remaining:
+            raise ValueError("Delta was cut short.")
+        return self.__hash.hexdigest()
+
+    def __copy(self, offset: int, length: int) -> None:
+        if offset + length > self.__base_size:
+            raise ValueError("Delta refers past the end of the old file.")
+
+        self.base.seek(offset)
+        while length > 0:
+            data = self.base.read(min(length, 1024 * 1024))
+            if not data:
+                raise ValueError("Old file is shorter than it should be.")
+            length -= len(data)
+            self.copied += len(data)
+            self.__write(data)
+
+    def __write(self, data: bytes) -> None:
+        self.out.write(data)
+        self.__hash.update(data)
@@ -0,0 +1,135 @@
+"""
+File Index Module.
+
+Remembers what every uploaded file looked like so unchanged files can be skipped on the next run.
+"""
+import os
+import json
+import mmap
+import time
+import hashlib
+
+# Hash used for file contents. The server must use the same one.
+HASH_NAME = "sha256"
+# Files at least this big are memory mapped instead of read...
+MMAP_THRESHOLD = 4 * 1024 * 1024
+# ...once they have gone this long without changing (seconds). A mapped file that gets shorter while it is being
+# hashed kills the process (SIGBUS), and a file that was just written to may well still be in use.
+MMAP_MIN_AGE = 60
+
+
+def hash_file(path: str, block_size: int = 1024 * 1024, use_mmap: bool = True) -> str:
+    """
+    Hash the contents of a file.
+
+    Large files are memory mapped and hashed in one go, so their contents are never copied into Python (and hashlib
+    lets go of the GIL for the whole file). Returns the hex digest.
+    """
+    h = hashlib.new(HASH_NAME)
+    with open(path, "rb") as f:
+        st = os.fstat(f.fileno())
+        if use_mmap and st.st_size >= MMAP_THRESHOLD and time.time() - st.st_mtime >= MMAP_MIN_AGE:
+            try:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    if hasattr(mmap, "MADV_SEQUENTIAL"):
+                        mm.madvise(mmap.MADV_SEQUENTIAL)
+                    h.update(mm)
+                return h.hexdigest()
+            except (OSError, ValueError, OverflowError):
+                # Can't be mapped (ex. too big for a 32 bit process, or an odd filesystem). Read it instead.
+                h = hashlib.new(HASH_NAME)
+                f.seek(0)
+
+        while contents := f.read(block_size):
+            h.update(contents)
+    return h.hexdigest()
+
+
+class FileIndex:
+    """
+    Local file-state index.
+
+    Maps the remote path of every uploaded file (ex. `Documents/hello.txt`) to the size, mtime
+    and content hash the local copy had when it was uploaded.
+
+    The index belongs to one server and one user. If either changes, it starts out empty.
+    """
+    def __init__(self, path: str, server: str, username: str) -> None:
+        self.path = path
+        self.server = server
+        self.username = username
+
+        # Private
+        self.__files: dict[str, dict] = {}
+        self.__dirty = False
+
+        self.load()
+
+    def load(self) -> None:
+        """
+        Load the index from disk.
+
+        A missing, broken or foreign index is treated as empty.
+        """
+        try:
+            with open(self.path, "r") as f:
+                data = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return
+
+        if data.get("server") != self.server or data.get("username") != self.username:
+            return
+
+        self.__files = data.get("files", {})
+
+    def save(self) -> None:
+        """
+        Write the index to disk if anything changed.
+
+        The index is written to a temporary file first so a crash can never leave half of it behind.
+        """
+        if not self.__dirty:
+            return
+
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump({
+                "server": self.server,
+                "username": self.username,
+                "files": self.__files
+            }, f)
+        os.replace(tmp, self.path)
+        self.__dirty = False
+
+    def get(self, remote: str) -> dict | None:
+        """
+        Returns the stored entry for a remote path, or None if it was never uploaded.
+        """
+        return self.__files.get(remote)
+
+    def isUnchanged(self, remote: str, st: os.stat_result) -> bool:
+        """
+        Cheap check. Returns True if the file has the same size and mtime as when it was last uploaded.
+        """
+        entry = self.__files.get(remote)
+        if not entry:
+            return False
+        return entry["size"] == st.st_size and entry["mtime"] == st.st_mtime
+
+    def update(self, remote: str, st: os.stat_result, digest: str) -> None:
+        """
+        Record that the file at `remote` now matches the given stat and hash.
+        """
+        self.__files[remote] = {"size": st.st_size, "mtime": st.st_mtime, "hash": digest}
+        self.__dirty = True
+
+    def merge(self, files: dict[str, dict]) -> None:
+        """
+        Record many files at once, from entries with the same size, mtime and hash as the index keeps. (ex. a Journal)
+        """
+        for remote, entry in files.items():
+            self.__files[remote] = {"size": entry["size"], "mtime": entry["mtime"], "hash": entry["hash"]}
+            self.__dirty = True
+
+    def __len__(self) -> int:
+        return len(self.__files)
@@ -0,0 +1,196 @@
+"""
+Hasher Module.
+
+Hashes files for ybt_cl on several threads at once, and remembers every hash so a file is only hashed again once it
+changes.
+
+Threads are enough to use every core: hashlib lets go of the GIL while it hashes, and large files are memory mapped
+and hashed in a single call (see fileindex.hash_file). Unlike a process pool, nothing has to be started up or sent
+between processes, and ybt_cl (which runs as a script) is never imported again by a worker.
+"""
+import os
+import json
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import Callable, Iterable, Iterator, TypeVar
+
+from fileindex import hash_file
+
+T = TypeVar("T")
+
+# How many files each worker can be hashing ahead of the one that is being waited on.
+AHEAD = 4
+
+
+class HashCache:
+    """
+    Remembers the hash of every file hashed so far, by (inode, size, mtime).
+
+    Files are known by inode rather than path, so a file that was moved or renamed (or is backed up into another
+    folder) is still known. The server and user don't matter either, so unlike the FileIndex it is never thrown away.
+
+    Not thread safe. (Hasher only uses it from the thread that asked for the hashes.)
+    """
+    def __init__(self, path: str) -> None:
+        self.path = path
+
+        # Private
+        # "device:inode" -> [size, mtime in ns, hash]
+        self.__files: dict[str, list] = {}
+        # Keys looked up or added since loading. Everything else can be pruned.
+        self.__used: set[str] = set()
+        self.__dirty = False
+
+        self.load()
+
+    @staticmethod
+    def key(st: os.stat_result) -> str | None:
+        """
+        Returns the key for a file, or None if it has no inode to go by. (ex. os.DirEntry.stat() on Windows)
+        """
+        if not st.st_ino:
+            return None
+        return f"{st.st_dev}:{st.st_ino}"
+
+    def load(self) -> None:
+        """
+        Load the cache from disk. A missing or broken cache is treated as empty.
+        """
+        try:
+            with open(self.path, "r") as f:
+                self.__files = json.load(f).get("files", {})
+        except (FileNotFoundError, json.JSONDecodeError, AttributeError):
+            return
+
+    def save(self, prune: bool = False) -> None:
+        """
+        Write the cache to disk if anything changed.
+
+        With `prune`, files that weren't looked up since the cache was loaded are forgotten. Only prune after going
+        through everything that is backed up, or files in other folders will have to be hashed again.
+        """
+        if prune:
+            unused = self.__files.keys() - self.__used
+            for key in unused:
+                del self.__files[key]
+            self.__dirty = self.__dirty or bool(unused)
+        if not self.__dirty:
+            return
+
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump({"files": self.__files}, f, separators=(",", ":"))
+        os.replace(tmp, self.path)
+        self.__dirty = False
+
+    def get(self, st: os.stat_result) -> str | None:
+        """
+        Returns the hash of a file, if it was hashed before and hasn't changed since.
+        """
+        key = self.key(st)
+        entry = self.__files.get(key) if key else None
+        if entry is None:
+            return None
+        self.__used.add(key) # type: ignore
+        if entry[0] != st.st_size or entry[1] != st.st_mtime_ns:
+            return None
+        return entry[2]
+
+    def put(self, st: os.stat_result, digest: str) -> None:
+        key = self.key(st)
+        if not key:
+            return
+        self.__files[key] = [st.st_size, st.st_mtime_ns, digest]
+        self.__used.add(key)
+        self.__dirty = True
+
+    def __len__(self) -> int:
+        return len(self.__files)
+
+
+class Hasher:
+    """
+    Hashes files on `workers` threads, skipping any file `cache` already knows.
+
+    `timer`, if given, is called with (seconds, bytes) for every file that actually had to be hashed. It is called
+    from the worker threads.
+    """
+    def __init__(self, workers: int = 1, cache: HashCache | None = None,
+                 timer: Callable[[float, int], None] | None = None) -> None:
+        self.workers = max(workers, 1)
+        self.cache = cache
+        self.timer = timer
+
+    def hash(self, path: str, st: os.stat_result) -> str:
+        """
+        Hash one file, on this thread. `st` is the stat of the file, used to look it up in the cache.
+        """
+        digest = self.cache.get(st) if self.cache is not None else None
+        if digest is None:
+            digest = self.__hash(path, st)
+            if self.cache is not None:
+                self.cache.put(st, digest)
+        return digest
+
+    def save(self, prune: bool = False) -> None:
+        """
+        Save the cache, if there is one. (see HashCache.save)
+        """
+        if self.cache is not None:
+            self.cache.save(prune)
+
+    def imap(self, items: Iterable[tuple[T, str, os.stat_result]]) -> Iterator[tuple[T, str | OSError]]:
+        """
+        Hash every (item, path, stat) in `items`, yielding (item, hash) in the same order.
+
+        If a file couldn't be read, the OSError is yielded instead of its hash. `items` can be a slow generator
+        (ex. a folder scan). Hashes are yielded as soon as they are ready, and only a few files per worker are
+        hashed ahead of the one being waited on, so a huge folder never piles up in memory.
+        """
+        if self.workers == 1:
+            for item, path, st in items:
+                try:
+                    yield item, self.hash(path, st)
+                except OSError as e:
+                    yield item, e
+            return
+
+        # (item, stat, hash or the Future that will have it)
+        pending: deque[tuple[T, os.stat_result, str | Future]] = deque()
+        pool = ThreadPoolExecutor(self.workers, thread_name_prefix="hasher")
+        try:
+            for item, path, st in items:
+                digest = self.cache.get(st) if self.cache is not None else None
+                pending.append((item, st, digest if digest is not None else pool.submit(self.__hash, path, st)))
+
+                while pending and (len(pending) > self.workers * AHEAD or _ready(pending[0][2])):
+                    yield self.__result(*pending.popleft())
+
+            while pending:
+                yield self.__result(*pending.popleft())
+        finally:
+            # Stopped early (ex. the upload was cancelled). Don't hash what nobody will look at.
+            pool.shutdown(cancel_futures=True)
+
+    def __hash(self, path: str, st: os.stat_result) -> str:
+        start = time.perf_counter()
+        digest = hash_file(path)
+        if self.timer is not None:
+            self.timer(time.perf_counter() - start, st.st_size)
+        return digest
+
+    def __result(self, item: T, st: os.stat_result, job: str | Future) -> tuple[T, str | OSError]:
+        if isinstance(job, str):
+            return item, job
+        try:
+            digest = job.result()
+        except OSError as e:
+            return item, e
+        if self.cache is not None:
+            self.cache.put(st, digest)
+        return item, digest
+
+
+def _ready(job: str | Future) -> bool:
+    return isinstance(job, str) or job.done()
@@ -0,0 +1,153 @@
+"""
+Journal Module.
+
+Remembers how far a folder upload got, so ybt_cl can pick up where it stopped after a crash (see --resume).
+
+The FileIndex is only saved once a sync is over. The journal is written as each file finishes instead: one JSON
+line per file, appended and flushed right away, so it survives ybt_cl being killed (or the laptop going to sleep,
+or the server restarting) halfway through. Every line is a whole record, so a line that was cut short by a crash is
+simply ignored.
+
+The first line says which upload it belongs to (server, user and folder). Every line after it is a file:
+`{"remote": ..., "status": "done", "size": ..., "mtime": ..., "hash": ...}`, or `"status": "failed"` with an
+`"error"`. A later line for the same file replaces an earlier one.
+"""
+import os
+import json
+import time
+
+# Lines are flushed to the OS as they are written, and forced to disk at most this often. (seconds)
+SYNC_INTERVAL = 1.0
+
+
+class Journal:
+    """
+    Append-only record of the files one folder upload has finished. Not thread safe.
+
+    Call `open` before recording anything.
+    """
+    def __init__(self, path: str) -> None:
+        self.path = path
+
+        # Private
+        self.__header: dict = {}
+        # remote path -> the last line written for it
+        self.__files: dict[str, dict] = {}
+        self.__file = None
+        self.__synced = 0.0
+
+    @staticmethod
+    def read(path: str) -> tuple[dict, dict[str, dict]]:
+        """
+        Returns the header and the files (by remote path) of the journal at `path`.
+
+        A missing or broken journal is treated as empty.
+        """
+        header, files = {}, {}
+        try:
+            with open(path, "r") as f:
+                for number, line in enumerate(f):
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        # Cut short by a crash. Nothing after it was written.
+                        break
+                    if number == 0:
+                        header = entry
+                    elif isinstance(entry, dict) and "remote" in entry:
+                        files[entry["remote"]] = entry
+        except FileNotFoundError:
+            pass
+        return header, files
+
+    def open(self, header: dict, resume: bool = False) -> dict[str, dict]:
+        """
+        Start recording the upload described by `header`. (ex. server, username and folder)
+
+        With `resume`, and if the journal on disk is for the same upload, it is carried on and the files it already
+        has are returned. Otherwise it is started over, and nothing is returned.
+        """
+        old_header, files = self.read(self.path)
+        if not resume or old_header.get("upload") != header:
+            files = {}
+
+        self.__header = {"upload": header, "started": time.time()}
+        self.__files = dict(files)
+        self.__rewrite()
+        return files
+
+    def record(self, remote: str, status: str, st: os.stat_result | None = None, digest: str | None = None,
+               error: str | None = None) -> None:
+        """
+        Record that the file at `remote` is done (`st` and `digest` are what was uploaded) or failed (with `error`).
+        """
+        entry: dict = {"remote": remote, "status": status}
+        if st is not None:
+            entry.update({"size": st.st_size, "mtime": st.st_mtime})
+        if digest is not None:
+            entry["hash"] = digest
+        if error is not None:
+            entry["error"] = error
+        self.__files[remote] = entry
+
+        self.__file.write(json.dumps(entry, separators=(",", ":")) + "\n") # type: ignore
+        self.__file.flush() # type: ignore
+        if time.monotonic() - self.__synced >= SYNC_INTERVAL:
+            self.sync()
+
+    def sync(self) -> None:
+        """
+        Force everything recorded so far to disk.
+        """
+        if self.__file is not None:
+            self.__file.flush()
+            os.fsync(self.__file.fileno())
+        self.__synced = time.monotonic()
+
+    def checkpoint(self) -> None:
+        """
+        Forget the files that are done, once the FileIndex has them. (so the journal doesn't grow forever in --watch)
+
+        Failures are kept, so a later --resume can say what is left.
+        """
+        self.__files = {remote: entry for remote, entry in self.__files.items() if entry["status"] != "done"}
+        self.__rewrite()
+
+    def failed(self) -> dict[str, dict]:
+        """
+        Returns the files (by remote path) whose last attempt failed.
+        """
+        return {remote: entry for remote, entry in self.__files.items() if entry["status"] == "failed"}
+
+    def close(self) -> None:
+        """
+        Stop recording. The journal is removed if nothing failed, since there is nothing left to resume.
+        """
+        if self.__file is None:
+            return
+        self.__file.close()
+        self.__file = None
+        if not self.failed():
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                pass
+
+    def __rewrite(self) -> None:
+        """
+        Write the header and the files still worth keeping to a new journal, and move it into place.
+        """
+        if self.__file is not None:
+            self.__file.close()
+
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            f.write(json.dumps(self.__header, separators=(",", ":")) + "\n")
+            for entry in self.__files.values():
+                f.write(json.dumps(entry, separators=(",", ":")) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+
+        self.__file = open(self.path, "a")
+        self.__synced = time.monotonic()
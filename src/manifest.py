@@ -0,0 +1,391 @@
+"""
+Manifest Module.
+
+In-memory model of a user's manifest for ybt_srv, and how it is saved.
+
+Every folder keeps its contents in a dict keyed by name, so adding or finding a path only costs one
+lookup per folder on the way there, no matter how many files sit next to it.
+
+Changes are appended to a journal instead of rewriting the whole manifest each time. (see ManifestFile)
+"""
+import os
+import json
+import time
+import posixpath
+import secrets
+import itertools
+from typing import Iterator
+
+
+class Folder:
+    """
+    A folder in the manifest.
+
+    `children` maps names to either another Folder, or the metadata (size, mtime, hash...) of a file.
+    Names keep the order they were added in.
+    """
+    __slots__ = ("children",)
+
+    def __init__(self) -> None:
+        self.children: dict[str, "Folder | dict"] = {}
+
+
+class Manifest:
+    """
+    A user's manifest.
+
+    Paths are always from root and use forward slashes. (ex. `docs/notes/a.txt`)
+    """
+    VERSION = 2
+
+    def __init__(self) -> None:
+        self.root = Folder()
+        self.__count = 0
+        # Changes every time the manifest does. (see etag)
+        self.__stamp = secrets.token_hex(4)
+        self.__changes = 0
+
+    @property
+    def etag(self) -> str:
+        """
+        A tag that only stays the same for as long as the manifest does.
+        """
+        return f"{self.__stamp}-{self.__changes}"
+
+    @classmethod
+    def fromDict(cls, data: dict) -> "Manifest":
+        """
+        Build a manifest from its saved form.
+
+        Also accepts the original `{"root": [...]}` layout, so older manifests keep working.
+        """
+        manifest = cls()
+
+        if data.get("version") == cls.VERSION:
+            for relpath, meta in data["files"].items():
+                manifest.add(relpath, meta)
+            for relpath in data["folders"]:
+                manifest.addFolder(relpath)
+            return manifest
+
+        # Original layout: a tree of lists, where dicts are folders and strings are files.
+        # File metadata (if any) was kept separately, by path.
+        metas = data.get("files", {})
+
+        def walk(entries: list, prefix: str) -> None:
+            for entry in entries:
+                if isinstance(entry, dict):
+                    for name, contents in entry.items():
+                        manifest.addFolder(prefix + name)
+                        walk(contents, prefix + name + "/")
+                else:
+                    manifest.add(prefix + entry, metas.get(prefix + entry, {}))
+
+        walk(data.get("root", []), "")
+        return manifest
+
+    def toDict(self) -> dict:
+        """
+        Returns the saved form of the manifest.
+
+        Every file is listed by path with its metadata, in tree order. Folders are implied by the files inside
+        them, so only empty folders are listed separately.
+        """
+        folders = []
+        files = {}
+        for relpath, node in self.walk():
+            if not isinstance(node, Folder):
+                files[relpath] = node
+            elif not node.children:
+                folders.append(relpath)
+        return {"version": self.VERSION, "folders": folders, "files": files}
+
+    def toLegacy(self, folder: "Folder | None" = None, depth: int | None = None, offset: int = 0, limit: int | None = None,
+                 prefix: str = "", files: dict | None = None) -> list:
+        """
+        Returns the contents of a folder (root by default) in the original manifest layout.
+
+        Files are strings, and folders are `{name: [contents]}`.
+
+        args
+        ---
+        `depth`: How many levels of folders to include. Folders below that are `{name: None}`.
+
+        `offset`, `limit`: Only include this slice of the folder's own entries.
+
+        `prefix`, `files`: If `files` is given, the metadata of every included file is added to it, by `prefix + path`.
+        """
+        entries = []
+        children = itertools.islice((folder or self.root).children.items(), offset, None if limit is None else offset + limit)
+        for name, node in children:
+            if not isinstance(node, Folder):
+                entries.append(name)
+                if files is not None:
+                    files[prefix + name] = node
+            elif depth is not None and depth <= 1:
+                entries.append({name: None})
+            else:
+                entries.append({name: self.toLegacy(node, None if depth is None else depth - 1, prefix=prefix + name + "/", files=files)})
+        return entries
+
+    def get(self, relpath: str) -> "Folder | dict | None":
+        """
+        Returns the Folder or file metadata at `relpath`, or None if there isn't anything there.
+        """
+        node = self.root
+        for name in relpath.split("/"):
+            if not isinstance(node, Folder):
+                return None
+            node = node.children.get(name)
+            if node is None:
+                return None
+        return node
+
+    def addFolder(self, relpath: str) -> Folder:
+        """
+        Add a folder (and any folders leading to it), returning it.
+
+        Raises ValueError if a file is in the way.
+        """
+        node = self.root
+        for name in relpath.split("/"):
+            if not name:
+                continue
+            child = node.children.get(name)
+            if child is None:
+                child = node.children[name] = Folder()
+                self.__changes += 1
+            elif not isinstance(child, Folder):
+                raise ValueError(f"'{name}' is a file, not a folder.")
+            node = child
+        return node
+
+    def add(self, relpath: str, meta: dict) -> None:
+        """
+        Add a file (and any folders leading to it), or update the metadata of an existing one.
+
+        Raises ValueError if a folder is in the way.
+        """
+        parent, name = posixpath.split(relpath)
+        folder = self.addFolder(parent)
+
+        existing = folder.children.get(name)
+        if isinstance(existing, Folder):
+            raise ValueError(f"'{relpath}' is a folder, not a file.")
+        if existing is None:
+            self.__count += 1
+        folder.children[name] = meta
+        self.__changes += 1
+
+    def remove(self, relpath: str) -> dict | None:
+        """
+        Remove a file. Returns its metadata, or None if it wasn't there.
+        """
+        parent, name = posixpath.split(relpath)
+        folder = self.get(parent) if parent else self.root
+        if not isinstance(folder, Folder) or isinstance(folder.children.get(name), Folder):
+            return None
+
+        meta = folder.children.pop(name, None)
+        if meta is not None:
+            self.__count -= 1
+            self.__changes += 1
+        return meta
+
+    def walk(self, folder: "Folder | None" = None, prefix: str = "") -> Iterator[tuple[str, "Folder | dict"]]:
+        """
+        Yields (path, node) for everything inside a folder (root by default), folders before their contents.
+        """
+        for name, node in (folder or self.root).children.items():
+            relpath = prefix + name
+            yield relpath, node
+            if isinstance(node, Folder):
+                yield from self.walk(node, relpath + "/")
+
+    def files(self) -> Iterator[tuple[str, dict]]:
+        """
+        Yields (path, metadata) for every file.
+        """
+        for relpath, node in self.walk():
+            if not isinstance(node, Folder):
+                yield relpath, node
+
+    def __len__(self) -> int:
+        """
+        Returns the number of files.
+        """
+        return self.__count
+
+
+class ManifestFile:
+    """
+    A user's manifest on disk, kept in memory between requests.
+
+    The manifest is saved as a snapshot (`manifest.json`) plus a journal (`manifest.journal`, in `dataPath`) of
+    the changes made since. Recording a change only appends a line to the journal, so it costs the same no matter how big
+    the manifest is. Once the journal grows past the snapshot (or gets old), both are compacted into a new
+    snapshot.
+
+    Not thread safe. Callers must hold the user's lock.
+    """
+    # Compact once the journal is larger than both this and the snapshot. (bytes)
+    # Tying it to the snapshot size means each entry is only rewritten a handful of times, however big the tree.
+    COMPACT_SIZE = 1024 * 1024
+    # Compact once the oldest journal entry is this old, so the journal never lingers. (seconds)
+    COMPACT_AGE = 10 * 60
+
+    def __init__(self, path: str, dataPath: str) -> None:
+        self.path = path
+        # Kept out of the user's files, so an upload can't replace them.
+        self.dataPath = dataPath
+        self.journalPath = os.path.join(dataPath, "manifest.journal")
+
+        self.manifest: Manifest | None = None
+        self.__snapshot_size = 0
+        self.__journal_size = 0
+        self.__journal_since = 0.0
+
+    @property
+    def size(self) -> int:
+        """
+        How many bytes the manifest takes on disk (snapshot and journal), as of the last load or change.
+        """
+        return self.__snapshot_size + self.__journal_size
+
+    def load(self) -> Manifest:
+        """
+        Returns the manifest, reading it from disk the first time.
+
+        Raises FileNotFoundError if there is no snapshot.
+        """
+        if self.manifest is not None:
+            return self.manifest
+
+        with open(self.path, "r") as f:
+            manifest = Manifest.fromDict(json.load(f))
+        self.__snapshot_size = os.path.getsize(self.path)
+
+        # Replay changes made since the snapshot.
+        try:
+            with open(self.journalPath, "rb") as f:
+                lines = f.readlines()
+        except FileNotFoundError:
+            lines = []
+
+        valid = 0
+        for line in lines:
+            try:
+                change = json.loads(line)
+            except ValueError:
+                # A crash mid-append leaves a partial last line. That change was never acknowledged.
+                break
+            try:
+                self.__apply(manifest, change)
+            except ValueError:
+                pass
+            valid += len(line)
+
+        self.manifest = manifest
+        self.__journal_size = valid
+        # The oldest entry is at least as old as the last one written.
+        self.__journal_since = os.path.getmtime(self.journalPath) if valid else time.time()
+        if valid != sum(len(line) for line in lines):
+            # Drop the partial line, so new changes aren't appended after it.
+            with open(self.journalPath, "r+b") as f:
+                f.truncate(valid)
+        return manifest
+
+    def record(self, changes: list[dict]) -> list[str]:
+        """
+        Apply changes to the manifest and append them to the journal.
+
+        A change is `{"op": "add", "path": ..., "meta": {...}}` or `{"op": "remove", "path": ...}`.
+
+        The journal is flushed to disk before returning, and compacted if it has grown too large or too old. If it
+        can't be written, the OSError is raised and the manifest is read from disk again next time, so it never holds
+        changes the journal doesn't.
+
+        Returns the paths of changes that could not be applied (see Manifest.add). These are left out of the journal.
+        """
+        manifest = self.load()
+
+        applied = []
+        failed = []
+        for change in changes:
+            try:
+                self.__apply(manifest, change)
+            except ValueError:
+                failed.append(change["path"])
+                continue
+            applied.append(change)
+
+        if not applied:
+            return failed
+
+        data = b"".join(json.dumps(change, separators=(",", ":")).encode() + b"\n" for change in applied)
+        try:
+            os.makedirs(self.dataPath, exist_ok=True)
+            with open(self.journalPath, "ab") as f:
+                try:
+                    f.write(data)
+                    f.flush()
+                    os.fsync(f.fileno())
+                except OSError:
+                    # Don't leave part of the changes behind to be replayed.
+                    f.truncate(self.__journal_size)
+                    raise
+        except OSError:
+            self.manifest = None
+            raise
+
+        if not self.__journal_size:
+            self.__journal_since = time.time()
+        self.__journal_size += len(data)
+
+        self.compactIfDue()
+        return failed
+
+    def compactIfDue(self) -> bool:
+        """
+        Compact if the journal is larger than the snapshot (and COMPACT_SIZE), or its oldest entry is older than
+        COMPACT_AGE. Returns whether it was.
+
+        Call every so often even when nothing is being recorded, so an idle user's journal is compacted too.
+        """
+        if self.manifest is None or not self.__journal_size:
+            return False
+        if self.__journal_size > max(self.COMPACT_SIZE, self.__snapshot_size) \
+                or time.time() - self.__journal_since > self.COMPACT_AGE:
+            self.compact()
+            return True
+        return False
+
+    def compact(self) -> None:
+        """
+        Write the whole manifest to a new snapshot and empty the journal.
+
+        The snapshot is written to a temporary file and renamed over the old one, so a crash leaves either the
+        old snapshot (and its journal) or the new one. Replaying the journal over the new snapshot is harmless.
+        """
+        manifest = self.load()
+
+        os.makedirs(self.dataPath, exist_ok=True)
+        tmp = os.path.join(self.dataPath, os.path.basename(self.path) + ".tmp")
+        with open(tmp, "w") as f:
+            json.dump(manifest.toDict(), f, separators=(",", ":"))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+
+        with open(self.journalPath, "wb"):
+            pass
+
+        self.__snapshot_size = os.path.getsize(self.path)
+        self.__journal_size = 0
+
+    @staticmethod
+    def __apply(manifest: Manifest, change: dict) -> None:
+        if change["op"] == "add":
+            manifest.add(change["path"], change["meta"])
+        elif change["op"] == "remove":
+            manifest.remove(change["path"])
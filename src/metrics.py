@@ -0,0 +1,168 @@
+"""
+Metrics Module.
+
+Counters, gauges and histograms for ybt_srv, shown by `/api/metrics` in the Prometheus text format.
+
+Updating a metric only takes a lock and bumps a number or two, so they are cheap enough to use on every request.
+Gauges can also be given a function instead, which is only called when the metrics are read.
+"""
+import bisect
+import threading
+from typing import Callable, Iterable
+
+# Seconds. Spans quick lookups up to multi-minute uploads of large files.
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _number(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _labels(names: Iterable[str], values: Iterable[str], extra: str = "") -> str:
+    pairs = [f"{name}=\"{_escape(str(value))}\"" for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Metric:
+    """
+    Base metric. Values are kept per set of label values, in the order of `labels`.
+    """
+    kind = "untyped"
+
+    def __init__(self, name: str, help: str, labels: Iterable[str] = (), registry: "Registry | None" = None) -> None:
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+        self._values: dict[tuple, object] = {}
+        (registry if registry is not None else REGISTRY).register(self)
+
+    def _samples(self) -> list[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self._samples())
+        return "\n".join(lines) + "\n"
+
+
+class Counter(Metric):
+    """
+    A number that only goes up (ex. requests served).
+    """
+    kind = "counter"
+
+    def inc(self, *labels: str, amount: float = 1) -> None:
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount # type: ignore
+
+    def _samples(self) -> list[str]:
+        with self._lock:
+            values = list(self._values.items())
+        return [f"{self.name}{_labels(self.labels, key)} {_number(value)}" for key, value in values] # type: ignore
+
+
+class Gauge(Metric):
+    """
+    A number that goes up and down (ex. uploads running right now).
+
+    If `function` is given, it is called whenever the metrics are read and returns {label values: value},
+    and the gauge can't be set by hand.
+    """
+    kind = "gauge"
+
+    def __init__(self, name: str, help: str, labels: Iterable[str] = (), registry: "Registry | None" = None,
+                 function: Callable[[], dict[tuple, float]] | None = None) -> None:
+        super().__init__(name, help, labels, registry)
+        self.function = function
+
+    def set(self, value: float, *labels: str) -> None:
+        with self._lock:
+            self._values[labels] = value
+
+    def inc(self, *labels: str, amount: float = 1) -> None:
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount # type: ignore
+
+    def dec(self, *labels: str, amount: float = 1) -> None:
+        self.inc(*labels, amount=-amount)
+
+    def _samples(self) -> list[str]:
+        if self.function is not None:
+            values = list(self.function().items())
+        else:
+            with self._lock:
+                values = list(self._values.items())
+        return [f"{self.name}{_labels(self.labels, key)} {_number(value)}" for key, value in values] # type: ignore
+
+
+class Histogram(Metric):
+    """
+    Counts how many values fell under each bucket (ex. how long requests took), plus their sum and count.
+    """
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labels: Iterable[str] = (), registry: "Registry | None" = None,
+                 buckets: Iterable[float] = DEFAULT_BUCKETS) -> None:
+        super().__init__(name, help, labels, registry)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, *labels: str) -> None:
+        # Only the first bucket the value fits in is counted here. They are added up when rendered.
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(labels)
+            if entry is None:
+                # [count per bucket (the last one is +Inf), sum]
+                entry = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][index] += 1 # type: ignore
+            entry[1] += value # type: ignore
+
+    def _samples(self) -> list[str]:
+        with self._lock:
+            values = [(key, list(counts), total) for key, (counts, total) in self._values.items()] # type: ignore
+
+        lines = []
+        for key, counts, total in values:
+            running = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                running += count
+                le = "le=\"" + _number(bound) + "\""
+                lines.append(f"{self.name}_bucket{_labels(self.labels, key, le)} {running}")
+            lines.append(f"{self.name}_sum{_labels(self.labels, key)} {_number(total)}")
+            lines.append(f"{self.name}_count{_labels(self.labels, key)} {running}")
+        return lines
+
+
+class Registry:
+    """
+    A set of metrics that are rendered together.
+    """
+    def __init__(self) -> None:
+        self.__lock = threading.Lock()
+        self.__metrics: list[Metric] = []
+
+    def register(self, metric: Metric) -> None:
+        with self.__lock:
+            self.__metrics.append(metric)
+
+    def render(self) -> str:
+        """
+        Returns every metric in the Prometheus text format.
+        """
+        with self.__lock:
+            metrics = list(self.__metrics)
+        return "".join(metric.render() for metric in metrics)
+
+
+REGISTRY = Registry()
@@ -4,9 +4,57 @@ Progress Bar Module.
 import sys, os
 import time
 import threading
-from io import StringIO
 from typing import Iterable
 
+class _Capture:
+    """
+    Stands in for stdout while a ProgressBar is showing.
+
+    Text is held until the bar's next update, which prints every finished line above the bar once.
+    Only lines that haven't been printed yet are kept, and if too much piles up it is printed right away,
+    so memory use stays bounded no matter how much is printed.
+    """
+    # Print straight away once this much text is waiting. (characters)
+    LIMIT = 64 * 1024
+
+    def __init__(self, bar: "ProgressBar") -> None:
+        self.__bar = bar
+        self.__lock = threading.Lock()
+        self.__pending: list[str] = []
+        self.__size = 0
+
+    def write(self, text: str) -> int:
+        with self.__lock:
+            self.__pending.append(text)
+            self.__size += len(text)
+            full = self.__size > self.LIMIT
+        if full:
+            self.__bar._render()
+        return len(text)
+
+    def flush(self) -> None:
+        pass
+
+    def take(self, everything: bool = False) -> str:
+        """
+        Returns the finished lines waiting to be printed (and forgets them). Unfinished lines stay, unless
+        `everything` is set (ex. the bar is closing), in which case they are ended with a newline and returned too.
+
+        An unfinished line longer than LIMIT is broken there and returned as well, so it can't pile up forever.
+        """
+        with self.__lock:
+            text = "".join(self.__pending)
+            cut = text.rfind("\n") + 1
+            if everything or len(text) - cut > self.LIMIT:
+                self.__pending = []
+                self.__size = 0
+                return text + "\n" if text and not text.endswith("\n") else text
+            rest = text[cut:]
+            self.__pending = [rest] if rest else []
+            self.__size = len(rest)
+        return text[:cut]
+
+
 class ProgressBar:
     """
     Progress bar. lets go.
@@ -16,7 +64,7 @@ class ProgressBar:
         The actual progress bar.
 
         Uses whatever its parent ProgressBar's MAX value is as the expected item count.
-        
+
         Example
         ---
         >>> with ProgressBar(90, "Hello!", " ", "*") as bar:
@@ -28,7 +76,7 @@ class ProgressBar:
         >>>         print("Hello, world!")
         >>>         sleep(0.1)
         >>>         bar.bar() # This should always be called last.
-        
+
         args
         ---
         @items: (str) Either the amount of expected items, or the list to be iterated over.
@@ -36,8 +84,13 @@ class ProgressBar:
         @empty: (str) The character(s) to use for empty spaces. Defaults to `-`
         @fill: (str) The character(s) to use for filled spaces. Defaults to `=`
         @size: (int/None) Force the size of the bar. If not supplied, the bar will attempt to dynamically resize
-        as it progresses. Note that setting this manually can cause issues 
+        as it progresses. Note that setting this manually can cause issues
         and crashes if the bar is too big for the terminal.
+
+        If the item count isn't known up front, start at 0 and call add() as items turn up.
+
+        If items are given a size (see add() and bar()), the bar also shows bytes, speed, and estimates the time
+        left from bytes instead of items.
         """
         if isinstance(items, list):
             self.MAX = len(items)
@@ -57,81 +110,105 @@ class ProgressBar:
         self.__count = len(range(self.MAX)) # type: ignore
         self.__start = time.time()
         self.__index = 0
+        self.__lock = threading.Lock()
+        # Only one thread draws at a time, so lines and the bar never interleave.
+        self.__render_lock = threading.Lock()
         self.__spinner_index = 0
-        self.__last_io = []
+        # Total and finished bytes, for items that have a size.
+        self.__bytes = 0
+        self.__bytes_done = 0
         self.__STDOUT = None
-        self.__IO = None
+        self.__IO: _Capture | None = None
+        self.__thread: threading.Thread | None = None
 
-    def __show(self, j, start, count):
+    @staticmethod
+    def __format_bytes(size: float) -> str:
+        for unit in ["B", "KB", "MB", "GB"]:
+            if size < 1024:
+                return f"{size:.1f} {unit}"
+            size /= 1024
+        return f"{size:.1f} TB"
+
+    def __show(self, final: bool = False):
         """
         Internal function.
 
         This does the actual work of creating the bar and handling any outside printing.
 
-        Size has to be supplied because Python is confused otherwise.
+        Only looks at what changed since the last call, so it costs the same no matter how much has been printed.
+        When `final`, unfinished lines are printed as well.
         """
         if not self.__IO:
             raise ValueError("IO was never assigned!")
 
-        remaining = ((time.time() - start) / j) * (count - j)
+        with self.__lock:
+            j, count = self.__index, self.__count
+            done, total = self.__bytes_done, self.__bytes
+
+        elapsed = time.time() - self.__start
+        if total:
+            # Files vary in size, so bytes are a much better guide than file count.
+            rate = done / elapsed if elapsed else 0
+            remaining = (total - done) / rate if rate else 0
+        else:
+            remaining = (elapsed / j) * (count - j) if j else 0
 
         mins, sec = divmod(remaining, 60)
 
         # Get the current spinner, or replace it with the finish symbol.
-        if self.__index != self.MAX:
-            spinner = self.spinner[self.__spinner_index]
-        else:
+        if count and j >= count:
             spinner = "✓"
+        else:
+            spinner = self.spinner[self.__spinner_index]
 
         # Assemble the end string for the final bar.
         time_str = f"{int(mins):02}:{sec:05.2f}"
         end_str = f"{j}/{count} est: {time_str}"
+        if total:
+            end_str = f"{j}/{count} {self.__format_bytes(done)}/{self.__format_bytes(total)} {self.__format_bytes(rate)}/s est: {time_str}"
 
-        if not self.size or os.get_terminal_size().columns > self.size:
+        try:
+            columns = os.get_terminal_size().columns
+        except OSError:
+            columns = 80
+
+        if not self.size or columns > self.size:
             # Determine the size of the bar dynamically.
-            self.size = (os.get_terminal_size().columns-6) - len(end_str) - len(self.title) - (len(self.fill)+len(self.empty)) - len(spinner)
+            self.size = (columns-6) - len(end_str) - len(self.title) - (len(self.fill)+len(self.empty)) - len(spinner)
         if self.resize:
             self.size = self.resize
 
-        x = int(self.size*j/count)
-
-        # Check if external things have been printed.
-        current_io = []
+        x = int(self.size*j/count) if count else 0
 
-        # force every line to be unique, so we only print them once.
-        for i, msg in enumerate(self.__IO.getvalue().split("\n")[:-1]):
-            # i is just the index of the message since StringIO doesn't purge old ones
-            newmsg = f"{i}__{msg}"
-            if newmsg not in current_io and newmsg:
-                current_io.append(newmsg)
-
-        # Clear the line, in case the progress bar is occupying it. 
+        # Clear the line, in case the progress bar is occupying it, and print anything new above it.
+        lines = self.__IO.take(final)
         print("\r\033[K", file=self.__STDOUT, end="\r")
-        if current_io != self.__last_io:                
-            for msg in current_io:
-                if msg not in self.__last_io:
-                    print(msg.split("__", 1)[1], file=self.__STDOUT)
-            
-            self.__last_io = current_io
-
+        if lines:
+            print(lines, file=self.__STDOUT, end="")
 
         final_str = f"{self.title}[{self.fill*x}{(self.empty*(self.size-x))}] {spinner} " + end_str
 
         self.__spinner_index += 1
         self.__spinner_index %= len(self.spinner)
-        if len(final_str) > os.get_terminal_size().columns:
+        if len(final_str) > columns:
+            self.__STDOUT.flush() # type: ignore
             return
         print(final_str, end="", file=self.__STDOUT, flush=True)
 
+    def _render(self, final: bool = False):
+        """
+        Draw the bar now. Safe to call from any thread.
+        """
+        with self.__render_lock:
+            self.__show(final)
+
     def __loop(self):
         """
         Bar loop. Allows for the bar to update without anything actually changing.
         """
         while self.__running:
-            if self.__index == self.MAX:
-                self.__running = False
-                break
-            self.__show(self.__index+1, self.__start, self.__count)
+            # Items can still be added, so keep going until the bar is closed.
+            self._render()
             time.sleep(0.2)
 
     def __enter__(self):
@@ -139,30 +216,46 @@ class ProgressBar:
         self.__STDOUT = sys.stdout
 
         # Change stdout to a fake output so we can capture all requests.
-        self.__IO = StringIO()
+        self.__IO = _Capture(self)
         sys.stdout = self.__IO
 
-        t = threading.Thread(target=self.__loop)
+        self.__thread = threading.Thread(target=self.__loop)
         # Dies when main thread dies.
-        t.daemon = True
-        t.start()
+        self.__thread.daemon = True
+        self.__thread.start()
 
         # Return ourself to expose ProgressBar.
         return self
-    
+
     def __exit__(self, exc_type, exc_val, exc_tb):
         # Restore stdout to whatever it was before.
         sys.stdout = self.__STDOUT
         # Ensure our seperate thread does actually exit.
         self.__running = False
+        if self.__thread is not None:
+            self.__thread.join()
 
-        # Ensure that we show the final value.
-        self.__show(self.__index, self.__start, self.__count)
+        # Ensure that we show the final value, and anything printed without a newline at the end.
+        self._render(final=True)
         print("\n", end="", flush=True)
 
-    def bar(self):
+    def add(self, items: int = 1, size: int = 0):
         """
-        Moves the bar forward one.
+        Adds items (and their total size in bytes) to the expected count.
+
+        Safe to call from multiple threads.
+        """
+        with self.__lock:
+            self.MAX += items
+            self.__count += items
+            self.__bytes += size
+
+    def bar(self, size: int = 0):
+        """
+        Moves the bar forward one. `size` is how many bytes that item was, if it was given to add().
+
+        Safe to call from multiple threads.
         """
-        # self.__show(self.__index+1, self.__start, self.__count)
-        self.__index += 1
+        with self.__lock:
+            self.__index += 1
+            self.__bytes_done += size
@@ -0,0 +1,238 @@
+"""
+Run Stats Module.
+
+Keeps track of where ybt_cl spends its time (scanning, hashing, uploading, waiting on the server) so a slow
+backup can be pinned on the disk, the network or the server. See `ybt_cl --stats` and `--report`.
+
+Phases that run in parallel (ex. hashing while uploading) are timed separately and added up per phase, so their
+totals can add up to more than the run took.
+"""
+import math
+import time
+import heapq
+import threading
+from contextlib import contextmanager
+from urllib.parse import urlparse
+from typing import Iterable, Iterator
+
+import requests
+
+
+def percentile(values: list[float], p: float) -> float | None:
+    """
+    Nearest-rank percentile. None if there are no values.
+    """
+    if not values:
+        return None
+    values = sorted(values)
+    return values[max(math.ceil(p / 100 * len(values)) - 1, 0)]
+
+
+def parse_server_timing(header: str) -> dict[str, float]:
+    """
+    Parse a `Server-Timing` header (ex. `auth;dur=0.12, total;dur=3.4`) into {name: seconds}.
+    """
+    timings = {}
+    for metric in header.split(","):
+        name, *params = [part.strip() for part in metric.split(";")]
+        for param in params:
+            key, _, value = param.partition("=")
+            if key == "dur":
+                try:
+                    timings[name] = float(value) / 1000
+                except ValueError:
+                    pass
+    return timings
+
+
+class CountedBody:
+    """
+    Streamed request body that counts the bytes it yields.
+
+    Streamed bodies are sent chunked, without a Content-Length, so `RunStats.response` reads the count from here.
+    """
+    def __init__(self, pieces: Iterable[bytes]) -> None:
+        self.pieces = pieces
+        self.sent = 0
+
+    def __iter__(self) -> Iterator[bytes]:
+        for data in self.pieces:
+            self.sent += len(data)
+            yield data
+
+
+class RunStats:
+    """
+    Timings and counters for one run of ybt_cl. Safe to use from multiple threads.
+
+    Requests are counted by adding `response` as a response hook, ex. `session.hooks["response"].append(stats.response)`.
+    """
+    def __init__(self, slowest: int = 10) -> None:
+        self.slowest = slowest
+        self.started = time.time()
+        self.__start = time.perf_counter()
+        self.__lock = threading.Lock()
+
+        # phase -> [seconds, times, bytes]
+        self.__phases: dict[str, list] = {}
+        # "METHOD /path" -> {"latencies": [...], "server": seconds, "sent": bytes, "received": bytes, "errors": n}
+        self.__endpoints: dict[str, dict] = {}
+        # reason -> times
+        self.__retries: dict[str, int] = {}
+        # (seconds, n, entry). n breaks ties, so entries are never compared.
+        self.__slowest: list[tuple[float, int, dict]] = []
+        self.__uploads = 0
+
+    def add(self, phase: str, seconds: float, size: int = 0) -> None:
+        """
+        Count `seconds` (and `size` bytes) towards `phase`.
+        """
+        with self.__lock:
+            entry = self.__phases.setdefault(phase, [0.0, 0, 0])
+            entry[0] += seconds
+            entry[1] += 1
+            entry[2] += size
+
+    @contextmanager
+    def phase(self, phase: str, size: int = 0):
+        """
+        Time the body of a with statement as `phase`.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(phase, time.perf_counter() - start, size)
+
+    def timeIter(self, phase: str, items: Iterable) -> Iterator:
+        """
+        Yields from `items`, counting the time spent waiting on each item towards `phase`. (ex. a folder scan)
+        """
+        iterator = iter(items)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.add(phase, time.perf_counter() - start)
+                return
+            self.add(phase, time.perf_counter() - start)
+            yield item
+
+    def retry(self, reason: str, times: int = 1) -> None:
+        with self.__lock:
+            self.__retries[reason] = self.__retries.get(reason, 0) + times
+
+    def upload(self, files: list[tuple[str, int]], seconds: float) -> None:
+        """
+        Record one upload of (local path, size) files (more than one for a batch), and how long it took.
+        """
+        size = sum(file_size for file, file_size in files)
+        self.add("upload", seconds, size)
+
+        entry = {"path": files[0][0], "files": len(files), "bytes": size, "seconds": round(seconds, 3)}
+        with self.__lock:
+            self.__uploads += 1
+            item = (seconds, self.__uploads, entry)
+            if len(self.__slowest) < self.slowest:
+                heapq.heappush(self.__slowest, item)
+            elif self.__slowest and seconds > self.__slowest[0][0]:
+                heapq.heapreplace(self.__slowest, item)
+
+    def response(self, r: requests.Response, *args, **kwargs) -> None:
+        """
+        Response hook for requests. Records the round trip, the server's own timing, and the bytes sent.
+        """
+        request = r.request
+        endpoint = f"{request.method} {urlparse(request.url).path}"
+        server = parse_server_timing(r.headers.get("Server-Timing", "")).get("total")
+        sent = request.body.sent if isinstance(request.body, CountedBody) else int(request.headers.get("Content-Length") or 0)
+        received = int(r.headers.get("Content-Length") or 0)
+
+        # Retries done by urllib3 itself (ex. on a dropped connection).
+        retries = getattr(getattr(r.raw, "retries", None), "history", ())
+
+        with self.__lock:
+            entry = self.__endpoints.setdefault(endpoint, {"latencies": [], "server": 0.0, "timed": 0, "sent": 0, "received": 0, "errors": 0})
+            entry["latencies"].append(r.elapsed.total_seconds())
+            if server is not None:
+                entry["server"] += server
+                entry["timed"] += 1
+            entry["sent"] += sent
+            entry["received"] += received
+            if r.status_code >= 400:
+                entry["errors"] += 1
+            if retries:
+                self.__retries["connection"] = self.__retries.get("connection", 0) + len(retries)
+
+    def report(self, **extra) -> dict:
+        """
+        Returns everything recorded so far as a dict that can be dumped to JSON. `extra` is added to the top level.
+        """
+        with self.__lock:
+            phases = {name: {"seconds": round(seconds, 3), "count": count, "bytes": size}
+                      for name, (seconds, count, size) in self.__phases.items()}
+
+            endpoints = {}
+            for name, entry in self.__endpoints.items():
+                latencies = entry["latencies"]
+                endpoints[name] = {
+                    "count": len(latencies),
+                    "errors": entry["errors"],
+                    "seconds": round(sum(latencies), 3),
+                    # Time the server spent on the requests. The rest of the round trip is the network (and queuing).
+                    "server_seconds": round(entry["server"], 3) if entry["timed"] else None,
+                    "p50_ms": round(percentile(latencies, 50) * 1000, 2), # type: ignore
+                    "p99_ms": round(percentile(latencies, 99) * 1000, 2), # type: ignore
+                    "max_ms": round(max(latencies) * 1000, 2),
+                    "bytes_sent": entry["sent"],
+                    "bytes_received": entry["received"],
+                }
+            retries = dict(self.__retries)
+            slowest = [entry for seconds, n, entry in sorted(self.__slowest, reverse=True)]
+
+        requests_seconds = sum(entry["seconds"] for entry in endpoints.values())
+        server_seconds = sum(entry["server_seconds"] or 0 for entry in endpoints.values())
+        return {
+            **extra,
+            "started": self.started,
+            "seconds": round(time.perf_counter() - self.__start, 3),
+            "phases": phases,
+            "requests": {
+                "count": sum(entry["count"] for entry in endpoints.values()),
+                "errors": sum(entry["errors"] for entry in endpoints.values()),
+                "seconds": round(requests_seconds, 3),
+                "server_seconds": round(server_seconds, 3),
+                "network_seconds": round(requests_seconds - server_seconds, 3),
+                "bytes_sent": sum(entry["bytes_sent"] for entry in endpoints.values()),
+                "bytes_received": sum(entry["bytes_received"] for entry in endpoints.values()),
+                "endpoints": endpoints,
+            },
+            "retries": retries,
+            "slowest": slowest,
+        }
+
+    def summary(self) -> str:
+        """
+        A few lines for the screen, covering the same as the report.
+        """
+        report = self.report()
+        lines = [f"Run took {report['seconds']:.2f}s (phases run in parallel, so they can add up to more)"]
+        for name, phase in report["phases"].items():
+            size = f", {phase['bytes'] / 1024 / 1024:.1f} MB" if phase["bytes"] else ""
+            lines.append(f"  {name:<8} {phase['seconds']:>9.2f}s  {phase['count']} times{size}")
+
+        req = report["requests"]
+        lines.append(f"  requests {req['seconds']:>9.2f}s  {req['count']} requests, {req['errors']} errors, {req['bytes_sent'] / 1024 / 1024:.1f} MB sent")
+        lines.append(f"    server  {req['server_seconds']:>8.2f}s")
+        lines.append(f"    network {req['network_seconds']:>8.2f}s")
+        for name, endpoint in sorted(report["requests"]["endpoints"].items(), key=lambda item: -item[1]["seconds"]):
+            lines.append(f"    {name}: {endpoint['count']}x p50 {endpoint['p50_ms']}ms p99 {endpoint['p99_ms']}ms")
+        if report["retries"]:
+            lines.append(f"  retries: {', '.join(f'{reason} {times}' for reason, times in report['retries'].items())}")
+        if report["slowest"]:
+            lines.append("  slowest uploads:")
+            for entry in report["slowest"]:
+                files = f" (+{entry['files'] - 1} more)" if entry["files"] > 1 else ""
+                lines.append(f"    {entry['seconds']:>8.2f}s  {entry['path']}{files}")
+        return "\n".join(lines)
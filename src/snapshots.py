@@ -0,0 +1,300 @@
+"""
+Snapshots Module.
+
+Point-in-time copies of a user's backup for ybt_srv, so a bad sync (ex. files encrypted by ransomware) can never
+replace the only good copy.
+
+Stored files are never changed in place: every upload writes a new file and moves it over the old one. So instead of
+copying anything, a snapshot shares what is already stored. `MirrorStore` files are hard linked into the snapshot,
+which keeps the old file alive after an upload replaces it. `ChunkStore` files are lists of chunks, which are kept
+for as long as any manifest or snapshot uses them (see ChunkStore.collect). Either way, taking a snapshot only
+costs metadata. `PackStore` packs are only appended to, so the packs a snapshot uses are linked the same way.
+
+Each snapshot is a folder `ID/` holding `info.json`, `manifest.json`, and (mirror and pack stores) the linked
+`files/` and `packs/`.
+"""
+import os
+import re
+import json
+import time
+import shutil
+import hashlib
+import threading
+from collections import OrderedDict
+
+import compression
+from manifest import Manifest, Folder
+from storage import MirrorStore, ChunkStore, PackStore, HASH_NAME
+
+# Snapshot IDs are made by SnapshotStore.create. Anything else is rejected, so an ID can never point outside the store.
+ID_PATTERN = re.compile(r"^[0-9]{8}-[0-9]{6}(-[0-9]+)?$")
+
+# Loaded snapshot manifests, by path. Snapshots never change, so they can be kept as long as there is room.
+CACHE_SIZE = 8
+_cache: "OrderedDict[str, Manifest]" = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def retained(snapshots: list[dict], last: int | None = None, daily: int | None = None, weekly: int | None = None,
+             monthly: int | None = None) -> set[str]:
+    """
+    Works out which snapshots a retention policy keeps. Returns their IDs.
+
+    args
+    ---
+    `last`: Keep the newest `last` snapshots.
+
+    `daily`, `weekly`, `monthly`: Keep the newest snapshot of each of the last N days, weeks or months that have one.
+
+    A snapshot is kept if any rule keeps it. If no rules are given, every snapshot is kept.
+    """
+    if last is None and daily is None and weekly is None and monthly is None:
+        return {info["id"] for info in snapshots}
+
+    newest = sorted(snapshots, key=lambda info: info["created"], reverse=True)
+    keep = {info["id"] for info in newest[:last or 0]}
+
+    periods = [(daily, "%Y-%m-%d"), (weekly, "%G-%V"), (monthly, "%Y-%m")]
+    for count, period in periods:
+        if not count:
+            continue
+        seen = set()
+        for info in newest:
+            key = time.strftime(period, time.gmtime(info["created"]))
+            if key in seen:
+                continue
+            if len(seen) >= count:
+                break
+            seen.add(key)
+            keep.add(info["id"])
+    return keep
+
+
+class SnapshotStore:
+    """
+    A user's snapshots, kept in `path`.
+
+    Not thread safe. Hold the user's lock while creating or removing snapshots.
+    """
+    def __init__(self, path: str, store: MirrorStore | ChunkStore | PackStore | None = None) -> None:
+        self.path = path
+        self.store = store
+
+    def snapshotPath(self, snapshot_id: str) -> str:
+        """
+        Returns where a snapshot is kept.
+
+        Raises ValueError if `snapshot_id` is not a valid snapshot ID.
+        """
+        if not ID_PATTERN.match(snapshot_id):
+            raise ValueError("Invalid snapshot ID.")
+        return os.path.join(self.path, snapshot_id)
+
+    def create(self, manifest: Manifest, label: str = "") -> dict:
+        """
+        Snapshot the files in `manifest` as they are stored right now.
+
+        Returns the new snapshot's info: its ID, when it was created, its label, and how many files and bytes it holds.
+        """
+        os.makedirs(self.path, exist_ok=True)
+        # Left behind by a crash part way through.
+        for name in os.listdir(self.path):
+            if name.startswith("."):
+                shutil.rmtree(os.path.join(self.path, name), ignore_errors=True)
+
+        created = time.time()
+        snapshot_id = time.strftime("%Y%m%d-%H%M%S", time.gmtime(created))
+        n = 1
+        while os.path.exists(os.path.join(self.path, snapshot_id)):
+            n += 1
+            snapshot_id = time.strftime("%Y%m%d-%H%M%S", time.gmtime(created)) + f"-{n}"
+
+        # Built under a hidden name and renamed once complete, so a half made snapshot is never listed.
+        tmp = os.path.join(self.path, f".{snapshot_id}")
+        os.makedirs(tmp)
+
+        snapshot = Manifest()
+        size = 0
+        # Packs linked so far, by their name in the user's manifest.
+        packs: dict[str, str] = {}
+        for relpath, meta in manifest.files():
+            if isinstance(self.store, PackStore) and "pack" in meta:
+                meta = self.__linkPack(meta, packs, tmp, snapshot_id)
+            elif isinstance(self.store, MirrorStore):
+                meta = self.__link(relpath, meta, os.path.join(tmp, "files", relpath))
+            if meta is None:
+                continue
+            snapshot.add(relpath, meta)
+            size += meta.get("size", 0)
+        for relpath, node in manifest.walk():
+            if isinstance(node, Folder) and not node.children:
+                snapshot.addFolder(relpath)
+
+        with open(os.path.join(tmp, "manifest.json"), "w") as f:
+            json.dump(snapshot.toDict(), f, separators=(",", ":"))
+
+        info = {"id": snapshot_id, "created": created, "label": label, "files": len(snapshot), "bytes": size}
+        with open(os.path.join(tmp, "info.json"), "w") as f:
+            json.dump(info, f, indent=2)
+
+        os.replace(tmp, os.path.join(self.path, snapshot_id))
+        return info
+
+    def __link(self, relpath: str, meta: dict, target: str) -> dict | None:
+        """
+        Hard link a stored file into a snapshot. Returns the metadata for the snapshot, or None if it is missing.
+        """
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        source = self.store.localPath(relpath) # type: ignore
+        try:
+            os.link(source, target)
+        except FileNotFoundError:
+            return None
+        except OSError:
+            # The disk doesn't support hard links. A copy still protects the file, it just costs space.
+            try:
+                shutil.copy2(source, target)
+            except FileNotFoundError:
+                return None
+
+        # A new copy can be moved into place just before the manifest is told about it. Describe what was linked.
+        st = os.stat(target)
+        if st.st_size != meta.get("stored", meta.get("size")) or st.st_mtime != meta.get("mtime"):
+            meta = {key: value for key, value in meta.items() if key not in ("encoding", "stored")}
+            meta.update(self.__describe(target, st))
+        return meta
+
+    def __describe(self, path: str, st: os.stat_result) -> dict:
+        """
+        Returns the size, mtime and hash of a linked file the manifest doesn't describe yet, and its encoding if the
+        store compressed it.
+        """
+        codec = getattr(self.store, "compress", None)
+        if codec:
+            # Only the store's own codec can be in use. A file that doesn't decode with it was kept as it is.
+            try:
+                h = hashlib.new(HASH_NAME)
+                size = 0
+                decoder = compression.Decoder(codec)
+                with open(path, "rb") as f:
+                    while contents := f.read(1024 * 1024):
+                        for data in decoder.decompress(contents):
+                            h.update(data)
+                            size += len(data)
+                data = decoder.close()
+                h.update(data)
+                size += len(data)
+                return {"size": size, "mtime": st.st_mtime, "hash": h.hexdigest(), "encoding": codec, "stored": st.st_size}
+            except ValueError:
+                pass
+
+        h = hashlib.new(HASH_NAME)
+        with open(path, "rb") as f:
+            while contents := f.read(1024 * 1024):
+                h.update(contents)
+        return {"size": st.st_size, "mtime": st.st_mtime, "hash": h.hexdigest()}
+
+    def __linkPack(self, meta: dict, packs: dict[str, str], tmp: str, snapshot_id: str) -> dict | None:
+        """
+        Link the pack a file is in into a snapshot (once per pack). Returns the metadata for the snapshot.
+        """
+        if meta["pack"] not in packs:
+            name = os.path.basename(meta["pack"])
+            os.makedirs(os.path.join(tmp, "packs"), exist_ok=True)
+            try:
+                os.link(self.store.packPath(meta["pack"]), os.path.join(tmp, "packs", name)) # type: ignore
+            except FileNotFoundError:
+                return None
+            except OSError:
+                shutil.copy2(self.store.packPath(meta["pack"]), os.path.join(tmp, "packs", name)) # type: ignore
+            # Pack paths are from the user's folder, so the snapshot's copy is read the same way.
+            final = os.path.join(self.path, snapshot_id, "packs", name)
+            packs[meta["pack"]] = os.path.relpath(final, self.store.base).replace(os.sep, "/") # type: ignore
+        return {**meta, "pack": packs[meta["pack"]]}
+
+    def listSnapshots(self) -> list[dict]:
+        """
+        Returns the info of every snapshot, oldest first.
+        """
+        snapshots = []
+        try:
+            names = os.listdir(self.path)
+        except FileNotFoundError:
+            return []
+
+        for name in names:
+            if not ID_PATTERN.match(name):
+                continue
+            try:
+                with open(os.path.join(self.path, name, "info.json"), "r") as f:
+                    snapshots.append(json.load(f))
+            except (OSError, ValueError):
+                continue
+        return sorted(snapshots, key=lambda info: info["created"])
+
+    def load(self, snapshot_id: str) -> Manifest:
+        """
+        Returns a snapshot's manifest.
+
+        Raises ValueError for invalid IDs, and FileNotFoundError if there is no such snapshot.
+        """
+        path = os.path.join(self.snapshotPath(snapshot_id), "manifest.json")
+        with _cache_lock:
+            if path in _cache:
+                _cache.move_to_end(path)
+                return _cache[path]
+
+        with open(path, "r") as f:
+            manifest = Manifest.fromDict(json.load(f))
+
+        with _cache_lock:
+            _cache[path] = manifest
+            while len(_cache) > CACHE_SIZE:
+                _cache.popitem(last=False)
+        return manifest
+
+    def localPath(self, snapshot_id: str, relpath: str) -> str:
+        """
+        Returns where a file in a (mirror store) snapshot is on disk.
+        """
+        return os.path.join(self.snapshotPath(snapshot_id), "files", relpath)
+
+    def remove(self, snapshot_id: str) -> None:
+        path = self.snapshotPath(snapshot_id)
+        # Hide it first, so it disappears all at once even if removing the files takes a while.
+        hidden = os.path.join(self.path, f".{snapshot_id}")
+        os.replace(path, hidden)
+
+        with _cache_lock:
+            _cache.pop(os.path.join(path, "manifest.json"), None)
+        shutil.rmtree(hidden, ignore_errors=True)
+
+    def prune(self, **policy) -> list[str]:
+        """
+        Remove every snapshot the retention policy doesn't keep. (see `retained`)
+
+        Returns the IDs that were removed.
+        """
+        snapshots = self.listSnapshots()
+        keep = retained(snapshots, **policy)
+        removed = []
+        for info in snapshots:
+            if info["id"] not in keep:
+                self.remove(info["id"])
+                removed.append(info["id"])
+        return removed
+
+    def chunksInUse(self) -> set[str]:
+        """
+        Returns every chunk used by any of these snapshots.
+        """
+        chunks = set()
+        for info in self.listSnapshots():
+            try:
+                manifest = self.load(info["id"])
+            except FileNotFoundError:
+                # Removed while we were looking.
+                continue
+            for relpath, meta in manifest.files():
+                chunks.update(meta.get("chunks", ()))
+        return chunks
@@ -0,0 +1,650 @@
+"""
+Storage Module.
+
+Storage backends for ybt_srv. A backend decides how the contents of a user's files are kept on disk.
+The user's manifest always records what is stored, and is passed back to the backend when reading.
+
+Backends
+---
+`MirrorStore`: Every file is a plain file under `fs/USERNAME`, mirroring the client's tree.
+
+`ChunkStore`: Files are split into content-defined chunks. Each chunk is stored once (by hash) in a
+store shared by every user, and files are lists of chunk references.
+
+`PackStore`: Like `MirrorStore`, but small files are appended to a few large pack files instead of each getting
+their own file, which saves inodes and makes the user's folder quick to scan. Files are found through their
+manifest entry, which records the pack, offset and length.
+
+`MirrorStore` and `PackStore` can keep files compressed (see compression). The manifest entry of a compressed file
+records its codec as `encoding`, and `stored` is how much space it takes. Its size and hash are always those of the
+real contents.
+"""
+import io
+import os
+import time
+import hashlib
+import threading
+from typing import BinaryIO, Iterable, Iterator
+
+import chunker
+import compression
+from manifest import ManifestFile
+
+# Hash used for file contents. Must match the one used by ybt_cl.
+HASH_NAME = "sha256"
+
+
+class MirrorStore:
+    """
+    Plain files under the user's folder.
+    """
+    name = "mirror"
+
+    def __init__(self, base: str, compress: str | None = None) -> None:
+        self.base = base
+        # Codec to keep files compressed with, if they are worth compressing. None keeps them as they are.
+        self.compress = compress
+
+    def write(self, relpath: str, stream: BinaryIO, mtime: float | None = None) -> dict:
+        """
+        Write the contents of `stream` to `relpath`, hashing (and compressing, if set) it on the way through.
+
+        Returns the size, mtime and hash of the stored copy, plus its encoding if it was compressed.
+        """
+        path = f"{self.base}/{relpath}"
+
+        # Make parent dirs if they don't exist already.
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # Write next to the file and move it into place once complete, so a failed upload never replaces the
+        # last good copy.
+        tmp = f"{path}.{threading.get_ident()}.tmp"
+        h = hashlib.new(HASH_NAME)
+        size = 0
+        try:
+            with open(tmp, 'wb') as f:
+                contents = stream.read(1024 * 1024)
+                codec = self.compress if self.compress and compression.worth_compressing(relpath, contents) else None
+                encoder = compression.Encoder(codec) if codec else None
+                while contents:
+                    f.write(encoder.compress(contents) if encoder else contents)
+                    h.update(contents)
+                    size += len(contents)
+                    contents = stream.read(1024 * 1024)
+                if encoder:
+                    f.write(encoder.flush())
+            if mtime is not None:
+                os.utime(tmp, (mtime, mtime))
+            os.replace(tmp, path)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+
+        return self.__meta(path, size, h.hexdigest(), codec)
+
+    def place(self, relpath: str, tmp: str, digest: str, mtime: float | None = None, verify: bool = True) -> dict:
+        """
+        Move a finished temporary file into place as `relpath`.
+
+        `tmp` must be on the same disk as the user's folder. It is only moved if its contents match `digest`,
+        so the last good copy is never replaced by a broken one. Set `verify` to False if the caller already
+        hashed it.
+
+        Raises ValueError if the hash does not match.
+
+        Returns the size, mtime and hash of the stored copy, plus its encoding if it was compressed.
+        """
+        if verify:
+            h = hashlib.new(HASH_NAME)
+            with open(tmp, "rb") as f:
+                while contents := f.read(1024 * 1024):
+                    h.update(contents)
+            if h.hexdigest() != digest:
+                raise ValueError("File does not match its hash.")
+
+        path = f"{self.base}/{relpath}"
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        size = os.path.getsize(tmp)
+
+        if self.compress:
+            with open(tmp, "rb") as f:
+                sample = f.read(compression.SAMPLE_SIZE)
+            if compression.worth_compressing(relpath, sample):
+                # Compressed next to the file, then moved into place like any other.
+                with open(tmp, "rb") as f:
+                    meta = self.write(relpath, f, mtime)
+                os.remove(tmp)
+                return meta
+
+        if mtime is not None:
+            os.utime(tmp, (mtime, mtime))
+        os.replace(tmp, path)
+
+        return self.__meta(path, size, digest, None)
+
+    def __meta(self, path: str, size: int, digest: str, codec: str | None) -> dict:
+        meta = {"size": size, "mtime": os.path.getmtime(path), "hash": digest}
+        if codec:
+            meta.update({"encoding": codec, "stored": os.path.getsize(path)})
+        return meta
+
+    def sync(self) -> None:
+        """
+        Make sure everything written so far is on disk. Files are written whole and moved into place, so there
+        is nothing to do.
+        """
+
+    def localPath(self, relpath: str) -> str:
+        """
+        Returns where a stored file is on disk.
+        """
+        return f"{self.base}/{relpath}"
+
+    def open(self, relpath: str, meta: dict) -> BinaryIO:
+        """
+        Open a stored file for reading. Compressed files are decompressed as they are read (and can't seek).
+        """
+        f = open(self.localPath(relpath), "rb")
+        if meta.get("encoding"):
+            return compression.Reader(f, meta["encoding"]) # type: ignore
+        return f
+
+
+class ChunkStore:
+    """
+    Deduplicated storage.
+
+    Every file is cut into chunks with `chunker`. Chunks live in `chunk_dir` as `ab/abcdef...`, named by
+    their hash, and are only ever written once. The file itself is just the list of chunk hashes kept in its
+    manifest entry, so nothing is written under the user's folder.
+    """
+    name = "chunk"
+
+    def __init__(self, base: str, chunk_dir: str) -> None:
+        self.base = base
+        self.chunk_dir = chunk_dir
+
+    def chunkPath(self, digest: str) -> str:
+        """
+        Returns where a chunk is kept.
+
+        Raises ValueError if `digest` is not a valid chunk hash.
+        """
+        if len(digest) != 64 or digest.strip("0123456789abcdef"):
+            raise ValueError("Invalid chunk hash.")
+        return os.path.join(self.chunk_dir, digest[:2], digest)
+
+    def hasChunk(self, digest: str) -> bool:
+        return os.path.exists(self.chunkPath(digest))
+
+    def touchChunk(self, digest: str) -> bool:
+        """
+        Mark a stored chunk as just used, so `collect` leaves it alone while a file using it is being committed.
+
+        Returns False if the chunk isn't stored.
+        """
+        try:
+            os.utime(self.chunkPath(digest))
+            return True
+        except FileNotFoundError:
+            return False
+
+    def missingChunks(self, digests: list[str]) -> list[str]:
+        """
+        Returns the chunks (in order, without duplicates) that are not stored yet.
+
+        Chunks that are stored are touched, since the client is about to commit a file that uses them.
+        """
+        missing = []
+        seen = set()
+        for digest in digests:
+            if digest not in seen and not self.touchChunk(digest):
+                missing.append(digest)
+            seen.add(digest)
+        return missing
+
+    def putChunk(self, digest: str, data: bytes) -> None:
+        """
+        Store a chunk.
+
+        Raises ValueError if `data` does not match `digest`. Chunks that already exist are left alone.
+        """
+        if chunker.hash_chunk(data) != digest:
+            raise ValueError("Chunk does not match its hash.")
+
+        path = self.chunkPath(digest)
+        if self.touchChunk(digest):
+            return
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Several uploads can carry the same chunk, so give each its own temporary file.
+        tmp = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+
+    def sync(self) -> None:
+        """
+        Nothing to do. Chunks are written whole and moved into place.
+        """
+
+    def readChunk(self, digest: str) -> bytes:
+        with open(self.chunkPath(digest), "rb") as f:
+            return f.read()
+
+    def write(self, relpath: str, stream: BinaryIO, mtime: float | None = None) -> dict:
+        """
+        Chunk the contents of `stream` and store any chunks that are new.
+
+        Returns the size, mtime, hash and chunk list of the file.
+        """
+        h = hashlib.new(HASH_NAME)
+        size = 0
+        chunks = []
+        for data in chunker.iter_chunks(stream):
+            digest = chunker.hash_chunk(data)
+            self.putChunk(digest, data)
+            chunks.append(digest)
+            h.update(data)
+            size += len(data)
+
+        return self.__entry(chunks, size, h.hexdigest(), mtime)
+
+    def place(self, relpath: str, tmp: str, digest: str, mtime: float | None = None, verify: bool = True) -> dict:
+        """
+        Chunk a finished temporary file and remove it.
+
+        The chunks are hashed either way, so `verify` is ignored.
+
+        Raises ValueError if its contents don't match `digest`.
+
+        Returns the size, mtime, hash and chunk list of the file.
+        """
+        with open(tmp, "rb") as f:
+            meta = self.write(relpath, f, mtime)
+        if meta["hash"] != digest:
+            raise ValueError("File does not match its hash.")
+
+        os.remove(tmp)
+        return meta
+
+    def commit(self, chunks: list[str], size: int, digest: str, mtime: float | None = None) -> dict:
+        """
+        Build the manifest entry for a file made of already stored chunks.
+
+        Raises FileNotFoundError if any of the chunks are missing.
+
+        Raises ValueError if the chunks don't add up to `size`, or their contents (in order) don't match `digest`.
+        """
+        if missing := self.missingChunks(chunks):
+            raise FileNotFoundError(f"{len(missing)} chunk(s) are missing.")
+
+        if sum(os.path.getsize(self.chunkPath(chunk)) for chunk in chunks) != size:
+            raise ValueError("Chunks do not add up to the file size.")
+
+        # The hash comes from the client, and is what restores and syncs compare against, so check it.
+        h = hashlib.new(HASH_NAME)
+        for chunk in chunks:
+            h.update(self.readChunk(chunk))
+        if h.hexdigest() != digest:
+            raise ValueError("File does not match its hash.")
+
+        return self.__entry(chunks, size, digest, mtime)
+
+    def __entry(self, chunks: list[str], size: int, digest: str, mtime: float | None) -> dict:
+        return {"size": size, "mtime": mtime if mtime is not None else time.time(), "hash": digest, "chunks": chunks}
+
+    def collect(self, in_use: set[str], grace: float) -> tuple[int, int]:
+        """
+        Remove every chunk that isn't in `in_use` and hasn't been touched for `grace` seconds.
+
+        The grace period covers chunks of files that are still being uploaded, which no manifest lists yet.
+
+        Returns how many chunks were removed, and their total size.
+        """
+        removed = 0
+        size = 0
+        cutoff = time.time() - grace
+        try:
+            folders = os.listdir(self.chunk_dir)
+        except FileNotFoundError:
+            return 0, 0
+
+        for folder in folders:
+            try:
+                entries = os.scandir(os.path.join(self.chunk_dir, folder))
+            except NotADirectoryError:
+                continue
+            with entries:
+                for entry in entries:
+                    if entry.name in in_use:
+                        continue
+                    try:
+                        st = entry.stat()
+                        if st.st_mtime >= cutoff:
+                            continue
+                        os.remove(entry.path)
+                    except FileNotFoundError:
+                        continue
+                    removed += 1
+                    size += st.st_size
+        return removed, size
+
+    def iterFile(self, meta: dict, start: int = 0, end: int | None = None) -> Iterator[bytes]:
+        """
+        Yields the contents of a stored file, one chunk at a time.
+
+        Set `start` and `end` to only get the bytes in [start, end). Chunks before `start` are skipped without being read.
+        """
+        offset = 0
+        for digest in meta["chunks"]:
+            if end is not None and offset >= end:
+                return
+
+            size = os.path.getsize(self.chunkPath(digest))
+            if offset + size > start:
+                data = self.readChunk(digest)
+                yield data[max(start - offset, 0):None if end is None else end - offset]
+            offset += size
+
+    def open(self, relpath: str, meta: dict) -> BinaryIO:
+        """
+        Open a stored file for reading.
+        """
+        return ChunkReader(self, meta)
+
+
+class ChunkReader:
+    """
+    Read-only file object over a list of chunks.
+    """
+    def __init__(self, store: ChunkStore, meta: dict) -> None:
+        self.__chunks = store.iterFile(meta)
+        self.__buffer = b""
+
+    def read(self, size: int = -1) -> bytes:
+        while size < 0 or len(self.__buffer) < size:
+            data = next(self.__chunks, None)
+            if data is None:
+                break
+            self.__buffer += data
+
+        if size < 0:
+            size = len(self.__buffer)
+        data, self.__buffer = self.__buffer[:size], self.__buffer[size:]
+        return data
+
+    def close(self) -> None:
+        self.__chunks.close() # type: ignore
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class PackStore(MirrorStore):
+    """
+    Mirror store that keeps small files in pack files.
+
+    Files smaller than PACK_FILE_SIZE are appended to the user's current pack (`.ybt/packs/pack-NNNNNN.pack`), and
+    their manifest entry records where: `{"pack": ..., "offset": ..., "length": ...}`. The pack path is relative to
+    the user's folder. Larger files are stored as plain files, exactly like MirrorStore.
+
+    Packs are only ever appended to, so replacing a packed file just leaves its old copy behind. `repack` copies the
+    files still in use out of packs that are mostly unused, so those packs can be removed.
+
+    Appends aren't flushed to disk one by one. Call `sync` before the manifest is told about them, so a whole batch
+    of files only costs one fsync.
+    """
+    name = "pack"
+
+    # Files smaller than this are packed. (bytes)
+    PACK_FILE_SIZE = 1024 * 1024
+    # A new pack is started once the current one is this big. (bytes)
+    PACK_SIZE = 64 * 1024 * 1024
+    # Packs where less than this much of the data is still in use are repacked.
+    REPACK_RATIO = 0.5
+    # Packs written to more recently than this are left alone, since files appended to them may not be in
+    # the manifest yet. (seconds)
+    REPACK_MIN_AGE = 10 * 60
+
+    PACK_DIR = ".ybt/packs"
+
+    # Appends to a user's packs happen one at a time, by user folder.
+    __locks: dict[str, threading.Lock] = {}
+    __locks_lock = threading.Lock()
+
+    def __init__(self, base: str, compress: str | None = None) -> None:
+        super().__init__(base, compress)
+        self.packDir = os.path.join(base, self.PACK_DIR)
+        with PackStore.__locks_lock:
+            self.__lock = PackStore.__locks.setdefault(base, threading.Lock())
+        # Packs appended to since the last sync.
+        self.__unsynced: set[str] = set()
+
+    def packPath(self, pack: str) -> str:
+        """
+        Returns where a pack (as named in a manifest entry) is on disk.
+
+        Packs (and the snapshots' copies of them) only ever live in the user's `.ybt` folder. Raises
+        FileNotFoundError for any other path, so a tampered manifest entry can't be used to read other files.
+        """
+        data = os.path.realpath(os.path.join(self.base, ".ybt"))
+        path = os.path.realpath(os.path.join(self.base, pack))
+        if os.path.commonpath([data, path]) != data or path == data:
+            raise FileNotFoundError(f"No such pack: {pack}")
+        return path
+
+    def __append(self, data: bytes) -> tuple[str, int]:
+        """
+        Append `data` to the current pack. Returns the pack (relative to the user's folder) and the offset.
+        """
+        with self.__lock:
+            os.makedirs(self.packDir, exist_ok=True)
+            packs = sorted(name for name in os.listdir(self.packDir) if name.endswith(".pack"))
+            number = int(packs[-1][5:-5]) if packs else 1
+            if packs and os.path.getsize(os.path.join(self.packDir, packs[-1])) + len(data) > self.PACK_SIZE:
+                number += 1
+
+            name = f"pack-{number:06}.pack"
+            path = os.path.join(self.packDir, name)
+            with open(path, "ab") as f:
+                offset = f.tell()
+                f.write(data)
+            self.__unsynced.add(path)
+        return f"{self.PACK_DIR}/{name}", offset
+
+    def __pack(self, relpath: str, data: bytes, digest: str, mtime: float | None) -> dict:
+        codec = self.compress if self.compress and compression.worth_compressing(relpath, data) else None
+        stored = compression.compress(codec, data) if codec else data
+        pack, offset = self.__append(stored)
+        # A plain copy left from when the file was bigger is no longer needed. (snapshots have their own link to it)
+        plain = self.localPath(relpath)
+        if os.path.isfile(plain):
+            os.remove(plain)
+        meta = {"size": len(data), "mtime": mtime if mtime is not None else time.time(), "hash": digest,
+                "pack": pack, "offset": offset, "length": len(stored)}
+        if codec:
+            meta["encoding"] = codec
+        return meta
+
+    def write(self, relpath: str, stream: BinaryIO, mtime: float | None = None) -> dict:
+        """
+        Store the contents of `stream`, in a pack if it is small.
+
+        Returns the size, mtime and hash of the stored copy, plus where it is packed (if it was).
+        """
+        data = stream.read(self.PACK_FILE_SIZE)
+        if len(data) < self.PACK_FILE_SIZE:
+            return self.__pack(relpath, data, hashlib.new(HASH_NAME, data).hexdigest(), mtime)
+        return super().write(relpath, _Prefixed(data, stream), mtime)
+
+    def place(self, relpath: str, tmp: str, digest: str, mtime: float | None = None, verify: bool = True) -> dict:
+        """
+        Same as MirrorStore.place, but small files are packed (and the temporary file removed).
+        """
+        if os.path.getsize(tmp) >= self.PACK_FILE_SIZE:
+            return super().place(relpath, tmp, digest, mtime, verify)
+
+        with open(tmp, "rb") as f:
+            data = f.read()
+        if verify and hashlib.new(HASH_NAME, data).hexdigest() != digest:
+            raise ValueError("File does not match its hash.")
+
+        meta = self.__pack(relpath, data, digest, mtime)
+        os.remove(tmp)
+        return meta
+
+    def sync(self) -> None:
+        """
+        Flush everything appended to packs (by this PackStore) to disk.
+        """
+        while self.__unsynced:
+            path = self.__unsynced.pop()
+            fd = os.open(path, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+    def iterFile(self, meta: dict, start: int = 0, end: int | None = None) -> Iterator[bytes]:
+        """
+        Yields the bytes in [start, end) of a stored file, a MB at a time.
+        """
+        if meta.get("encoding"):
+            # Packed files are small, so they are decompressed in one go.
+            data = compression.decompress(meta["encoding"], b"".join(self.__iterRaw(meta)), meta["size"])
+            yield data[start:end]
+            return
+        yield from self.__iterRaw(meta, start, end)
+
+    def __iterRaw(self, meta: dict, start: int = 0, end: int | None = None) -> Iterator[bytes]:
+        """
+        Same as iterFile, but yields the bytes as they are in the pack. (still compressed, if they are)
+        """
+        length = meta["length"]
+        end = length if end is None else min(end, length)
+        with open(self.packPath(meta["pack"]), "rb") as f:
+            f.seek(meta["offset"] + start)
+            remaining = end - start
+            while remaining > 0:
+                data = f.read(min(remaining, 1024 * 1024))
+                if not data:
+                    return
+                remaining -= len(data)
+                yield data
+
+    def open(self, relpath: str, meta: dict) -> BinaryIO:
+        if "pack" not in meta:
+            return super().open(relpath, meta)
+        return io.BytesIO(b"".join(self.iterFile(meta)))
+
+    def repack(self, files: Iterable[tuple[str, dict]]) -> tuple[dict[str, dict], list[str]]:
+        """
+        Copy the files still in use out of packs that are mostly unused.
+
+        `files` is every (path, metadata) in the user's manifest. Only packs that are no longer being appended to are
+        looked at.
+
+        Returns the new metadata of the files that moved (by path), and the packs that can be removed once the
+        manifest has been updated with it. Call `sync` before updating the manifest.
+        """
+        try:
+            names = sorted(name for name in os.listdir(self.packDir) if name.endswith(".pack"))
+        except FileNotFoundError:
+            return {}, []
+
+        # The newest pack is still being appended to, and recent ones may have appends the manifest doesn't list yet.
+        cutoff = time.time() - self.REPACK_MIN_AGE
+        sealed = {f"{self.PACK_DIR}/{name}" for name in names[:-1] if os.path.getmtime(os.path.join(self.packDir, name)) < cutoff}
+
+        in_use: dict[str, list[tuple[str, dict]]] = {pack: [] for pack in sealed}
+        for relpath, meta in files:
+            if meta.get("pack") in in_use:
+                in_use[meta["pack"]].append((relpath, meta))
+
+        moved = {}
+        removable = []
+        for pack, entries in in_use.items():
+            used = sum(meta["length"] for relpath, meta in entries)
+            if used >= os.path.getsize(self.packPath(pack)) * self.REPACK_RATIO:
+                continue
+
+            for relpath, meta in entries:
+                data = b"".join(self.__iterRaw(meta))
+                new_pack, offset = self.__append(data)
+                moved[relpath] = {**meta, "pack": new_pack, "offset": offset}
+            removable.append(pack)
+        return moved, removable
+
+    def repackManifest(self, manifest_file: ManifestFile, lock: threading.Lock) -> tuple[list[str], int]:
+        """
+        Repack a user's files and point their manifest (a ManifestFile) at the new copies.
+
+        The files are copied without holding `lock` (the user's lock), so uploads carry on meanwhile. Files replaced in
+        the meantime keep their new entry, and a pack is only removed once no entry in the manifest refers to it.
+
+        Returns the packs removed, and how many bytes were freed.
+        """
+        with lock:
+            try:
+                files = list(manifest_file.load().files())
+            except FileNotFoundError:
+                return [], 0
+
+        moved, packs = self.repack(files)
+        if not packs:
+            return [], 0
+        self.sync()
+
+        before = dict(files)
+        with lock:
+            manifest = manifest_file.load()
+            # Only files still where they were. The manifest may have been read from disk again since, so compare
+            # by place, not by identity.
+            changes = []
+            for relpath, meta in moved.items():
+                current = manifest.get(relpath)
+                if isinstance(current, dict) and (current.get("pack"), current.get("offset")) == \
+                        (before[relpath]["pack"], before[relpath]["offset"]):
+                    changes.append({"op": "add", "path": relpath, "meta": {**current, "pack": meta["pack"], "offset": meta["offset"]}})
+            manifest_file.record(changes)
+
+            in_use = {meta.get("pack") for relpath, meta in manifest_file.load().files()}
+            packs = [pack for pack in packs if pack not in in_use]
+            return packs, self.removePacks(packs)
+
+    def removePacks(self, packs: list[str]) -> int:
+        """
+        Remove packs returned by `repack`. Returns how many bytes were freed.
+        """
+        freed = 0
+        for pack in packs:
+            path = self.packPath(pack)
+            try:
+                freed += os.path.getsize(path)
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        return freed
+
+
+class _Prefixed:
+    """
+    Read-only stream of `prefix`, followed by the rest of `stream`.
+    """
+    def __init__(self, prefix: bytes, stream: BinaryIO) -> None:
+        self.__prefix = prefix
+        self.__stream = stream
+
+    def read(self, size: int = -1) -> bytes:
+        if self.__prefix:
+            if size < 0:
+                data, self.__prefix = self.__prefix + self.__stream.read(), b""
+            else:
+                data, self.__prefix = self.__prefix[:size], self.__prefix[size:]
+            return data
+        return self.__stream.read(size)
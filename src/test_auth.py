@@ -0,0 +1,99 @@
+"""
+Tests for accounts and login tokens. (see auth)
+"""
+import os
+import json
+
+import pytest
+
+import auth
+from auth import Accounts, Tokens, hash_password
+
+
+class Clock:
+    """
+    Stands in for the time module, so tokens can be aged without waiting.
+    """
+    def __init__(self) -> None:
+        self.now = 1_000_000.0
+
+    def time(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(auth, "time", clock)
+    return clock
+
+
+@pytest.fixture
+def accounts(tmp_path):
+    path = tmp_path / "manifest.json"
+    path.write_text(json.dumps({"users": []}))
+    return Accounts(str(path))
+
+
+def test_passwords_are_stored_hashed(accounts):
+    assert accounts.add("alice", "secret1")
+    assert not accounts.add("alice", "other")
+
+    with open(accounts.path) as f:
+        users = json.load(f)["users"]
+    assert users == [{"username": "alice", "password": hash_password("secret1")}]
+    assert hash_password("secret1") != "secret1"
+
+    assert accounts.check("alice", "secret1")
+    assert not accounts.check("alice", "secret2")
+    assert not accounts.check("bob", "secret1")
+
+
+def test_accounts_follow_the_file(accounts):
+    accounts.add("alice", "secret1")
+
+    # Another process (or an older server) rewrites the file.
+    with open(accounts.path, "w") as f:
+        json.dump({"users": [{"username": "bob", "password": hash_password("hunter2")}]}, f)
+    os.utime(accounts.path, ns=(0, 0))
+
+    assert accounts.exists("bob")
+    assert not accounts.exists("alice")
+    assert Accounts(accounts.path).check("bob", "hunter2")
+
+
+def test_token_is_tied_to_its_user(clock):
+    tokens = Tokens(60)
+    token = tokens.issue("alice")
+
+    assert tokens.resolve(token) == "alice"
+    assert tokens.resolve("made-up") is None
+    assert tokens.issue("alice") != token
+
+
+def test_token_expires_when_unused(clock):
+    tokens = Tokens(60)
+    token = tokens.issue("alice")
+
+    # Each use pushes the expiry back.
+    for _ in range(3):
+        clock.now += 50
+        assert tokens.resolve(token) == "alice"
+
+    clock.now += 61
+    assert tokens.resolve(token) is None
+    # Once expired, it's forgotten for good.
+    clock.now -= 61
+    assert tokens.resolve(token) is None
+
+
+def test_expired_tokens_are_dropped(clock):
+    tokens = Tokens(60)
+    old = tokens.issue("alice")
+    clock.now += 61
+
+    # Issuing clears out whatever expired, even if it's never asked about again.
+    new = tokens.issue("bob")
+    clock.now -= 61
+    assert tokens.resolve(old) is None
+    assert tokens.resolve(new) == "bob"
@@ -0,0 +1,96 @@
+"""
+Tests for upload and at-rest compression. (see compression)
+"""
+import io
+import random
+
+import pytest
+
+import compression
+
+DATA = b"".join(f"line {i}: the quick brown fox\n".encode() for i in range(20000))
+
+
+@pytest.fixture(params=compression.CODECS)
+def codec(request):
+    return request.param
+
+
+def test_round_trip(codec):
+    packed = compression.compress(codec, DATA)
+
+    assert len(packed) < len(DATA) // 4
+    assert compression.decompress(codec, packed, len(DATA)) == DATA
+
+
+def test_streamed_round_trip(codec):
+    encoder = compression.Encoder(codec)
+    packed = b"".join(encoder.compress(DATA[i:i + 1000]) for i in range(0, len(DATA), 1000)) + encoder.flush()
+
+    decoder = compression.Decoder(codec)
+    data = b"".join(piece for i in range(0, len(packed), 777) for piece in decoder.decompress(packed[i:i + 777]))
+    assert data + decoder.close() == DATA
+
+
+def test_cut_short_is_refused(codec):
+    packed = compression.compress(codec, DATA)
+
+    with pytest.raises(ValueError):
+        compression.decompress(codec, packed[:len(packed) // 2], len(DATA))
+    decoder = compression.Decoder(codec)
+    for piece in decoder.decompress(packed[:len(packed) // 2]):
+        pass
+    with pytest.raises(ValueError):
+        decoder.close()
+
+
+@pytest.mark.skipif(compression.zstandard is None, reason="zstandard is not installed")
+def test_cut_short_zstd_is_refused():
+    # Only run where the zstandard package is installed.
+    packed = compression.compress("zstd", DATA)
+
+    assert compression.decompress("zstd", packed, len(DATA)) == DATA
+    with pytest.raises(ValueError):
+        compression.decompress("zstd", packed[:-10], len(DATA))
+
+
+def test_decompress_limit(codec):
+    # A small body that would expand to far more than a piece can hold.
+    bomb = compression.compress(codec, bytes(10 * 1024 * 1024))
+
+    with pytest.raises(ValueError):
+        compression.decompress(codec, bomb, 1024 * 1024)
+
+
+def test_streamed_pieces_are_bounded(codec):
+    # 10 MB of zeros, which compresses to a few KB.
+    bomb = compression.compress(codec, bytes(10 * 1024 * 1024))
+    decoder = compression.Decoder(codec)
+
+    sizes = [len(piece) for piece in decoder.decompress(bomb, 64 * 1024)]
+    assert max(sizes) <= 64 * 1024
+    assert sum(sizes) + len(decoder.close()) == 10 * 1024 * 1024
+
+
+def test_invalid_data_and_codecs():
+    with pytest.raises(ValueError):
+        compression.decompress("zlib", b"not zlib", 100)
+    with pytest.raises(ValueError):
+        compression.Decoder("brotli")
+    assert compression.decompress(None, b"as is", 100) == b"as is"
+
+
+def test_reader_and_ranges(codec, tmp_path):
+    path = tmp_path / "a.txt"
+    path.write_bytes(compression.compress(codec, DATA))
+
+    with compression.Reader(open(path, "rb"), codec) as f:
+        assert f.read(10) == DATA[:10]
+        assert f.read() == DATA[10:]
+    assert b"".join(compression.iter_decompressed(str(path), codec, 1234, 567890)) == DATA[1234:567890]
+
+
+def test_worth_compressing():
+    assert compression.worth_compressing("notes.txt", DATA)
+    assert not compression.worth_compressing("photo.jpg", DATA)
+    assert not compression.worth_compressing("random.bin", random.Random(0).randbytes(64 * 1024))
@@ -0,0 +1,78 @@
+"""
+Tests for delta encoding and patching. (see delta)
+"""
+import io
+import random
+import hashlib
+
+import pytest
+
+import delta
+
+
+def patch(old: bytes, new: bytes, piece: int = 1000) -> tuple[bytes, delta.Patcher, bytes]:
+    """
+    Send `new` as a delta against `old`, fed to the patcher `piece` bytes at a time.
+
+    Returns the rebuilt file, the patcher and the delta.
+    """
+    encoded = b"".join(delta.encode(io.BytesIO(new), delta.signature(io.BytesIO(old))))
+    out = io.BytesIO()
+    patcher = delta.Patcher(io.BytesIO(old), out)
+    for offset in range(0, len(encoded), piece):
+        patcher.feed(encoded[offset:offset + piece])
+    assert patcher.close() == hashlib.sha256(new).hexdigest()
+    return out.getvalue(), patcher, encoded
+
+
+@pytest.fixture
+def old():
+    return random.Random(0).randbytes(2 * 1024 * 1024)
+
+
+def test_unchanged_file_is_all_copies(old):
+    new, patcher, encoded = patch(old, old)
+
+    assert new == old
+    assert patcher.literal == 0
+    assert len(encoded) < 100
+
+
+def test_insert_only_sends_what_changed(old):
+    changed = old[:1000000] + b"inserted" + old[1000000:]
+    new, patcher, encoded = patch(old, changed)
+
+    assert new == changed
+    # Only the chunks around the insert are sent.
+    assert patcher.literal < len(old) // 4
+    assert patcher.copied + patcher.literal == len(changed)
+
+
+def test_unrelated_file_is_all_literal(old):
+    other = random.Random(1).randbytes(100000)
+    new, patcher, encoded = patch(old, other, piece=7)
+
+    assert new == other
+    assert patcher.copied == 0
+
+
+def test_empty_files():
+    assert patch(b"", b"")[0] == b""
+    assert patch(b"old", b"")[0] == b""
+    assert patch(b"", b"new")[0] == b"new"
+
+
+def test_cut_short_delta_is_refused(old):
+    encoded = b"".join(delta.encode(io.BytesIO(b"new" + old), delta.signature(io.BytesIO(old))))
+    patcher = delta.Patcher(io.BytesIO(old), io.BytesIO())
+    patcher.feed(encoded[:-1])
+    with pytest.raises(ValueError):
+        patcher.close()
+
+
+def test_invalid_deltas_are_refused(old):
+    with pytest.raises(ValueError):
+        delta.Patcher(io.BytesIO(old), io.BytesIO()).feed(b"X")
+    # A copy from past the end of the old file.
+    with pytest.raises(ValueError):
+        delta.Patcher(io.BytesIO(old), io.BytesIO()).feed(delta._COPY.pack(delta.COPY, len(old) - 10, 20))
@@ -0,0 +1,39 @@
+"""
+Tests for the client's file index. (see fileindex)
+"""
+import os
+
+from fileindex import FileIndex, hash_file
+
+
+def test_unchanged_files_are_skipped(tmp_path):
+    path = tmp_path / "a.txt"
+    path.write_bytes(b"hello")
+    index = FileIndex(str(tmp_path / "index.json"), "http://server/api/", "alice")
+
+    assert not index.isUnchanged("a.txt", os.stat(path))
+    index.update("a.txt", os.stat(path), hash_file(str(path)))
+    assert index.isUnchanged("a.txt", os.stat(path))
+
+    # A new mtime, or a new size, means it has to be looked at again.
+    os.utime(path, (1, 1))
+    assert not index.isUnchanged("a.txt", os.stat(path))
+    path.write_bytes(b"hello world")
+    assert not index.isUnchanged("a.txt", os.stat(path))
+
+
+def test_index_belongs_to_one_server_and_user(tmp_path):
+    path = tmp_path / "a.txt"
+    path.write_bytes(b"hello")
+    index = FileIndex(str(tmp_path / "index.json"), "http://server/api/", "alice")
+    index.update("a.txt", os.stat(path), hash_file(str(path)))
+    index.save()
+
+    assert FileIndex(index.path, "http://server/api/", "alice").isUnchanged("a.txt", os.stat(path))
+    assert len(FileIndex(index.path, "http://server/api/", "bob")) == 0
+    assert len(FileIndex(index.path, "http://other/api/", "alice")) == 0
+
+    # A broken index is as good as none.
+    (tmp_path / "index.json").write_text('{"server": ')
+    assert len(FileIndex(index.path, "http://server/api/", "alice")) == 0
+
@@ -0,0 +1,77 @@
+"""
+Tests for hashing files and the hash cache. (see hasher)
+"""
+import os
+import hashlib
+from types import SimpleNamespace
+
+import fileindex
+from fileindex import hash_file
+from hasher import HashCache, Hasher
+
+
+def stat(dev: int = 1, ino: int = 2, size: int = 3, mtime_ns: int = 4) -> SimpleNamespace:
+    return SimpleNamespace(st_dev=dev, st_ino=ino, st_size=size, st_mtime_ns=mtime_ns)
+
+
+def test_cache_forgets_changed_files(tmp_path):
+    cache = HashCache(str(tmp_path / "hashes.json"))
+    cache.put(stat(), "hash")
+
+    assert cache.get(stat()) == "hash"
+    # Another file, or the same one changed.
+    for changed in [stat(dev=9), stat(ino=9), stat(size=9), stat(mtime_ns=9)]:
+        assert cache.get(changed) is None
+    # No inode to go by.
+    cache.put(stat(ino=0), "other")
+    assert cache.get(stat(ino=0)) is None
+
+
+def test_cache_is_saved_and_pruned(tmp_path):
+    cache = HashCache(str(tmp_path / "hashes.json"))
+    cache.put(stat(ino=1), "one")
+    cache.put(stat(ino=2), "two")
+    cache.save()
+
+    reloaded = HashCache(cache.path)
+    assert reloaded.get(stat(ino=1)) == "one"
+    # Only what was looked at since loading survives a prune.
+    reloaded.save(prune=True)
+    assert len(HashCache(cache.path)) == 1
+
+    (tmp_path / "hashes.json").write_text("[]")
+    assert len(HashCache(cache.path)) == 0
+
+
+def test_hasher_keeps_order_and_skips_known_files(tmp_path):
+    paths = []
+    for i in range(20):
+        path = tmp_path / f"{i}.txt"
+        path.write_bytes(str(i).encode() * (i + 1))
+        paths.append(str(path))
+
+    hashed = []
+    hasher = Hasher(4, HashCache(str(tmp_path / "hashes.json")), timer=lambda seconds, size: hashed.append(size))
+    items = [(i, path, os.stat(path)) for i, path in enumerate(paths)] + [(99, str(tmp_path / "gone.txt"), os.stat(tmp_path))]
+
+    results = list(hasher.imap(items))
+    assert [item for item, digest in results] == list(range(20)) + [99]
+    assert [digest for item, digest in results[:20]] == [hash_file(path) for path in paths]
+    assert isinstance(results[-1][1], OSError)
+    assert len(hashed) == 20
+
+    # The second time round, everything is already known.
+    assert list(hasher.imap(items[:20])) == results[:20]
+    assert len(hashed) == 20
+
+
+def test_hash_file_with_and_without_mmap(tmp_path, monkeypatch):
+    monkeypatch.setattr(fileindex, "MMAP_THRESHOLD", 1024)
+    monkeypatch.setattr(fileindex, "MMAP_MIN_AGE", 0)
+    data = os.urandom(100_000)
+    path = tmp_path / "big.bin"
+    path.write_bytes(data)
+
+    digest = hashlib.sha256(data).hexdigest()
+    assert hash_file(str(path)) == digest
+    assert hash_file(str(path), block_size=4096, use_mmap=False) == digest
@@ -0,0 +1,62 @@
+"""
+Tests for the client's upload journal. (see journal)
+"""
+import os
+
+from journal import Journal
+
+HEADER = {"server": "http://server/api/", "username": "alice", "folder": "/home/alice/docs"}
+
+
+def test_resume_replays_finished_files(tmp_path):
+    path = str(tmp_path / "journal.jsonl")
+    journal = Journal(path)
+    journal.open(HEADER)
+    journal.record("docs/a.txt", "done", os.stat(path), "hash-a")
+    journal.record("docs/b.txt", "failed", error="503")
+    # Killed here, without closing.
+
+    files = Journal(path).open(HEADER, resume=True)
+    assert files["docs/a.txt"]["hash"] == "hash-a"
+    assert files["docs/b.txt"]["status"] == "failed"
+
+
+def test_resume_needs_the_same_upload(tmp_path):
+    path = str(tmp_path / "journal.jsonl")
+    journal = Journal(path)
+    journal.open(HEADER)
+    journal.record("docs/a.txt", "done", digest="hash-a")
+
+    assert Journal(path).open({**HEADER, "folder": "/home/alice/photos"}, resume=True) == {}
+    assert Journal.read(path)[1] == {}
+
+
+def test_cut_short_line_is_ignored(tmp_path):
+    path = str(tmp_path / "journal.jsonl")
+    journal = Journal(path)
+    journal.open(HEADER)
+    journal.record("docs/a.txt", "done", digest="hash-a")
+    journal.sync()
+    with open(path, "a") as f:
+        f.write('{"remote": "docs/b.t')
+
+    header, files = Journal.read(path)
+    assert header["upload"] == HEADER
+    assert list(files) == ["docs/a.txt"]
+
+
+def test_checkpoint_and_close(tmp_path):
+    path = str(tmp_path / "journal.jsonl")
+    journal = Journal(path)
+    journal.open(HEADER)
+    journal.record("docs/a.txt", "done", digest="hash-a")
+    journal.record("docs/b.txt", "failed", error="503")
+
+    # Once the FileIndex has them, finished files are forgotten. Failures stay.
+    journal.checkpoint()
+    assert list(Journal.read(path)[1]) == ["docs/b.txt"]
+
+    # A later success replaces the failure, and then there is nothing left to resume.
+    journal.record("docs/b.txt", "done", digest="hash-b")
+    journal.close()
+    assert not os.path.exists(path)
@@ -0,0 +1,163 @@
+"""
+Tests for the manifest and its journal. (see manifest)
+"""
+import os
+import json
+
+import pytest
+
+import manifest
+from manifest import Manifest, ManifestFile
+
+
+@pytest.fixture
+def manifest_file(tmp_path):
+    with open(tmp_path / "manifest.json", "w") as f:
+        json.dump(Manifest().toDict(), f)
+    return ManifestFile(str(tmp_path / "manifest.json"), str(tmp_path / ".ybt"))
+
+
+def reopen(manifest_file: ManifestFile) -> ManifestFile:
+    """
+    A fresh ManifestFile for the same files, as after a restart.
+    """
+    return ManifestFile(manifest_file.path, manifest_file.dataPath)
+
+
+def paths(manifest_file: ManifestFile) -> list[str]:
+    return sorted(relpath for relpath, meta in manifest_file.load().files())
+
+
+def test_journal_is_replayed(manifest_file):
+    manifest_file.record([{"op": "add", "path": "a.txt", "meta": {"size": 1}},
+                          {"op": "add", "path": "docs/b.txt", "meta": {"size": 2}}])
+    manifest_file.record([{"op": "remove", "path": "a.txt"}])
+
+    assert paths(reopen(manifest_file)) == ["docs/b.txt"]
+
+
+def test_journal_is_kept_out_of_the_users_files(manifest_file, tmp_path):
+    manifest_file.record([{"op": "add", "path": "a.txt", "meta": {"size": 1}}])
+    manifest_file.compact()
+
+    assert sorted(os.listdir(tmp_path)) == [".ybt", "manifest.json"]
+    assert os.listdir(tmp_path / ".ybt") == ["manifest.journal"]
+
+
+def test_partial_line_is_truncated(manifest_file):
+    manifest_file.record([{"op": "add", "path": "a.txt", "meta": {"size": 1}}])
+    size = os.path.getsize(manifest_file.journalPath)
+    # A crash in the middle of an append.
+    with open(manifest_file.journalPath, "ab") as f:
+        f.write(b'{"op":"add","path":"b.t')
+
+    reopened = reopen(manifest_file)
+    assert paths(reopened) == ["a.txt"]
+    assert os.path.getsize(manifest_file.journalPath) == size
+
+    # New changes go after the last whole line.
+    reopened.record([{"op": "add", "path": "c.txt", "meta": {"size": 3}}])
+    assert paths(reopen(manifest_file)) == ["a.txt", "c.txt"]
+
+
+def test_failed_changes_are_left_out(manifest_file):
+    failed = manifest_file.record([{"op": "add", "path": "docs", "meta": {"size": 1}},
+                                   {"op": "add", "path": "docs/b.txt", "meta": {"size": 2}}])
+
+    assert failed == ["docs/b.txt"]
+    assert paths(reopen(manifest_file)) == ["docs"]
+
+
+def test_failed_write_is_not_kept(manifest_file, monkeypatch):
+    manifest_file.record([{"op": "add", "path": "a.txt", "meta": {"size": 1}}])
+    size = os.path.getsize(manifest_file.journalPath)
+
+    def fsync(fd):
+        raise OSError(28, "No space left on device")
+    monkeypatch.setattr(manifest.os, "fsync", fsync)
+    with pytest.raises(OSError):
+        manifest_file.record([{"op": "add", "path": "b.txt", "meta": {"size": 2}}])
+    monkeypatch.undo()
+
+    assert os.path.getsize(manifest_file.journalPath) == size
+    assert paths(manifest_file) == ["a.txt"]
+
+
+def test_compact_empties_journal(manifest_file):
+    manifest_file.record([{"op": "add", "path": "a.txt", "meta": {"size": 1}}])
+    manifest_file.compact()
+
+    assert os.path.getsize(manifest_file.journalPath) == 0
+    assert paths(reopen(manifest_file)) == ["a.txt"]
+
+
+def test_compacts_when_journal_grows(manifest_file, monkeypatch):
+    monkeypatch.setattr(ManifestFile, "COMPACT_SIZE", 100)
+    for i in range(10):
+        manifest_file.record([{"op": "add", "path": f"{i}.txt", "meta": {"size": i}}])
+
+    assert os.path.getsize(manifest_file.journalPath) <= 100
+    assert len(paths(reopen(manifest_file))) == 10
+
+
+def test_idle_journal_compacts(manifest_file, monkeypatch):
+    manifest_file.record([{"op": "add", "path": "a.txt", "meta": {"size": 1}}])
+    assert not manifest_file.compactIfDue()
+
+    # Nothing else is recorded, but the journal gets old.
+    monkeypatch.setattr(ManifestFile, "COMPACT_AGE", -1)
+    assert manifest_file.compactIfDue()
+    assert os.path.getsize(manifest_file.journalPath) == 0
+
+
+def test_legacy_layout_is_converted():
+    legacy = {"root": ["a.txt", {"docs": ["b.txt", {"empty": []}]}], "files": {"docs/b.txt": {"size": 2}}}
+
+    manifest = Manifest.fromDict(legacy)
+    assert len(manifest) == 2
+    assert manifest.get("docs/b.txt") == {"size": 2}
+    # Files saved before metadata was kept have none.
+    assert manifest.get("a.txt") == {}
+    assert manifest.toDict() == {"version": Manifest.VERSION, "folders": ["docs/empty"],
+                                 "files": {"a.txt": {}, "docs/b.txt": {"size": 2}}}
+    assert Manifest.fromDict(manifest.toDict()).toLegacy() == legacy["root"]
+
+
+def test_legacy_listing_is_paged():
+    manifest = Manifest()
+    for relpath in ["a.txt", "b.txt", "docs/c.txt", "docs/sub/d.txt", "e.txt"]:
+        manifest.add(relpath, {"size": len(relpath)})
+
+    assert manifest.toLegacy() == ["a.txt", "b.txt", {"docs": ["c.txt", {"sub": ["d.txt"]}]}, "e.txt"]
+    assert manifest.toLegacy(depth=1) == ["a.txt", "b.txt", {"docs": None}, "e.txt"]
+    assert manifest.toLegacy(depth=2) == ["a.txt", "b.txt", {"docs": ["c.txt", {"sub": None}]}, "e.txt"]
+    assert manifest.toLegacy(depth=1, offset=1, limit=2) == ["b.txt", {"docs": None}]
+    assert manifest.toLegacy(offset=4, limit=2) == []
+
+    # Metadata comes back for the included files only, by full path.
+    files = {}
+    docs = manifest.get("docs")
+    assert manifest.toLegacy(docs, depth=1, prefix="docs/", files=files) == ["c.txt", {"sub": None}]
+    assert files == {"docs/c.txt": {"size": 10}}
+
+
+def test_journal_is_cut_at_a_bad_line(manifest_file):
+    manifest_file.record([{"op": "add", "path": "a.txt", "meta": {"size": 1}}])
+    size = os.path.getsize(manifest_file.journalPath)
+    with open(manifest_file.journalPath, "ab") as f:
+        f.write(b'garbage\n{"op":"add","path":"b.txt","meta":{"size":2}}\n')
+
+    # Nothing after a damaged line can be trusted to follow on from it.
+    assert paths(reopen(manifest_file)) == ["a.txt"]
+    assert os.path.getsize(manifest_file.journalPath) == size
+
+
+def test_cut_short_snapshot_is_an_error(manifest_file):
+    manifest_file.record([{"op": "add", "path": "a.txt", "meta": {"size": 1}}])
+    manifest_file.compact()
+    with open(manifest_file.path, "r+b") as f:
+        f.truncate(os.path.getsize(manifest_file.path) // 2)
+
+    # Never silently treated as an empty manifest.
+    with pytest.raises(ValueError):
+        reopen(manifest_file).load()
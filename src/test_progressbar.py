@@ -0,0 +1,86 @@
+"""
+Tests for the progress bar's output capture. (see progressbar)
+"""
+import io
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+from progressbar import ProgressBar, _Capture
+
+
+class Bar:
+    """
+    Stands in for a ProgressBar, printing whatever its _Capture hands over.
+    """
+    def __init__(self) -> None:
+        self.capture = _Capture(self)  # type: ignore
+        self.renders = 0
+        self.out = io.StringIO()
+
+    def _render(self, final: bool = False) -> None:
+        self.renders += 1
+        self.out.write(self.capture.take(final))
+
+
+def test_only_finished_lines_are_taken():
+    bar = Bar()
+    bar.capture.write("one\ntw")
+    bar.capture.write("o\nthr")
+
+    assert bar.capture.take() == "one\ntwo\n"
+    assert bar.capture.take() == ""
+    assert bar.capture.take(everything=True) == "thr\n"
+    assert bar.renders == 0
+
+
+def test_long_line_is_broken_off_not_rerendered():
+    bar = Bar()
+    text = "x" * (5 * _Capture.LIMIT)
+    for char in text:
+        bar.capture.write(char)
+
+    # Every render prints what's waiting, so they're rare and nothing piles up.
+    assert bar.renders <= 5
+    bar._render(final=True)
+    assert bar.out.getvalue().replace("\n", "") == text
+
+
+def test_bar_prints_lines_above_itself(monkeypatch):
+    out = io.StringIO()
+    monkeypatch.setattr(sys, "stdout", out)
+    with ProgressBar(2, "Files ") as bar:
+        print("first")
+        bar.bar()
+        print("second", end="")
+        bar.bar()
+
+    assert sys.stdout is out
+    text = out.getvalue()
+    assert text.index("first\n") < text.index("second\n") < text.rindex("2/2")
+
+
+def test_bar_counts_from_many_threads(monkeypatch):
+    out = io.StringIO()
+    monkeypatch.setattr(sys, "stdout", out)
+    with ProgressBar(0) as bar:
+        bar.add(4000)
+        with ThreadPoolExecutor(8) as pool:
+            for _ in pool.map(lambda i: bar.bar(), range(4000)):
+                pass
+
+    assert "4000/4000" in out.getvalue()
+
+
+def test_bar_grows_and_counts_bytes(monkeypatch):
+    out = io.StringIO()
+    monkeypatch.setattr(sys, "stdout", out)
+    # Started before the folder scan has found anything.
+    with ProgressBar(0) as bar:
+        bar.add(1, size=1024 * 1024)
+        bar.add(1, size=3 * 1024 * 1024)
+        bar.bar(size=1024 * 1024)
+        bar._render()
+        assert "1/2 1.0 MB/4.0 MB" in out.getvalue()
+        bar.bar(size=3 * 1024 * 1024)
+
+    assert "2/2 4.0 MB/4.0 MB" in out.getvalue()
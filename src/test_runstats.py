@@ -0,0 +1,94 @@
+"""
+Tests for the client's run stats. (see runstats)
+"""
+import datetime
+
+import requests
+
+import compression
+from runstats import RunStats, CountedBody, parse_server_timing, percentile
+
+
+def respond(request: requests.PreparedRequest, headers: dict | None = None) -> requests.Response:
+    """
+    A response to `request`, as the response hook would get it once the request was sent.
+    """
+    if isinstance(request.body, CountedBody):
+        # Sending a streamed body is what counts it.
+        for _ in request.body:
+            pass
+    r = requests.Response()
+    r.request = request
+    r.status_code = 200
+    r.headers.update(headers or {})
+    r.elapsed = datetime.timedelta(milliseconds=5)
+    return r
+
+
+def test_sent_bytes_of_compressed_upload():
+    data = b"the quick brown fox\n" * 10000
+    encoder = compression.Encoder("zlib")
+    body = CountedBody(piece for piece in [encoder.compress(data[:100000]), encoder.compress(data[100000:]), encoder.flush()])
+    request = requests.Request("PUT", "http://server/api/fs/file", data=body, headers={"Content-Encoding": "zlib"}).prepare()
+
+    # Streamed, so there is no Content-Length to go by.
+    assert "Content-Length" not in request.headers
+    stats = RunStats()
+    stats.response(respond(request))
+
+    sent = stats.report()["requests"]["endpoints"]["PUT /api/fs/file"]["bytes_sent"]
+    assert sent == len(compression.compress("zlib", data))
+    assert 0 < sent < len(data)
+
+
+def test_sent_bytes_of_plain_upload():
+    request = requests.Request("PUT", "http://server/api/fs/file", data=b"x" * 1234).prepare()
+    stats = RunStats()
+    stats.response(respond(request, {"Content-Length": "10"}))
+
+    endpoint = stats.report()["requests"]["endpoints"]["PUT /api/fs/file"]
+    assert endpoint["bytes_sent"] == 1234
+    assert endpoint["bytes_received"] == 10
+
+
+def test_parse_server_timing():
+    assert parse_server_timing("auth;dur=0.5, total;dur=12, bad;dur=x, other") == {"auth": 0.0005, "total": 0.012}
+
+
+def test_percentile():
+    assert percentile([], 50) is None
+    assert percentile([3, 1, 2], 50) == 2
+    assert percentile(list(range(1, 101)), 99) == 99
+
+
+def test_phases_and_slowest_uploads():
+    stats = RunStats(slowest=2)
+    with stats.phase("hash", size=100):
+        pass
+    assert list(stats.timeIter("scan", ["a", "b"])) == ["a", "b"]
+    for i, seconds in enumerate([0.5, 3.0, 1.0]):
+        stats.upload([(f"file{i}", 10)], seconds)
+    stats.retry("503", 2)
+
+    report = stats.report(mode="upload")
+    assert report["mode"] == "upload"
+    assert report["phases"]["hash"]["bytes"] == 100
+    # One wait per item, and one more to find out there are none left.
+    assert report["phases"]["scan"]["count"] == 3
+    assert report["phases"]["upload"] == {"seconds": 4.5, "count": 3, "bytes": 30}
+    assert [entry["path"] for entry in report["slowest"]] == ["file1", "file2"]
+    assert report["retries"] == {"503": 2}
+    assert "Run took" in stats.summary()
+
+
+def test_server_time_is_split_from_the_network():
+    stats = RunStats()
+    request = requests.Request("GET", "http://server/api/fs/file").prepare()
+    stats.response(respond(request, {"Server-Timing": "auth;dur=1, total;dur=2"}))
+    stats.response(respond(request))
+
+    report = stats.report()["requests"]
+    endpoint = report["endpoints"]["GET /api/fs/file"]
+    assert endpoint["count"] == 2
+    assert endpoint["server_seconds"] == 0.002
+    assert report["network_seconds"] == round(0.010 - 0.002, 3)
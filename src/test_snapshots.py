@@ -0,0 +1,60 @@
+"""
+Tests for the snapshot retention policy. (see snapshots.retained)
+"""
+import calendar
+
+from snapshots import retained
+
+DAY = 24 * 60 * 60
+
+
+def at(date: str, hour: int = 12) -> float:
+    """
+    Timestamp (UTC) of `hour` o'clock on `date`. (ex. 2026-03-14)
+    """
+    year, month, day = map(int, date.split("-"))
+    return calendar.timegm((year, month, day, hour, 0, 0))
+
+
+def snapshots(*times: float) -> list[dict]:
+    return [{"id": str(i), "created": created} for i, created in enumerate(times)]
+
+
+def test_no_rules_keeps_everything():
+    infos = snapshots(at("2026-03-01"), at("2026-03-02"), at("2026-03-03"))
+    assert retained(infos) == {"0", "1", "2"}
+
+
+def test_keep_last():
+    # Out of order, to check they are sorted by age.
+    infos = snapshots(at("2026-03-03"), at("2026-03-01"), at("2026-03-04"), at("2026-03-02"))
+    assert retained(infos, last=2) == {"0", "2"}
+    assert retained(infos, last=0) == set()
+    assert retained(infos, last=10) == {"0", "1", "2", "3"}
+
+
+def test_keep_daily_keeps_newest_of_each_day():
+    infos = snapshots(at("2026-03-01", 9), at("2026-03-01", 18), at("2026-03-02", 9), at("2026-03-02", 18), at("2026-03-03", 9))
+    assert retained(infos, daily=2) == {"4", "3"}
+    assert retained(infos, daily=5) == {"4", "3", "1"}
+
+
+def test_days_without_snapshots_are_skipped():
+    infos = snapshots(at("2026-01-01"), at("2026-02-01"), at("2026-03-01"))
+    # The last 2 days that have one, not the last 2 calendar days.
+    assert retained(infos, daily=2) == {"1", "2"}
+
+
+def test_keep_weekly_and_monthly():
+    # Every day from Monday 2 March to Sunday 5 April 2026.
+    infos = snapshots(*(at("2026-03-02") + day * DAY for day in range(35)))
+
+    # Sundays 5 April, 29 March and 22 March.
+    assert retained(infos, weekly=3) == {"34", "27", "20"}
+    # 5 April and 31 March.
+    assert retained(infos, monthly=2) == {"34", "29"}
+
+
+def test_rules_add_up():
+    infos = snapshots(*(at("2026-03-02") + day * DAY for day in range(35)))
+    assert retained(infos, last=2, monthly=2) == {"34", "33", "29"}
@@ -0,0 +1,121 @@
+"""
+Tests for the storage backends. (see storage)
+"""
+import io
+import json
+import hashlib
+import threading
+
+import pytest
+
+import chunker
+from manifest import Manifest, ManifestFile
+from storage import ChunkStore, PackStore
+
+
+def test_pack_paths_stay_in_the_users_data(tmp_path):
+    store = PackStore(str(tmp_path / "alice"))
+
+    assert store.packPath(".ybt/packs/pack-000001.pack") == str(tmp_path / "alice" / ".ybt" / "packs" / "pack-000001.pack")
+    # Snapshots keep their own copies of packs.
+    assert store.packPath(".ybt/snapshots/1/packs/pack-000001.pack").startswith(str(tmp_path / "alice" / ".ybt"))
+
+    for pack in ["../bob/.ybt/packs/pack-000001.pack", ".ybt/../../bob/notes.txt", "notes.txt", ".ybt", "/etc/passwd"]:
+        with pytest.raises(FileNotFoundError):
+            store.packPath(pack)
+
+
+def test_packed_file_round_trip(tmp_path):
+    store = PackStore(str(tmp_path))
+    meta = store.write("a.txt", io.BytesIO(b"hello"))
+    store.sync()
+
+    assert "pack" in meta
+    assert b"".join(store.iterFile(meta)) == b"hello"
+    assert b"".join(store.iterFile(meta, 1, 3)) == b"el"
+
+
+def test_forged_pack_entry_is_refused(tmp_path):
+    store = PackStore(str(tmp_path / "alice"))
+    (tmp_path / "bob").mkdir()
+    (tmp_path / "bob" / "secret.txt").write_bytes(b"secret")
+
+    meta = {"pack": "../bob/secret.txt", "offset": 0, "length": 6, "size": 6}
+    with pytest.raises(FileNotFoundError):
+        b"".join(store.iterFile(meta))
+
+
+def test_commit_checks_the_file_hash(tmp_path):
+    store = ChunkStore(str(tmp_path / "alice"), str(tmp_path / "chunks"))
+    for data in [b"hello ", b"world"]:
+        store.putChunk(chunker.hash_chunk(data), data)
+    chunks = [chunker.hash_chunk(b"hello "), chunker.hash_chunk(b"world")]
+
+    meta = store.commit(chunks, 11, hashlib.sha256(b"hello world").hexdigest())
+    assert b"".join(store.iterFile(meta)) == b"hello world"
+
+    # The right chunks under someone else's hash, or in the wrong order.
+    with pytest.raises(ValueError):
+        store.commit(chunks, 11, hashlib.sha256(b"something else").hexdigest())
+    with pytest.raises(ValueError):
+        store.commit(chunks[::-1], 11, hashlib.sha256(b"hello world").hexdigest())
+
+
+@pytest.fixture
+def repackable(tmp_path, monkeypatch):
+    """
+    A pack store and manifest where the first pack is mostly unused, holding only a.txt.
+    """
+    monkeypatch.setattr(PackStore, "PACK_SIZE", 100)
+    monkeypatch.setattr(PackStore, "REPACK_MIN_AGE", 0)
+    store = PackStore(str(tmp_path))
+    with open(tmp_path / "manifest.json", "w") as f:
+        json.dump(Manifest().toDict(), f)
+    manifest_file = ManifestFile(str(tmp_path / "manifest.json"), str(tmp_path / ".ybt"))
+
+    files = {name: store.write(name, io.BytesIO(data)) for name, data in
+             [("a.txt", b"a" * 10), ("junk.txt", b"j" * 40), ("c.txt", b"c" * 60)]}
+    store.sync()
+    manifest_file.record([{"op": "add", "path": name, "meta": meta} for name, meta in files.items() if name != "junk.txt"])
+    assert files["a.txt"]["pack"] != files["c.txt"]["pack"]
+    return store, manifest_file
+
+
+def during_repack(store: PackStore, action) -> None:
+    """
+    Run `action` while the store is copying files, when the user's lock isn't held.
+    """
+    repack = store.repack
+    store.repack = lambda files: (repack(files), action())[0]
+
+
+def test_repack_after_the_manifest_was_reloaded(repackable):
+    store, manifest_file = repackable
+    old = manifest_file.load().get("a.txt")
+
+    # As after a failed journal write: same entries, but new objects.
+    during_repack(store, lambda: setattr(manifest_file, "manifest", None))
+    packs, freed = store.repackManifest(manifest_file, threading.Lock())
+
+    assert packs == [old["pack"]]
+    meta = manifest_file.load().get("a.txt")
+    assert meta["pack"] != old["pack"]
+    assert b"".join(store.iterFile(meta)) == b"a" * 10
+
+
+def test_repack_keeps_packs_still_in_use(repackable):
+    store, manifest_file = repackable
+    old = manifest_file.load().get("a.txt")
+
+    # a.txt is replaced while it's being copied, and another entry still points into its old pack.
+    def replace():
+        meta = store.write("a.txt", io.BytesIO(b"new"))
+        store.sync()
+        manifest_file.record([{"op": "add", "path": "a.txt", "meta": meta}, {"op": "add", "path": "copy.txt", "meta": old}])
+    during_repack(store, replace)
+    packs, freed = store.repackManifest(manifest_file, threading.Lock())
+
+    assert packs == []
+    manifest = manifest_file.load()
+    assert b"".join(store.iterFile(manifest.get("a.txt"))) == b"new"
+    assert b"".join(store.iterFile(manifest.get("copy.txt"))) == b"a" * 10
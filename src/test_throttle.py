@@ -0,0 +1,60 @@
+"""
+Tests for upload throttling. (see throttle)
+"""
+import time
+
+import pytest
+
+import throttle
+from throttle import AdaptiveLimit, TokenBucket, backoff, parse_rate
+
+
+def test_parse_rate():
+    assert parse_rate("500") == 500
+    assert parse_rate("500K") == 500 * 1024
+    assert parse_rate("1.5mb/s") == int(1.5 * 1024 ** 2)
+    assert parse_rate(" 2G ") == 2 * 1024 ** 3
+    for text in ["", "fast", "0", "-1M"]:
+        with pytest.raises(ValueError):
+            parse_rate(text)
+
+
+def test_backoff():
+    for attempt in range(10):
+        assert 0 <= backoff(attempt, 1.0, 60.0) <= min(60.0, 2 ** attempt)
+    assert backoff(0, 1.0, 60.0, "5") == 5.0
+    assert backoff(0, 1.0, 60.0, "600") == 60.0
+    assert 0 <= backoff(0, 1.0, 60.0, "Wed, 21 Oct 2015 07:28:00 GMT") <= 1.0
+
+
+def test_token_bucket_holds_the_rate():
+    waits = []
+    bucket = TokenBucket(1_000_000, burst=100_000, timer=lambda seconds, size: waits.append(seconds))
+    start = time.monotonic()
+    for _ in range(5):
+        bucket.take(100_000)
+
+    # The burst goes straight through, the rest at 1 MB/s.
+    assert 0.35 <= time.monotonic() - start < 1.0
+    assert waits
+
+
+def test_adaptive_limit(monkeypatch):
+    monkeypatch.setattr(throttle, "DECREASE_INTERVAL", 0)
+    limit = AdaptiveLimit(8)
+
+    # Only grows while every slot is in use, doubling at first.
+    limit.delay(0.01)
+    assert int(limit.limit) == 1
+    with limit:
+        limit.delay(0.01)
+    assert int(limit.limit) == 2
+
+    # A climbing round trip means the uplink is queueing.
+    limit.delay(0.5)
+    assert int(limit.limit) == 1
+    assert limit.decreases == {"latency": 1}
+
+    limit.congested("503")
+    assert limit.limit == 1.0
+    assert limit.report()["peak"] == 2
@@ -0,0 +1,56 @@
+"""
+Tests for resumable upload sessions. (see uploads)
+"""
+import os
+import time
+import threading
+
+import pytest
+
+from uploads import UploadSession
+
+
+def test_pieces_in_any_order(tmp_path):
+    session = UploadSession.create(str(tmp_path), "a.txt", 10, "hash")
+    session.write(5, b"56789")
+    assert session.offset() == 0
+    session.write(0, b"01234")
+
+    session = UploadSession(str(tmp_path), session.id)
+    assert session.offset() == 10
+    assert session.ranges == [[0, 10]]
+    with open(session.dataPath, "rb") as f:
+        assert f.read() == b"0123456789"
+
+
+def test_piece_must_fit(tmp_path):
+    session = UploadSession.create(str(tmp_path), "a.txt", 10, "hash")
+    with pytest.raises(ValueError):
+        session.write(8, b"too long")
+
+
+def test_piece_during_commit_finds_session_gone(tmp_path):
+    session = UploadSession.create(str(tmp_path), "a.txt", 10, "hash")
+    session.write(0, b"0123456789")
+    other = UploadSession(str(tmp_path), session.id)
+
+    errors = []
+    def write():
+        try:
+            other.write(0, b"late")
+        except UploadSession.NoSuchSession as e:
+            errors.append(e)
+
+    # Commit like commitsession does, while a late piece tries to get in.
+    thread = threading.Thread(target=write)
+    with session:
+        thread.start()
+        time.sleep(0.05)
+        os.replace(session.dataPath, tmp_path / "a.txt")
+        session.remove()
+    thread.join()
+
+    assert len(errors) == 1
+    assert (tmp_path / "a.txt").read_bytes() == b"0123456789"
+    with pytest.raises(UploadSession.NoSuchSession):
+        UploadSession(str(tmp_path), session.id)
@@ -0,0 +1,77 @@
+"""
+Tests for watching a folder for changes. (see watcher)
+"""
+import os
+import sys
+import time
+
+import pytest
+
+import watcher
+from watcher import Watcher, open_watcher
+
+
+class Scripted(Watcher):
+    """
+    Watcher that reports a fixed list of polls (or what a function in it returns), then nothing.
+    """
+    def __init__(self, polls: list, debounce: float = 0.05) -> None:
+        super().__init__("/", debounce)
+        self.polls = list(polls)
+
+    def _poll(self, timeout: float | None) -> list[str] | None:
+        if self.polls:
+            poll = self.polls.pop(0)
+            return poll() if callable(poll) else poll
+        time.sleep(timeout if timeout is not None else 0)
+        return []
+
+
+def test_changes_are_debounced():
+    changes = Scripted([["a", "b"], ["a"], ["a", "c"]]).changes()
+
+    start = time.monotonic()
+    assert next(changes) == {"a", "b", "c"}
+    assert time.monotonic() - start >= 0.05
+
+
+def test_changing_again_restarts_the_wait():
+    def keep_changing() -> list[str]:
+        time.sleep(0.05)
+        return ["busy"]
+    scripted = Scripted([["quiet"]] + [keep_changing] * 8, debounce=0.2)
+    changes = scripted.changes()
+
+    # "quiet" is due long before "busy" has been left alone.
+    assert next(changes) == {"quiet"}
+    assert next(changes) == {"busy"}
+    assert not scripted.polls
+
+
+def test_lost_changes_ask_for_a_rescan(monkeypatch):
+    assert next(Scripted([None]).changes()) is None
+
+    # Too much at once.
+    monkeypatch.setattr(watcher, "MAX_PENDING", 3)
+    changes = Scripted([["a", "b"], ["c", "d", "e"], ["f"]]).changes()
+    assert next(changes) is None
+    assert next(changes) == {"f"}
+
+
+@pytest.mark.skipif(not sys.platform.startswith("linux"), reason="inotify is Linux only")
+def test_inotify_sees_new_files_and_folders(tmp_path):
+    with open_watcher(str(tmp_path), debounce=0.05) as w:
+        assert isinstance(w, watcher.InotifyWatcher)
+        changes = w.changes()
+
+        (tmp_path / "a.txt").write_text("a")
+        assert next(changes) == {str(tmp_path / "a.txt")}
+
+        # Anything already in a new folder is reported too, and the folder is watched from then on.
+        os.makedirs(tmp_path / "new" / "sub")
+        (tmp_path / "new" / "sub" / "b.txt").write_text("b")
+        found = next(changes)
+        (tmp_path / "new" / "c.txt").write_text("c")
+        while str(tmp_path / "new" / "c.txt") not in found:
+            found |= next(changes)
+        assert str(tmp_path / "new" / "sub" / "b.txt") in found
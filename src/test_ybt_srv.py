@@ -0,0 +1,293 @@
+"""
+Tests for ybt_srv, run against a real server started in the background.
+"""
+import io
+import os
+import sys
+import json
+import time
+import socket
+import tarfile
+import hashlib
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+import requests
+
+import compression
+
+USER = {"usr": "alice", "psw": "secret1"}
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+@pytest.fixture(scope="module")
+def timing_log(tmp_path_factory):
+    return str(tmp_path_factory.mktemp("logs") / "timing.jsonl")
+
+
+@pytest.fixture(scope="module")
+def server(tmp_path_factory, timing_log):
+    """
+    Base URL of a server (pack store) with the user alice, shared by the tests in this file.
+    """
+    fs = tmp_path_factory.mktemp("fs")
+    port = free_port()
+    process = subprocess.Popen([sys.executable, "ybt_srv.py", "-t", "--fs", str(fs), "--port", str(port), "--store", "pack",
+                                "--timing-log", timing_log],
+                               cwd=os.path.dirname(os.path.abspath(__file__)), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    url = f"http://127.0.0.1:{port}/api/"
+    try:
+        for _ in range(100):
+            try:
+                requests.get(url, timeout=1)
+                break
+            except requests.ConnectionError:
+                time.sleep(0.1)
+        else:
+            pytest.fail("Server did not start.")
+        requests.post(url + "users/create", params=USER).raise_for_status()
+        yield url
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def upload(server: str, path: str, data: bytes) -> None:
+    requests.put(server + "fs/file", params={**USER, "path": path}, data=data).raise_for_status()
+
+
+def test_range(server):
+    upload(server, "range/a.txt", b"0123456789")
+
+    r = requests.get(server + "fs/file", params={**USER, "path": "range/a.txt"}, headers={"Range": "bytes=3-5"})
+    assert r.status_code == 206
+    assert r.content == b"345"
+    assert r.headers["content-range"] == "bytes 3-5/10"
+
+    # The last 4 bytes, and everything from an offset on.
+    r = requests.get(server + "fs/file", params={**USER, "path": "range/a.txt"}, headers={"Range": "bytes=-4"})
+    assert r.content == b"6789"
+    r = requests.get(server + "fs/file", params={**USER, "path": "range/a.txt"}, headers={"Range": "bytes=8-"})
+    assert r.content == b"89"
+
+
+def test_range_past_the_end(server):
+    upload(server, "range/b.txt", b"0123456789")
+
+    # What a restore with a complete part file used to ask for.
+    for header in ["bytes=10-", "bytes=50-60"]:
+        r = requests.get(server + "fs/file", params={**USER, "path": "range/b.txt"}, headers={"Range": header})
+        assert r.status_code == 416
+        assert r.headers["content-range"] == "bytes */10"
+
+
+def test_if_range_mismatch_sends_everything(server):
+    upload(server, "range/c.txt", b"0123456789")
+
+    r = requests.get(server + "fs/file", params={**USER, "path": "range/c.txt"},
+                     headers={"Range": "bytes=5-", "If-Range": '"not-the-hash"'})
+    assert r.status_code == 200
+    assert r.content == b"0123456789"
+
+
+def test_requests_are_timed(server, timing_log):
+    upload(server, "timed/a.txt", b"0123456789")
+
+    r = requests.get(server + "fs/file", params={**USER, "path": "timed/a.txt"})
+    assert r.content == b"0123456789"
+    assert "total;dur=" in r.headers["server-timing"]
+    assert requests.get(server + "metrics").text.count('route="/api/fs/file",status="200"') >= 1
+
+    # Written in the background, so give it a moment.
+    for _ in range(50):
+        with open(timing_log) as f:
+            lines = [json.loads(line) for line in f]
+        if any(line["path"] == "/api/fs/file" and line["method"] == "GET" for line in lines):
+            break
+        time.sleep(0.1)
+    else:
+        pytest.fail("Download is not in the timing log.")
+    line = [line for line in lines if line["path"] == "/api/fs/file"][-1]
+    assert line["status"] == 200
+    assert line["time"] > 0
+
+
+def received_bytes(server: str, route: str) -> float:
+    for line in requests.get(server + "metrics").text.splitlines():
+        if line.startswith(f'ybt_received_bytes_total{{route="{route}"}}'):
+            return float(line.split()[-1])
+    return 0.0
+
+
+def test_compressed_upload_bytes_are_counted(server):
+    data = b"the quick brown fox\n" * 50000
+    packed = compression.compress("zlib", data)
+    before = received_bytes(server, "/api/fs/file")
+
+    # Streamed, so it is sent chunked, without a Content-Length.
+    r = requests.put(server + "fs/file", params={**USER, "path": "counted/a.txt", "size": len(data)}, data=iter([packed[:1000], packed[1000:]]),
+                     headers={"Content-Encoding": "zlib"})
+    assert r.status_code == 200
+    assert "Content-Length" not in r.request.headers
+    assert received_bytes(server, "/api/fs/file") - before == len(packed)
+
+    r = requests.get(server + "fs/file", params={**USER, "path": "counted/a.txt"})
+    assert r.content == data
+
+
+def test_getmanifest_is_paged(server):
+    for i in range(5):
+        upload(server, f"paged/{i}.txt", b"x")
+    upload(server, "paged/sub/deep.txt", b"x")
+
+    # By default: one level, and no metadata.
+    data = requests.get(server + "fs/getmanifest", params={**USER, "path": "paged"}).json()
+    assert data["total"] == 6
+    assert {"sub": None} in data["root"]
+    assert "files" not in data
+
+    listed = []
+    offset = 0
+    while offset is not None:
+        data = requests.get(server + "fs/getmanifest", params={**USER, "path": "paged", "limit": 2, "offset": offset, "files": True}).json()
+        assert len(data["root"]) <= 2
+        listed += data["files"]
+        offset = data["next"]
+    assert sorted(listed) == [f"paged/{i}.txt" for i in range(5)]
+
+
+def test_compressed_upload_stops_past_its_size(server):
+    # A few KB that would expand to 100 MB.
+    bomb = compression.compress("zlib", bytes(100 * 1024 * 1024))
+
+    r = requests.put(server + "fs/file", params={**USER, "path": "bomb.bin", "size": 1024 * 1024}, data=bomb,
+                     headers={"Content-Encoding": "zlib"})
+    assert r.status_code == 422
+    r = requests.put(server + "fs/file", params={**USER, "path": "bomb.bin"}, data=bomb, headers={"Content-Encoding": "zlib"})
+    assert r.status_code == 411
+    assert requests.get(server + "fs/file", params={**USER, "path": "bomb.bin"}).status_code == 404
+
+
+def batch(*members: tuple[tarfile.TarInfo, bytes | None]) -> bytes:
+    """
+    A tar archive of the given members, as putbatch expects.
+    """
+    out = io.BytesIO()
+    with tarfile.open(fileobj=out, mode="w") as tar:
+        for info, data in members:
+            if data is not None:
+                info.size = len(data)
+            tar.addfile(info, io.BytesIO(data) if data is not None else None)
+    return out.getvalue()
+
+
+def member(name: str, type: bytes = tarfile.REGTYPE, linkname: str = "") -> tarfile.TarInfo:
+    info = tarfile.TarInfo(name)
+    info.type = type
+    info.linkname = linkname
+    return info
+
+
+def putbatch(server: str, archive: bytes, dirfr: str = "batch") -> requests.Response:
+    return requests.post(server + "fs/putbatch", params={**USER, "dirfr": dirfr}, files={"file": ("batch.tar", archive)})
+
+
+def test_putbatch_refuses_paths_outside_the_folder(server):
+    r = putbatch(server, batch((member("ok.txt"), b"ok"), (member("../../escaped.txt"), b"x"), (member("../.ybt/x"), b"x"),
+                               (member(".ybt/tokens"), b"x"), (member("manifest.json"), b"x")), dirfr="")
+    r.raise_for_status()
+
+    assert r.json()["stored"] == ["ok.txt"]
+    assert sorted(r.json()["failed"]) == sorted(["../../escaped.txt", "../.ybt/x", ".ybt/tokens", "manifest.json"])
+    for path in ["../escaped.txt", "escaped.txt", ".ybt/tokens", ".ybt/x"]:
+        assert requests.get(server + "fs/file", params={**USER, "path": path}).status_code in (404, 422)
+
+
+def test_putbatch_skips_links_and_devices(server):
+    r = putbatch(server, batch((member("link", tarfile.SYMTYPE, "/etc/passwd"), None),
+                               (member("hard", tarfile.LNKTYPE, "../../../etc/passwd"), None),
+                               (member("dev", tarfile.CHRTYPE), None),
+                               (member("fifo", tarfile.FIFOTYPE), None),
+                               (member("real.txt"), b"real")))
+    r.raise_for_status()
+
+    assert r.json()["stored"] == ["batch/real.txt"]
+    for name in ["link", "hard", "dev", "fifo"]:
+        assert requests.get(server + "fs/file", params={**USER, "path": f"batch/{name}"}).status_code == 404
+
+
+def test_putbatch_cut_short(server):
+    archive = batch((member("whole.txt"), b"whole"), (member("cut.txt"), b"x" * 100000))
+
+    # The second member claims more data than the archive holds.
+    r = putbatch(server, archive[:len(archive) // 2])
+    r.raise_for_status()
+    assert r.json()["stored"] == ["batch/whole.txt"]
+    assert any(failed.startswith("ERROR:") for failed in r.json()["failed"])
+    assert requests.get(server + "fs/file", params={**USER, "path": "batch/cut.txt"}).status_code == 404
+
+    # Nothing usable at all.
+    assert putbatch(server, batch((member("cut.txt"), b"x" * 100000))[:2000]).status_code == 400
+
+
+def test_putbatch_hashes_what_it_stored(server):
+    data = b"batched contents\n" * 1000
+    # Batches carry no hashes, so the server's has to be of the contents as unpacked.
+    putbatch(server, batch((member("hashed.txt"), data))).raise_for_status()
+
+    r = requests.get(server + "fs/file", params={**USER, "path": "batch/hashed.txt"})
+    assert r.content == data
+    assert r.headers["etag"] == f'"{hashlib.sha256(data).hexdigest()}"'
+
+
+def test_check_lists_what_needs_uploading(server):
+    requests.put(server + "fs/file", params={**USER, "path": "checked/a.txt", "mtime": 1234.5}, data=b"same").raise_for_status()
+
+    files = [{"path": "checked/a.txt", "hash": hashlib.sha256(b"same").hexdigest()},
+             {"path": "/checked/a.txt", "hash": hashlib.sha256(b"changed").hexdigest()},
+             {"path": "checked/new.txt", "hash": hashlib.sha256(b"new").hexdigest()},
+             {"path": "checked", "hash": hashlib.sha256(b"").hexdigest()}]
+    r = requests.post(server + "fs/check", params=USER, json={"files": files})
+    assert r.json()["missing"] == ["/checked/a.txt", "checked/new.txt", "checked"]
+
+    # What the check compares against is kept for every file.
+    data = requests.get(server + "fs/getmanifest", params={**USER, "path": "checked", "files": True}).json()
+    meta = data["files"]["checked/a.txt"]
+    assert (meta["size"], meta["mtime"], meta["hash"]) == (4, 1234.5, hashlib.sha256(b"same").hexdigest())
+
+
+def test_parallel_uploads_are_all_kept(server):
+    # Like a folder upload with -j 8, over one pooled session.
+    session = requests.Session()
+    session.mount("http://", requests.adapters.HTTPAdapter(pool_maxsize=8))
+    def put(i: int) -> int:
+        return session.post(server + "fs/put", params={**USER, "dirfr": f"parallel/{i % 3}"},
+                            files={"file": (f"{i}.txt", str(i).encode())}).status_code
+    with ThreadPoolExecutor(8) as pool:
+        assert set(pool.map(put, range(60))) == {200}
+
+    data = requests.get(server + "fs/getmanifest", params={**USER, "path": "parallel", "depth": 2, "files": True}).json()
+    assert sorted(data["files"]) == sorted(f"parallel/{i % 3}/{i}.txt" for i in range(60))
+
+
+def test_streamed_upload_keeps_the_last_good_copy(server):
+    data = os.urandom(3 * 1024 * 1024 + 5)
+    params = {**USER, "path": "streamed/big.bin"}
+    r = requests.put(server + "fs/file", params={**params, "hash": hashlib.sha256(data).hexdigest(), "size": len(data)}, data=data)
+    assert r.status_code == 200
+
+    # A bad upload over it is refused, and the old contents stay.
+    r = requests.put(server + "fs/file", params={**params, "hash": hashlib.sha256(data).hexdigest()}, data=data[:-1])
+    assert r.status_code == 422
+    r = requests.put(server + "fs/file", params={**params, "size": len(data)}, data=data + b"x")
+    assert r.status_code == 422
+    assert requests.get(server + "fs/file", params=params).content == data
+
+    assert requests.put(server + "fs/file", params={**USER, "path": "../outside.bin"}, data=b"x").status_code == 422
+    assert requests.put(server + "fs/file", params={**USER, "path": "manifest.json"}, data=b"x").status_code == 409
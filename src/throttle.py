@@ -0,0 +1,228 @@
+"""
+Throttle Module.
+
+Keeps ybt_cl's uploads from crowding out everything else on the network.
+
+`TokenBucket` caps how fast every upload together can send (--bwlimit). `ThrottledAdapter` makes a requests Session
+send through one, so the cap covers every kind of upload without each having to know about it.
+
+`AdaptiveLimit` decides how many uploads run at once (--adaptive). It grows while the network keeps up, and is cut in
+half as soon as the round trip to the server starts to climb (the uplink is queueing packets, which is what makes
+everyone else's traffic slow) or the server says it is too busy. (AIMD: additive increase, multiplicative decrease)
+
+`backoff` says how long to wait before trying a failed upload again.
+"""
+import time
+import random
+import threading
+from collections import deque
+from typing import Callable
+
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+# Bodies are sent in pieces of this size, so uploads running at once take turns. (bytes)
+SEND_PIECE = 64 * 1024
+
+# The round trip can grow this much over the quickest one seen before the uplink counts as congested. (seconds)
+TARGET_DELAY = 0.1
+# The quickest round trip is remembered for this long. (seconds)
+BASE_WINDOW = 10 * 60
+# After cutting the limit, wait this long for it to take effect before cutting it again. (seconds)
+DECREASE_INTERVAL = 2.0
+
+_UNITS = {"": 1, "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+
+
+def parse_rate(text: str) -> int:
+    """
+    Parse a rate in bytes per second, with an optional K, M or G suffix. (ex. 500K, 2M)
+
+    Raises ValueError if it isn't one.
+    """
+    text = text.strip().upper().removesuffix("/S").removesuffix("B")
+    unit = text[-1:] if text[-1:] in _UNITS else ""
+    rate = int(float(text[:len(text) - len(unit)]) * _UNITS[unit])
+    if rate <= 0:
+        raise ValueError("Rate must be more than 0.")
+    return rate
+
+
+def backoff(attempt: int, base: float, cap: float, retry_after: str | None = None) -> float:
+    """
+    Returns how long to wait (seconds) before retry number `attempt` (from 0).
+
+    Exponential backoff with full jitter: a random time up to `base` * 2 ** `attempt` (at most `cap`), so clients that
+    failed together don't all come back at once. If the server sent a `Retry-After` (in seconds), that is used instead.
+    """
+    if retry_after is not None:
+        try:
+            return min(max(float(retry_after), 0.0), cap)
+        except ValueError:
+            # An HTTP date. Not worth parsing, the usual backoff will do.
+            pass
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+class TokenBucket:
+    """
+    Lets at most `rate` bytes a second through, shared by every thread that takes from it.
+
+    After a quiet spell, up to `burst` bytes (a tenth of a second's worth by default) can go through at once.
+
+    `timer`, if given, is called with (seconds, bytes) every time a thread had to wait.
+    """
+    def __init__(self, rate: int, burst: int | None = None, timer: Callable[[float, int], None] | None = None) -> None:
+        self.rate = rate
+        self.burst = burst if burst is not None else max(rate // 10, SEND_PIECE)
+        self.timer = timer
+
+        # Private
+        self.__tokens = float(self.burst)
+        self.__last = time.monotonic()
+        self.__lock = threading.Lock()
+
+    def take(self, size: int) -> None:
+        """
+        Wait until `size` more bytes can be sent.
+
+        Threads are let through in the order they asked: each one takes its bytes right away, running the bucket
+        into debt, and waits until the debt is paid off.
+        """
+        with self.__lock:
+            now = time.monotonic()
+            self.__tokens = min(self.burst, self.__tokens + (now - self.__last) * self.rate)
+            self.__last = now
+            self.__tokens -= size
+            wait = -self.__tokens / self.rate if self.__tokens < 0 else 0.0
+
+        if wait > 0:
+            time.sleep(wait)
+            if self.timer is not None:
+                self.timer(wait, size)
+
+
+class _Throttled:
+    """
+    Mixin for urllib3 connections that sends everything through `bucket`.
+    """
+    bucket: TokenBucket
+
+    def send(self, data) -> None:
+        # Older urllib3 versions hand over file objects (and iterables) as is.
+        if hasattr(data, "read"):
+            while block := data.read(SEND_PIECE):
+                self.send(block)
+            return
+        if not isinstance(data, (bytes, bytearray, memoryview, str)):
+            for block in data:
+                self.send(block)
+            return
+
+        if isinstance(data, str):
+            data = data.encode("iso-8859-1")
+        view = memoryview(data)
+        for offset in range(0, len(view), SEND_PIECE):
+            piece = view[offset:offset + SEND_PIECE]
+            self.bucket.take(len(piece))
+            super().send(piece) # type: ignore
+
+
+def _throttled_pool(pool: type, bucket: TokenBucket) -> type:
+    connection = type(f"Throttled{pool.ConnectionCls.__name__}", (_Throttled, pool.ConnectionCls), {"bucket": bucket})
+    return type(f"Throttled{pool.__name__}", (pool,), {"ConnectionCls": connection})
+
+
+class ThrottledAdapter(HTTPAdapter):
+    """
+    HTTPAdapter whose requests are all sent through `bucket`. (responses are not limited)
+
+    ex. `session.mount("http://", ThrottledAdapter(bucket, pool_maxsize=8))`
+    """
+    def __init__(self, bucket: TokenBucket, **kwargs) -> None:
+        # Set first, since HTTPAdapter sets up its pool manager right away.
+        self.bucket = bucket
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs) -> None:
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": _throttled_pool(HTTPConnectionPool, self.bucket),
+            "https": _throttled_pool(HTTPSConnectionPool, self.bucket),
+        }
+
+
+class AdaptiveLimit:
+    """
+    How many uploads can run at once, between 1 and `maximum`. Thread safe.
+
+    Wrap each upload in `with limit:`, which waits for a free slot. Report the round trip of a small request to the
+    server every so often with `delay`, and anything that shows the server or network is overloaded (ex. 503 or 429
+    responses, timeouts) with `congested`.
+
+    Starts at 1 and doubles (slow start, like TCP) until the first sign of congestion, then grows by one at a time.
+    It only grows while every slot is in use, so a limit nothing needs is never built up.
+    """
+    def __init__(self, maximum: int) -> None:
+        self.maximum = max(maximum, 1)
+        self.limit = 1.0
+        # How often the limit was cut, by reason.
+        self.decreases: dict[str, int] = {}
+        self.peak = 1
+
+        # Private
+        self.__active = 0
+        self.__slow_start = True
+        self.__last_decrease = 0.0
+        # (time, seconds) of recent round trips, to find the quickest.
+        self.__delays: deque[tuple[float, float]] = deque()
+        self.__condition = threading.Condition()
+
+    def __enter__(self):
+        with self.__condition:
+            self.__condition.wait_for(lambda: self.__active < int(self.limit))
+            self.__active += 1
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        with self.__condition:
+            self.__active -= 1
+            self.__condition.notify()
+
+    def delay(self, seconds: float) -> None:
+        """
+        Record the round trip of a small request to the server, and grow or cut the limit to match.
+        """
+        now = time.monotonic()
+        with self.__condition:
+            self.__delays.append((now, seconds))
+            while self.__delays[0][0] < now - BASE_WINDOW:
+                self.__delays.popleft()
+            base = min(delay for when, delay in self.__delays)
+
+        if seconds - base > TARGET_DELAY:
+            self.congested("latency")
+            return
+
+        with self.__condition:
+            if self.__active < int(self.limit):
+                return
+            self.limit = min(self.limit * 2 if self.__slow_start else self.limit + 1, self.maximum)
+            self.peak = max(self.peak, int(self.limit))
+            self.__condition.notify_all()
+
+    def congested(self, reason: str) -> None:
+        """
+        Cut the limit in half. Signs of the same congestion that arrive right after are ignored.
+        """
+        now = time.monotonic()
+        with self.__condition:
+            self.__slow_start = False
+            if now - self.__last_decrease < DECREASE_INTERVAL:
+                return
+            self.__last_decrease = now
+            self.limit = max(self.limit / 2, 1.0)
+            self.decreases[reason] = self.decreases.get(reason, 0) + 1
+
+    def report(self) -> dict:
+        return {"maximum": self.maximum, "limit": int(self.limit), "peak": self.peak, "decreases": dict(self.decreases)}
@@ -0,0 +1,194 @@
+"""
+Uploads Module.
+
+Resumable upload sessions for ybt_srv.
+
+A session is opened for one file with its final size and hash. The client then sends numbered pieces at
+any offset (several at once, in any order), can ask how much has arrived, and commits once everything is
+there. If the connection drops, the next run picks up the session and only sends what is missing.
+
+Each session is a folder holding `session.json` (what is being uploaded and which byte ranges arrived)
+and `data` (the file being built).
+"""
+import os
+import json
+import time
+import shutil
+import threading
+
+from genuid import generate_uid
+
+
+class UploadSession:
+    """
+    One resumable upload.
+
+    Use UploadSession.create to open a new session, and UploadSession(folder, id) to load an existing one.
+
+    Hold the session (`with session:`) while committing it, so no piece can be written while its data is checked and
+    moved into place.
+    """
+    # One lock per session, so pieces arriving at the same time don't lose each other's ranges, and none arrive
+    # while the session is committed.
+    __locks: dict[str, threading.Lock] = {}
+    __locks_lock = threading.Lock()
+
+    class NoSuchSession(BaseException):
+        def __init__(self, *args: object) -> None:
+            super().__init__(*args)
+
+    def __init__(self, folder: str, id: str) -> None:
+        # IDs end up in paths, so only accept what generate_uid makes.
+        if not id.isalnum():
+            raise self.NoSuchSession(f"Upload session '{id}' does not exist.")
+
+        self.id = id
+        self.folder = os.path.join(folder, id)
+        self.dataPath = os.path.join(self.folder, "data")
+        self.__state_path = os.path.join(self.folder, "session.json")
+
+        try:
+            with open(self.__state_path, "r") as f:
+                self.__state = json.load(f)
+        except FileNotFoundError:
+            raise self.NoSuchSession(f"Upload session '{id}' does not exist.")
+
+        with UploadSession.__locks_lock:
+            self.__lock = UploadSession.__locks.setdefault(self.folder, threading.Lock())
+
+    @classmethod
+    def create(cls, folder: str, relpath: str, size: int, digest: str, mtime: float | None = None) -> "UploadSession":
+        """
+        Open a new session for a file of `size` bytes that will be stored as `relpath`.
+        """
+        id = generate_uid()
+        path = os.path.join(folder, id)
+        os.makedirs(path)
+
+        # Reserve the full size up front. Pieces can then be written anywhere.
+        with open(os.path.join(path, "data"), "wb") as f:
+            f.truncate(size)
+
+        with open(os.path.join(path, "session.json"), "w") as f:
+            json.dump({
+                "path": relpath,
+                "size": size,
+                "hash": digest,
+                "mtime": mtime,
+                "created": time.time(),
+                # [start, end) byte ranges that have arrived, merged and sorted.
+                "ranges": []
+            }, f)
+
+        return cls(folder, id)
+
+    @staticmethod
+    def prune(folder: str, max_age: float) -> None:
+        """
+        Remove sessions that were opened more than `max_age` seconds ago.
+        """
+        if not os.path.isdir(folder):
+            return
+
+        for id in os.listdir(folder):
+            path = os.path.join(folder, id)
+            if time.time() - os.path.getmtime(path) > max_age:
+                shutil.rmtree(path, ignore_errors=True)
+
+    @property
+    def path(self) -> str:
+        return self.__state["path"]
+
+    @property
+    def size(self) -> int:
+        return self.__state["size"]
+
+    @property
+    def hash(self) -> str:
+        return self.__state["hash"]
+
+    @property
+    def mtime(self) -> float | None:
+        return self.__state["mtime"]
+
+    @property
+    def ranges(self) -> list[list[int]]:
+        return self.__state["ranges"]
+
+    def offset(self) -> int:
+        """
+        Returns the committed offset: everything before it has arrived.
+        """
+        ranges = self.__state["ranges"]
+        if ranges and ranges[0][0] == 0:
+            return ranges[0][1]
+        return 0
+
+    def info(self) -> dict:
+        return {"id": self.id, "path": self.path, "size": self.size, "offset": self.offset(), "ranges": self.ranges}
+
+    def write(self, offset: int, data: bytes) -> None:
+        """
+        Write a piece of the file at `offset`.
+
+        The piece is flushed to disk before it is recorded, so a crash can never mark missing data as received.
+
+        Raises ValueError if the piece does not fit in the file, and NoSuchSession if the session was committed (or
+        removed) in the meantime.
+        """
+        if offset < 0 or offset + len(data) > self.size:
+            raise ValueError("Piece does not fit in the file.")
+
+        with self:
+            fd = os.open(self.dataPath, os.O_WRONLY)
+            try:
+                os.pwrite(fd, data, offset)
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+            self.__state["ranges"] = self.__merge(self.__state["ranges"] + [[offset, offset + len(data)]])
+
+            tmp = self.__state_path + ".tmp"
+            with open(tmp, "w") as f:
+                json.dump(self.__state, f)
+            os.replace(tmp, self.__state_path)
+
+            # Keep the session from being pruned while pieces are still arriving.
+            os.utime(self.folder)
+
+    def __enter__(self):
+        """
+        Hold the session, and reload it in case another piece was recorded since it was loaded.
+
+        Raises NoSuchSession if it was committed (or removed) in the meantime.
+        """
+        self.__lock.acquire()
+        try:
+            with open(self.__state_path, "r") as f:
+                self.__state = json.load(f)
+        except FileNotFoundError:
+            self.__lock.release()
+            raise self.NoSuchSession(f"Upload session '{self.id}' does not exist.")
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.__lock.release()
+
+    def remove(self) -> None:
+        """
+        Delete the session and anything left of its data.
+        """
+        shutil.rmtree(self.folder, ignore_errors=True)
+        with UploadSession.__locks_lock:
+            UploadSession.__locks.pop(self.folder, None)
+
+    @staticmethod
+    def __merge(ranges: list[list[int]]) -> list[list[int]]:
+        merged = []
+        for start, end in sorted(ranges):
+            if merged and start <= merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], end)
+            else:
+                merged.append([start, end])
+        return merged
@@ -0,0 +1,228 @@
+"""
+Watcher Module.
+
+Watches a folder for files that change, so ybt_cl can back them up as it happens instead of scanning the
+whole tree again.
+
+Use `open_watcher`. On Linux this uses inotify, anywhere else it falls back to scanning every few seconds.
+
+Changes are debounced: a file is only reported once it has been left alone for `debounce` seconds, so a file
+saved ten times in a row is only reported once.
+"""
+import os
+import sys
+import time
+import select
+import struct
+import ctypes
+import ctypes.util
+from typing import Iterator
+
+# The most paths that can wait to be reported. Past this, the watcher gives up on tracking single paths and
+# asks for a full rescan instead, so memory stays bounded however much changes at once.
+MAX_PENDING = 100_000
+
+
+class Watcher:
+    """
+    Base watcher. Subclasses find changed paths, this handles debouncing and reporting them.
+    """
+    def __init__(self, root: str, debounce: float = 1.0) -> None:
+        self.root = root
+        self.debounce = debounce
+        # path -> when it last changed
+        self.__pending: dict[str, float] = {}
+        self.__overflow = False
+
+    def _poll(self, timeout: float | None) -> list[str] | None:
+        """
+        Wait up to `timeout` seconds (forever if None) for changes.
+
+        Returns the paths that changed, or None if changes were lost and everything should be rescanned.
+        """
+        raise NotImplementedError
+
+    def changes(self) -> Iterator[set[str] | None]:
+        """
+        Yields sets of changed paths, forever.
+
+        Yields None instead if changes were lost (ex. too many at once), in which case the whole folder should be
+        scanned again.
+        """
+        while True:
+            now = time.monotonic()
+            due = {path for path, changed in self.__pending.items() if now - changed >= self.debounce}
+
+            if self.__overflow and not self.__pending:
+                self.__overflow = False
+                yield None
+                continue
+            if due:
+                for path in due:
+                    del self.__pending[path]
+                yield due
+                continue
+
+            # Sleep until the next path is due, or until something changes.
+            timeout = None
+            if self.__pending:
+                timeout = max(min(self.__pending.values()) + self.debounce - now, 0)
+            elif self.__overflow:
+                timeout = self.debounce
+
+            paths = self._poll(timeout)
+            now = time.monotonic()
+            if paths is None:
+                self.__overflow = True
+                continue
+            for path in paths:
+                # Changing again restarts the wait.
+                self.__pending.pop(path, None)
+                self.__pending[path] = now
+
+            if len(self.__pending) > MAX_PENDING:
+                self.__pending.clear()
+                self.__overflow = True
+
+    def close(self) -> None:
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class InotifyWatcher(Watcher):
+    """
+    Linux watcher using inotify (through ctypes, so nothing needs installing).
+
+    Every folder under `root` gets its own watch. New folders are watched as they appear, and anything already
+    inside them is reported, since it may have been written before the watch was added.
+    """
+    IN_MODIFY = 0x2
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_Q_OVERFLOW = 0x4000
+    IN_IGNORED = 0x8000
+    IN_ISDIR = 0x40000000
+
+    MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+
+    # struct inotify_event: int wd, uint32 mask, uint32 cookie, uint32 len, char name[len]
+    EVENT = struct.Struct("iIII")
+
+    def __init__(self, root: str, debounce: float = 1.0) -> None:
+        super().__init__(root, debounce)
+
+        self.__libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.__fd = self.__libc.inotify_init1(os.O_CLOEXEC)
+        if self.__fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+        # watch descriptor -> folder
+        self.__watches: dict[int, str] = {}
+        self.__watchTree(root)
+
+    def __watchTree(self, folder: str) -> list[str]:
+        """
+        Watch `folder` and every folder inside it. Returns the files found on the way.
+        """
+        files = []
+        for path, subdirs, names in os.walk(folder):
+            wd = self.__libc.inotify_add_watch(self.__fd, os.fsencode(path), self.MASK)
+            if wd < 0:
+                # Most likely the folder was removed already, or the watch limit was reached.
+                continue
+            self.__watches[wd] = path
+            files.extend(os.path.join(path, name) for name in names)
+        return files
+
+    def _poll(self, timeout: float | None) -> list[str] | None:
+        readable, _, _ = select.select([self.__fd], [], [], timeout)
+        if not readable:
+            return []
+
+        data = os.read(self.__fd, 64 * 1024)
+        paths = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = self.EVENT.unpack_from(data, offset)
+            name = data[offset + self.EVENT.size:offset + self.EVENT.size + length].rstrip(b"\0")
+            offset += self.EVENT.size + length
+
+            if mask & self.IN_Q_OVERFLOW:
+                return None
+            if mask & self.IN_IGNORED:
+                self.__watches.pop(wd, None)
+                continue
+
+            folder = self.__watches.get(wd)
+            if folder is None or not name:
+                continue
+            path = os.path.join(folder, os.fsdecode(name))
+
+            if mask & self.IN_ISDIR:
+                if mask & (self.IN_CREATE | self.IN_MOVED_TO):
+                    paths.extend(self.__watchTree(path))
+            elif not mask & self.IN_CREATE:
+                # Creating a file is followed by writing and closing it, so wait for that.
+                paths.append(path)
+        return paths
+
+    def close(self) -> None:
+        if self.__fd >= 0:
+            os.close(self.__fd)
+            self.__fd = -1
+
+
+class PollingWatcher(Watcher):
+    """
+    Watcher for systems without inotify. Scans the whole folder every `interval` seconds, and reports files
+    whose size or mtime changed.
+    """
+    def __init__(self, root: str, debounce: float = 1.0, interval: float = 5.0) -> None:
+        super().__init__(root, debounce)
+        self.interval = interval
+        self.__last_scan = time.monotonic()
+        self.__seen = self.__scan()
+
+    def __scan(self) -> dict[str, tuple[int, int]]:
+        seen = {}
+        for path, subdirs, names in os.walk(self.root):
+            for name in names:
+                file = os.path.join(path, name)
+                try:
+                    st = os.stat(file)
+                except OSError:
+                    continue
+                seen[file] = (st.st_mtime_ns, st.st_size)
+        return seen
+
+    def _poll(self, timeout: float | None) -> list[str] | None:
+        wait = self.__last_scan + self.interval - time.monotonic()
+        if timeout is not None and timeout < wait:
+            time.sleep(timeout)
+            return []
+        time.sleep(max(wait, 0))
+
+        self.__last_scan = time.monotonic()
+        seen = self.__scan()
+        changed = [file for file, stamp in seen.items() if self.__seen.get(file) != stamp]
+        self.__seen = seen
+        return changed
+
+
+def open_watcher(root: str, debounce: float = 1.0) -> Watcher:
+    """
+    Returns the best watcher available for `root`.
+    """
+    if sys.platform.startswith("linux"):
+        try:
+            return InotifyWatcher(root, debounce)
+        except (OSError, AttributeError):
+            # No inotify (ex. an unusual libc). Scanning still works.
+            pass
+    return PollingWatcher(root, debounce)
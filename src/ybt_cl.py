@@ -26,8 +26,26 @@ import requests
 import os
 import json
 import sys
+import io
+import tarfile
+import threading
+import hashlib
+import queue
+import time
+import contextlib
 from time import sleep
+from typing import Callable, Iterable, Iterator
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from progressbar import ProgressBar
+from fileindex import FileIndex, HASH_NAME
+from hasher import Hasher, HashCache
+from watcher import open_watcher
+from runstats import RunStats, CountedBody
+from throttle import TokenBucket, ThrottledAdapter, AdaptiveLimit, parse_rate, backoff
+from journal import Journal
+import chunker
+import delta
+import compression
 
 # This should be http://YBTSERVERIP:8000/api/
 BASE_URL = os.environ.get("YBT_SERVER_IP", None)
@@ -44,23 +62,94 @@ FORBIDDEN = ["^/$", "^/home/?([A-Za-z0-9]+)?/?$", ".:/?$", "^[A-Za-z]:/Users/?([
 
 VERSION = "2.0.0-alpha"
 
+# Remembers what was uploaded last time, so unchanged files can be skipped.
+INDEX_PATH = "./ybt_index.json"
+# Remembers the hash of every file, so only new or changed files are hashed again.
+HASH_CACHE_PATH = "./ybt_hashes.json"
+# How many (path, hash) pairs to ask the server about at once...
+CHECK_BATCH = 2000
+# ...or after how long, if the folder is still being scanned. (seconds)
+CHECK_DELAY = 1.0
+# Files smaller than this are grouped together and uploaded in batches...
+BATCH_FILE_SIZE = 1024 * 1024
+# ...of at most this many files, or this many bytes.
+BATCH_MAX_FILES = 256
+BATCH_MAX_BYTES = 16 * 1024 * 1024
+# Files at least this big are sent through resumable upload sessions...
+SESSION_THRESHOLD = 64 * 1024 * 1024
+# ...in pieces this big, with this many pieces in flight at once.
+SESSION_PIECE = 8 * 1024 * 1024
+SESSION_INFLIGHT = 4
+# Changed files at least this big are sent as the differences from the server's copy, if the server has one.
+DELTA_THRESHOLD = 16 * 1024 * 1024
+# Open upload sessions, so interrupted uploads can be resumed on the next run.
+SESSIONS_PATH = "./ybt_sessions.json"
+# What the current (or last, if it was cut short) folder upload finished, for --resume.
+JOURNAL_PATH = "./ybt_journal.jsonl"
+# Uploads that fail with one of these (or can't reach the server) are tried again...
+RETRY_STATUS = {408, 429, 500, 502, 503, 504}
+# ...up to this many more times, waiting a random time of up to 1, 2, 4... seconds in between, never more than a minute.
+RETRY_ATTEMPTS = 5
+RETRY_BASE_DELAY = 1.0
+RETRY_MAX_DELAY = 60.0
+# In --watch mode, a file is only uploaded once it has gone this long without changing. (seconds)
+WATCH_DEBOUNCE = 2.0
+# How many entries of a folder to fetch at once for --get.
+GET_PAGE = 1000
+# Restored files are downloaded next to where they go, with this added to the name, until they are complete.
+PART_SUFFIX = ".ybt-part"
+# How many of the slowest uploads --stats and --report list.
+SLOWEST_FILES = 10
+# With --adaptive, how often to time a round trip to the server while uploading... (seconds)
+PROBE_INTERVAL = 1.0
+# ...and how long one can take before the network counts as congested. (seconds)
+PROBE_TIMEOUT = 5.0
+
 if not BASE_URL:
     print("Unable to determine YBT server IP! Please set it with the \"YBT_SERVER_IP\" env variable!")
     sys.exit()
 
 
-# Ensure we run from the location of the executable.
-os.chdir(os.path.dirname(__file__))
+# Ensure we run from the location of the executable, which is where the config and index are kept.
+# YBT_HOME can point somewhere else instead (ex. to keep separate configs, as the benchmarks do).
+os.chdir(os.environ.get("YBT_HOME") or os.path.dirname(__file__))
 
 # CLI Arguments.
 parser = argparse.ArgumentParser()
 parser.add_argument("path", nargs='?', default=None, help="The path to backup.")
 parser.add_argument("-t","--top", help="For single file uploads, choose the folder to upload into. This will also create the directory if needed.")
-parser.add_argument("-g", "--get", action="store_true", help="Get a list of all files currently uploaded to YBT's server.")
+parser.add_argument("-g", "--get", nargs="?", const="/", metavar="PATH", help="Get a list of all files currently uploaded to YBT's server, or only the ones in the folder PATH.")
 parser.add_argument("-s", "--setup", action="store_true", help="Enter setup mode to create or log into an account.")
 parser.add_argument("-v", "--version", action="store_true", help="Display the current YBT version.")
+parser.add_argument("-j", "--jobs", type=int, default=4, help="For folder uploads, how many files to upload at once. Defaults to 4.")
+parser.add_argument("--hash-workers", type=int, default=min(os.cpu_count() or 1, 8), metavar="N", help="How many files to hash at once. Defaults to the number of CPUs (at most 8).")
+parser.add_argument("-f", "--force", action="store_true", help="For folder uploads, upload every file even if it has not changed since the last backup.")
+parser.add_argument("-w", "--watch", action="store_true", help="For folder uploads, keep running after the upload and back up files as they change.")
+parser.add_argument("-r", "--restore", metavar="REMOTE", help="Download the backed up file or folder REMOTE (from root, \"/\" for everything) into the folder given as the path.")
+parser.add_argument("--snapshot", nargs="?", const="", metavar="LABEL", help="After uploading, take a snapshot of everything on the server, so it can be restored later even if files are overwritten. Optionally give it a label.")
+parser.add_argument("--snapshots", action="store_true", help="List your snapshots.")
+parser.add_argument("--at", metavar="SNAPSHOT", help="With -g or --restore, use the files as they were in SNAPSHOT (see --snapshots) instead of the latest ones.")
+parser.add_argument("--compress", choices=["auto", "zstd", "zlib", "lzma", "none"], default="auto", help="How to compress uploads. auto (default): zstd if both sides have it, otherwise zlib. none: send files as they are. Files that are already compressed (ex. photos, videos, zip files) are always sent as they are.")
+parser.add_argument("--resume", action="store_true", help="For folder uploads, pick up where the last upload of the same folder stopped (ex. if it crashed), without checking the files it already finished again.")
+parser.add_argument("--bwlimit", type=parse_rate, metavar="RATE", help="Upload at most RATE bytes per second, across all uploads at once. Accepts K, M and G suffixes (ex. 500K, 2M).")
+parser.add_argument("--adaptive", action="store_true", help="For folder uploads, start with one upload at a time and add more (up to -j) while the network keeps up. Backs off as soon as the server gets slow to answer or says it is busy.")
+parser.add_argument("--stats", action="store_true", help="After uploading or restoring, show where the time went (scan, hashing, requests, server).")
+parser.add_argument("--report", metavar="FILE", help="Write the same timings as --stats to FILE, as JSON.")
 args = parser.parse_args()
 
+# Guards SESSIONS_PATH, since large files upload in parallel.
+sessions_lock = threading.Lock()
+# Guards the login token, which uploads renew if the server forgets it.
+token_lock = threading.Lock()
+
+# Timings for --stats and --report. Always kept, since it's cheap.
+stats = RunStats(SLOWEST_FILES)
+
+# Shared by every upload, so --bwlimit holds for all of them together.
+bucket = TokenBucket(args.bwlimit, timer=lambda seconds, size: stats.add("throttle", seconds, size)) if args.bwlimit else None
+# How many uploads run at once with --adaptive.
+upload_limit = AdaptiveLimit(args.jobs) if args.adaptive else None
+
 # FUNCTIONS #
 def exc(exc_type, exc_value, exc_tb):
     """
@@ -94,7 +183,13 @@ def authorizeUser():
             config: dict
 
         if config.get("username") and config.get("password"):
-            r = requests.get(BASE_URL+f"users/auth?usr={config["username"]}&psw={config["password"]}")
+            # Log in once, then send the token instead of the password. Older servers don't have tokens.
+            r = requests.post(BASE_URL+"users/login", params=auth_params(config))
+            if r.status_code == 404:
+                r = requests.get(BASE_URL+f"users/auth?usr={config["username"]}&psw={config["password"]}")
+            elif r.status_code == 200:
+                config["token"] = r.json()["token"]
+
             if r.status_code == 200:
                 print("OK!")
             elif r.status_code == 401:
@@ -115,6 +210,36 @@ def authorizeUser():
         print("FAILED: Could not find the ybt.json config file! Please run YBT with the -s flag to create it.")
         sys.exit()
 
+def auth_params(config: dict) -> dict:
+    """
+    Returns the query parameters that identify the user. Uses the login token if there is one.
+    """
+    if config.get("token"):
+        return {"usr": config["username"], "token": config["token"]}
+    return {"usr": config["username"], "psw": config["password"]}
+
+def renew_token(config: dict, stale: str | None) -> bool:
+    """
+    Log in again after the server turned down the token `stale`. (tokens are lost when the server restarts)
+
+    Returns True if there is a new token to try. Safe to call from multiple threads at once: only the first one to
+    find the token stale logs in again.
+    """
+    if stale is None:
+        # Logged in with the password, so it really was turned down.
+        return False
+    with token_lock:
+        if config.get("token") != stale:
+            return True
+        try:
+            r = requests.post(BASE_URL+"users/login", params={"usr": config["username"], "psw": config["password"]})
+        except requests.RequestException:
+            return False
+        if r.status_code != 200:
+            return False
+        config["token"] = r.json()["token"]
+        return True
+
 def makeAPIRequest(url: str = "", post: bool = False):
     """
     Make an API request and print either OK or FAILED based on the result.
@@ -155,27 +280,866 @@ def makeAPIRequest(url: str = "", post: bool = False):
 
     return r.json()
     
-def print_tree(data: dict, indent=''):
-    """
-    Iterate through a dictionary and print out a Tree structured version of it.
-
-    Dictionaries count as sub-folders, and their contents will cause an indent.
-    """
-    for name, contents in data.items():
-        print(f"{indent}└── {name}")
-        # print(value)
-        if isinstance(contents, list):
-            size = len(contents)-1
-            for i, subcontents in enumerate(contents):
-                # If the item is a dictionary AKA a folder, start iterating through it instead.
-                if isinstance(subcontents, dict):
-                    print_tree(subcontents, indent + "    ")
-                    size -= 1
+def make_session(pool_size: int = 1) -> requests.Session:
+    """
+    Returns a session for talking to the server, keeping up to `pool_size` connections open.
+
+    Its requests are counted for --stats, held to --bwlimit, and (with --adaptive) watched for signs that the
+    server is overloaded.
+    """
+    session = requests.Session()
+    session.hooks["response"].append(stats.response)
+    if upload_limit is not None:
+        session.hooks["response"].append(watch_congestion)
+
+    if bucket is not None:
+        adapter = ThrottledAdapter(bucket, pool_connections=1, pool_maxsize=pool_size)
+    else:
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+def watch_congestion(r: requests.Response, *args, **kwargs) -> None:
+    """
+    Response hook for --adaptive. Fewer uploads run at once when the server says it is too busy.
+    """
+    if r.status_code in (429, 503):
+        upload_limit.congested(str(r.status_code)) # type: ignore
+
+def probe_latency(stop: threading.Event) -> None:
+    """
+    For --adaptive. Times a small request to the server every PROBE_INTERVAL until `stop` is set.
+
+    It has its own connection, so it never waits behind an upload on this side, only in the network (and server).
+    """
+    with requests.Session() as session:
+        while not stop.wait(PROBE_INTERVAL):
+            began = time.perf_counter()
+            try:
+                r = session.get(BASE_URL+"info", timeout=PROBE_TIMEOUT)
+            except requests.RequestException:
+                upload_limit.congested("timeout") # type: ignore
+                continue
+            if r.status_code in (429, 503):
+                upload_limit.congested(str(r.status_code)) # type: ignore
+            else:
+                upload_limit.delay(time.perf_counter() - began) # type: ignore
+
+def print_tree(name: str, entries: Iterable, fetch: Callable[[str], Iterable]) -> None:
+    """
+    Print a folder and everything inside it as a tree, as its contents come in.
+
+    Files are strings and folders are `{name: [contents]}`, where contents can be None if they still need to be
+    fetched with `fetch(path)`. Nothing is kept around once it has been printed.
+    """
+    print(f"└── {name}")
+
+    # [entries, indent, path of the folder, the next entry]. The next entry is looked at early to know which is last.
+    stack = [[iter(entries), "    ", ""]]
+    stack[-1].append(next(stack[-1][0], None))
+    while stack:
+        level = stack[-1]
+        entries, indent, prefix, entry = level
+        if entry is None:
+            stack.pop()
+            continue
+        level[3] = next(entries, None)
+
+        if isinstance(entry, dict):
+            # Dictionaries are sub-folders. Start going through them instead.
+            for folder, contents in entry.items():
+                print(f"{indent}└── {folder}")
+                path = prefix + folder
+                children = iter(contents if contents is not None else fetch(path))
+                stack.append([children, indent + "    ", path + "/", next(children, None)])
+        elif level[3] is not None:
+            print(f"{indent}├── {entry}")
+        else:
+            print(f"{indent}└── {entry}")
+
+def iter_folder(session: requests.Session, config: dict, path: str, snapshot: str | None = None) -> Iterator:
+    """
+    Yields the contents of a remote folder (in the manifest's layout, see print_tree), one page at a time.
+
+    Sub-folders are left for the caller to fetch. Set `snapshot` to list the folder as it was in that snapshot.
+    """
+    offset = 0
+    while True:
+        params = {**auth_params(config), "path": path, "depth": 1, "offset": offset, "limit": GET_PAGE, "files": False}
+        if snapshot:
+            params["snapshot"] = snapshot
+        r = session.get(BASE_URL+"fs/getmanifest", params=params)
+        if r.status_code != 200:
+            print(f"FAILED: Could not list '{path}'. ({r.json()["detail"]})")
+            sys.exit(1)
+
+        data = r.json()
+        yield from data["root"]
+
+        # Older servers send everything at once.
+        if data.get("next") is None:
+            return
+        offset = data["next"]
+
+def iter_remote_files(session: requests.Session, config: dict, path: str, snapshot: str | None = None) -> Iterator[tuple[str, dict]]:
+    """
+    Yields (remote path, metadata) for every file inside a remote folder and all of its sub-folders (or just the
+    file, if `path` is one), fetching the listing a page at a time.
+
+    Set `snapshot` to list the files as they were in that snapshot.
+    """
+    folders = [path]
+    while folders:
+        folder = folders.pop()
+        offset = 0
+        while True:
+            params = {**auth_params(config), "path": folder, "depth": 1, "offset": offset, "limit": GET_PAGE, "files": True}
+            if snapshot:
+                params["snapshot"] = snapshot
+            r = session.get(BASE_URL+"fs/getmanifest", params=params)
+            if r.status_code != 200:
+                print(f"FAILED: Could not list '{folder}'. ({r.json()["detail"]})")
+                sys.exit(1)
+
+            data = r.json()
+            yield from data["files"].items()
+            # Sub-folders are listed on their own. (Older servers send them filled in, with their files included)
+            prefix = folder + "/" if folder else ""
+            folders.extend(prefix + name for entry in data["root"] if isinstance(entry, dict)
+                           for name, contents in entry.items() if contents is None)
+
+            if data.get("next") is None:
+                break
+            offset = data["next"]
+
+def find_missing(session: requests.Session, config: dict, files: list[tuple[str, str]]) -> set[str]:
+    """
+    Ask the server which files it does not already have.
+
+    Takes a list of (remote path, hash) pairs and returns the remote paths that need uploading.
+    Pairs are sent in batches of CHECK_BATCH, so thousands of files only take a few requests.
+    """
+    missing = set()
+    for i in range(0, len(files), CHECK_BATCH):
+        batch = files[i:i+CHECK_BATCH]
+        try:
+            r = session.post(BASE_URL+"fs/check", params=auth_params(config),
+                             json={"files": [{"path": path, "hash": digest} for path, digest in batch]})
+        except requests.ConnectionError:
+            r = None
+
+        if r is not None and r.status_code == 200:
+            missing.update(r.json()["missing"])
+        else:
+            # Older servers can't tell us, so upload everything in this batch.
+            missing.update(path for path, digest in batch)
+    return missing
+
+def upload_file(session: requests.Session, config: dict, file: str, remote: str, st: os.stat_result) -> requests.Response:
+    """
+    Upload a single file to its remote path.
+
+    Safe to call from multiple threads at once. Returns the server's response.
+    """
+    # DirectoryFromRoot. This will place the file in subfolders instead of just in root.
+    dirfr = os.path.dirname(remote)
+
+    with open(file, 'rb') as f:
+        return session.post(BASE_URL+"fs/put", params={**auth_params(config), "dirfr": dirfr, "mtime": st.st_mtime}, files={'file': f})
+
+def file_codec(encoding: str | None, file: str) -> str | None:
+    """
+    Returns the codec to compress `file` with when uploading it, or None if it isn't worth compressing.
+
+    `encoding` is the codec picked for this server. (see get_server_info)
+    """
+    if encoding is None:
+        return None
+    try:
+        with open(file, "rb") as f:
+            sample = f.read(compression.SAMPLE_SIZE)
+    except OSError:
+        return None
+    return encoding if compression.worth_compressing(file, sample) else None
+
+def compressed(pieces: Iterable[bytes], codec: str) -> Iterator[bytes]:
+    """
+    Yields `pieces` compressed with `codec`, as a streamed request body.
+    """
+    encoder = compression.Encoder(codec)
+    for data in pieces:
+        with stats.phase("compress", len(data)):
+            data = encoder.compress(data)
+        if data:
+            yield data
+    yield encoder.flush()
+
+def compress_body(codec: str | None, data: bytes) -> tuple[bytes, dict]:
+    """
+    Compress a request body with `codec`, if that makes it smaller. Returns the body and the headers to send it with.
+    """
+    headers = {"Content-Type": "application/octet-stream"}
+    if codec is not None:
+        with stats.phase("compress", len(data)):
+            packed = compression.compress(codec, data)
+        if len(packed) < len(data):
+            return packed, {**headers, "Content-Encoding": codec}
+    return data, headers
+
+def upload_stream(session: requests.Session, config: dict, file: str, remote: str, st: os.stat_result, digest: str | None = None,
+                  encoding: str | None = None) -> requests.Response:
+    """
+    Upload a single file as the raw request body.
+
+    The file is streamed from disk, and the server writes it straight into place, so this is the cheapest way to
+    send a large file. Only for servers with the "stream" feature. (see get_server_info)
+
+    If the file is worth compressing, it is compressed with `encoding` on the way out.
+
+    Safe to call from multiple threads at once. Returns the server's response.
+    """
+    params = {**auth_params(config), "path": remote, "mtime": st.st_mtime, "size": st.st_size}
+    if digest is not None:
+        params["hash"] = digest
+
+    codec = file_codec(encoding, file)
+    with open(file, 'rb') as f:
+        if codec is None:
+            return session.put(BASE_URL+"fs/file", params=params, data=f, headers={"Content-Type": "application/octet-stream"})
+        return session.put(BASE_URL+"fs/file", params=params, data=CountedBody(compressed(iter(lambda: f.read(1024 * 1024), b""), codec)),
+                           headers={"Content-Type": "application/octet-stream", "Content-Encoding": codec})
+
+def upload_batch(session: requests.Session, config: dict, top_dir: str, files: list[tuple[str, str]], encoding: str | None = None) -> requests.Response:
+    """
+    Upload many small files in one request.
+
+    Takes a list of (local file, remote path) pairs. Every remote path must be inside `top_dir`.
+    The files are packed into a tar archive that the server unpacks into `top_dir`. If `encoding` is given, the
+    archive is compressed too (gzip, or xz for lzma, which the server unpacks either way).
+
+    Safe to call from multiple threads at once. Returns the server's response.
+    """
+    if encoding is None:
+        mode, options = "w", {}
+    elif encoding == "lzma":
+        mode, options = "w:xz", {"preset": compression.LEVELS["lzma"]}
+    else:
+        mode, options = "w:gz", {"compresslevel": compression.LEVELS["zlib"]}
+
+    buffer = io.BytesIO()
+    began = time.perf_counter()
+    size = 0
+    # PAX keeps the exact (sub-second) mtime of every file.
+    with tarfile.open(fileobj=buffer, mode=mode, format=tarfile.PAX_FORMAT, **options) as tar:
+        for file, remote in files:
+            info = tar.gettarinfo(file, arcname=remote.removeprefix(top_dir + "/"))
+            with open(file, "rb") as f:
+                tar.addfile(info, f)
+            size += info.size
+    if encoding is not None:
+        # Reading the files is counted too, since it happens as they are compressed.
+        stats.add("compress", time.perf_counter() - began, size)
+    buffer.seek(0)
+
+    return session.post(BASE_URL+"fs/putbatch", params={**auth_params(config), "dirfr": top_dir}, files={'file': ("batch.tar", buffer, "application/x-tar")})
+
+def get_server_info(session: requests.Session) -> dict:
+    """
+    Ask the server how it stores files.
+
+    Servers that can't say are treated as plain mirrors.
+    """
+    try:
+        r = session.get(BASE_URL+"info")
+    except requests.ConnectionError:
+        r = None
+    if r is None or r.status_code != 200:
+        return {"store": "mirror"}
+    info = r.json()
+
+    # Chunks only deduplicate if both sides cut them in the same places.
+    if info.get("store") == "chunk" and info.get("chunking") != {"min": chunker.MIN_SIZE, "max": chunker.MAX_SIZE, "anchor": chunker.ANCHOR,
+                                                                "window": chunker.WINDOW, "bits": chunker.BOUNDARY_BITS}:
+        print("WARNING: The server chunks files differently. Sending whole files instead.")
+        info["store"] = "mirror"
+
+    # Pick how uploads are compressed. (see --compress)
+    codecs = [codec for codec in compression.CODECS if codec in info.get("compression", [])]
+    if args.compress == "auto":
+        # lzma is only worth its time on a slow link, so it is never picked on its own.
+        info["encoding"] = next((codec for codec in codecs if codec != "lzma"), None)
+    elif args.compress == "none":
+        info["encoding"] = None
+    elif args.compress in codecs:
+        info["encoding"] = args.compress
+    else:
+        print(f"WARNING: {args.compress} compression is not available on both sides. Sending files as they are.")
+        info["encoding"] = None
+    return info
+
+def upload_chunked(session: requests.Session, config: dict, file: str, remote: str, st: os.stat_result, digest: str,
+                   encoding: str | None = None) -> requests.Response:
+    """
+    Upload a file to a server using the chunk store.
+
+    The file is cut into chunks, and only the chunks the server does not already have are sent (compressed with
+    `encoding`, where that helps). A file that moved, or that another machine already uploaded, costs almost nothing.
+
+    Safe to call from multiple threads at once. Returns the server's response.
+    """
+    auth = auth_params(config)
+    codec = file_codec(encoding, file)
+
+    # (offset, length, hash) of every chunk.
+    chunks = []
+    size = 0
+    with open(file, "rb") as f:
+        for data in chunker.iter_chunks(f):
+            chunks.append((size, len(data), chunker.hash_chunk(data)))
+            size += len(data)
+
+        r = session.post(BASE_URL+"chunks/missing", params=auth, json={"chunks": [h for offset, length, h in chunks]})
+        if r.status_code != 200:
+            return r
+        missing = set(r.json()["missing"])
+
+        for offset, length, h in chunks:
+            if h not in missing:
+                continue
+            f.seek(offset)
+            data, headers = compress_body(codec, f.read(length))
+            r = session.put(BASE_URL+f"chunks/{h}", params=auth, data=data, headers=headers)
+            if r.status_code != 200:
+                return r
+            # The same chunk can show up more than once in a file.
+            missing.discard(h)
+
+    return session.post(BASE_URL+"fs/commit", params=auth, json={"path": remote, "size": size, "hash": digest, "mtime": st.st_mtime,
+                                                                   "chunks": [h for offset, length, h in chunks]})
+
+def upload_delta(session: requests.Session, config: dict, file: str, remote: str, st: os.stat_result, digest: str,
+                 encoding: str | None = None) -> requests.Response:
+    """
+    Upload a new version of a file the server already has, sending only the parts that changed. (see delta)
+    The delta is compressed with `encoding`, if the file is worth compressing.
+
+    If the server has no copy to start from (or it changed in the meantime), the whole file is sent instead.
+    Only for servers with the "delta" feature. (see get_server_info)
+
+    Safe to call from multiple threads at once. Returns the server's response.
+    """
+    auth = auth_params(config)
+    r = session.get(BASE_URL+"fs/signature", params={**auth, "path": remote})
+    if r.status_code == 200:
+        signature = r.json()
+        codec = file_codec(encoding, file)
+        headers = {"Content-Type": "application/octet-stream"}
+        if codec is not None:
+            headers["Content-Encoding"] = codec
+        with open(file, "rb") as f:
+            body = delta.encode(f, signature["blocks"])
+            r = session.put(BASE_URL+"fs/delta", params={**auth, "path": remote, "base": signature["hash"], "hash": digest, "mtime": st.st_mtime,
+                                                                "size": st.st_size},
+                            data=CountedBody(body if codec is None else compressed(body, codec)), headers=headers)
+        # 409 means the server's copy changed since the signature was made.
+        if r.status_code != 409:
+            return r
+
+    if st.st_size >= SESSION_THRESHOLD:
+        return upload_session(session, config, file, remote, st, digest, encoding)
+    return upload_stream(session, config, file, remote, st, digest, encoding)
+
+def saved_session(remote: str, entry: dict | None = ...) -> dict | None:
+    """
+    Get (or set, if `entry` is given) the open upload session for a remote path.
+
+    Sessions are kept in SESSIONS_PATH so they survive the client being closed. Set `entry` to None to forget one.
+    """
+    with sessions_lock:
+        try:
+            with open(SESSIONS_PATH, "r") as f:
+                sessions = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            sessions = {}
+
+        if entry is ...:
+            return sessions.get(remote)
+
+        if entry is None:
+            sessions.pop(remote, None)
+        else:
+            sessions[remote] = entry
+        with open(SESSIONS_PATH, "w") as f:
+            json.dump(sessions, f, indent=2)
+        return entry
+
+def upload_session(session: requests.Session, config: dict, file: str, remote: str, st: os.stat_result, digest: str,
+                   encoding: str | None = None) -> requests.Response:
+    """
+    Upload a large file through a resumable upload session.
+
+    The file is sent in SESSION_PIECE sized pieces, SESSION_INFLIGHT at a time, each compressed with `encoding` if
+    that helps. If an earlier run was interrupted while uploading the same version of this file, only the missing
+    pieces are sent.
+
+    Safe to call from multiple threads at once. Returns the server's response.
+    """
+    auth = auth_params(config)
+
+    # Resume the last session for this file, as long as the file hasn't changed since.
+    info = None
+    saved = saved_session(remote)
+    if saved and (saved["size"], saved["mtime"], saved["hash"]) == (st.st_size, st.st_mtime, digest):
+        r = session.get(BASE_URL+f"fs/session/{saved["id"]}", params=auth)
+        if r.status_code == 200:
+            info = r.json()
+
+    if info is None:
+        r = session.post(BASE_URL+"fs/session", params={**auth, "path": remote, "size": st.st_size, "hash": digest, "mtime": st.st_mtime})
+        if r.status_code != 200:
+            return r
+        info = r.json()
+        saved_session(remote, {"id": info["id"], "size": st.st_size, "mtime": st.st_mtime, "hash": digest})
+
+    # Only send the pieces the server doesn't have yet.
+    pieces = []
+    for offset in range(0, st.st_size, SESSION_PIECE):
+        end = min(offset + SESSION_PIECE, st.st_size)
+        if not any(start <= offset and end <= stop for start, stop in info["ranges"]):
+            pieces.append(offset)
+
+    codec = file_codec(encoding, file)
+
+    def send(offset: int) -> requests.Response:
+        with open(file, "rb") as f:
+            f.seek(offset)
+            data, headers = compress_body(codec, f.read(SESSION_PIECE))
+        return session.put(BASE_URL+f"fs/session/{info["id"]}", params={**auth, "offset": offset}, data=data, headers=headers)
+
+    with ThreadPoolExecutor(SESSION_INFLIGHT) as pool:
+        for r in pool.map(send, pieces):
+            if r.status_code != 200:
+                return r
+
+    r = session.post(BASE_URL+f"fs/session/{info["id"]}/commit", params=auth)
+    # 422 means the data didn't match, and the server threw the session away.
+    if r.status_code in (200, 404, 422):
+        saved_session(remote, None)
+    return r
+
+def restore_file(session: requests.Session, config: dict, remote: str, meta: dict, local: str, snapshot: str | None = None) -> bool:
+    """
+    Download a backed up file to `local`.
+
+    The file is written to `local + PART_SUFFIX` first, and only moved into place once it is complete and matches
+    its hash. If a part file is already there (ex. an earlier restore was interrupted), only the rest is downloaded.
+
+    Safe to call from multiple threads at once. Returns True if the file was restored.
+    """
+    part = local + PART_SUFFIX
+    os.makedirs(os.path.dirname(local) or ".", exist_ok=True)
+
+    # Resume only if the server still has the same file. (If-Range makes it send everything otherwise)
+    headers = {}
+    h = hashlib.new(HASH_NAME)
+    offset = os.path.getsize(part) if os.path.exists(part) and meta.get("hash") else 0
+    if offset > meta.get("size", offset):
+        # Can't be the same file.
+        offset = 0
+    if offset:
+        with open(part, "rb") as f:
+            while contents := f.read(1024 * 1024):
+                h.update(contents)
+        headers = {"Range": f"bytes={offset}-", "If-Range": f'"{meta["hash"]}"'}
+
+    params = {**auth_params(config), "path": remote}
+    if snapshot:
+        params["snapshot"] = snapshot
+    # A part file that is already complete (ex. interrupted right before being moved into place) only needs checking.
+    while not offset or offset != meta.get("size"):
+        with session.get(BASE_URL+"fs/file", params=params, headers=headers, stream=True) as r:
+            if r.status_code == 416 and offset:
+                # The server doesn't agree with the part file. Start over.
+                os.remove(part)
+                offset, headers, h = 0, {}, hashlib.new(HASH_NAME)
+                continue
+            if r.status_code == 200:
+                # Starting over.
+                h = hashlib.new(HASH_NAME)
+                mode = "wb"
+            elif r.status_code == 206:
+                mode = "ab"
+            else:
+                return False
+
+            with open(part, mode) as f:
+                for contents in r.iter_content(1024 * 1024):
+                    f.write(contents)
+                    h.update(contents)
+        break
+
+    if meta.get("hash") and h.hexdigest() != meta["hash"]:
+        os.remove(part)
+        return False
+
+    if meta.get("mtime") is not None:
+        os.utime(part, (meta["mtime"], meta["mtime"]))
+    os.replace(part, local)
+    return True
+
+def walk_files(folder: str) -> Iterator[os.DirEntry]:
+    """
+    Yields every file inside a folder, and all of its sub-folders, as it is found.
+
+    Uses os.scandir, so on most systems the file's stat comes along with it for free.
+    """
+    folders = [folder]
+    while folders:
+        try:
+            entries = os.scandir(folders.pop())
+        except OSError:
+            # Unreadable (or already removed) folders are skipped, like os.walk does.
+            continue
+        with entries:
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        folders.append(entry.path)
+                    elif entry.is_file():
+                        yield entry
+                except OSError:
+                    continue
+
+def sync_files(session: requests.Session, server_info: dict, config: dict, index: FileIndex, hasher: Hasher, journal: Journal,
+               upload_path: str, top_dir: str, files: Iterable[str | os.DirEntry], full_scan: bool = False) -> tuple[list[dict], int]:
+    """
+    Upload the files (all inside `upload_path`) that changed since the last backup.
+
+    Every file is recorded in `journal` as soon as it is done (or failed). Uploads that fail because the server or
+    network had a problem are tried again, backing off a little longer each time.
+
+    This is a pipeline: a background thread goes through `files` (checking, hashing and asking the server about them)
+    and starts uploads as soon as it has something to send, while this thread handles the results. Uploading
+    starts right away, even if `files` is a scan that takes minutes to finish.
+
+    If `files` is everything in `upload_path` (`full_scan`), hashes of files that are no longer there are forgotten.
+
+    Returns the upload jobs (one per file that was sent), and how many files were skipped because they were unchanged.
+    """
+    jobs = []
+    skipped = 0
+
+    # Results for this thread: ("skip", file, remote, st, digest), ("fail", file, remote), ("done", future, [(file, remote, st, digest)...]),
+    # or ("end", number of uploads started). Only this thread touches the index, jobs and the screen.
+    results = queue.Queue()
+    # Keeps the scan from running too far ahead of the uploads.
+    in_flight = threading.Semaphore(args.jobs * 4)
+    stop = threading.Event()
+
+    def timed(task: list[tuple[str, str, os.stat_result, str]], upload: Callable, *params) -> requests.Response:
+        for attempt in range(RETRY_ATTEMPTS + 1):
+            # With --adaptive, wait for a free slot first. Time spent waiting doesn't count towards the upload.
+            with upload_limit or contextlib.nullcontext():
+                token = config.get("token")
+                began = time.perf_counter()
+                try:
+                    r, error = upload(*params), None
+                except requests.RequestException as e:
+                    # Couldn't reach the server, or the connection dropped. (anything else is raised as is)
+                    r, error = None, e
+                finally:
+                    stats.upload([(file, st.st_size) for file, remote, st, digest in task], time.perf_counter() - began)
+
+            if r is not None and r.status_code == 401 and attempt < RETRY_ATTEMPTS and renew_token(config, token):
+                # Logged in again (ex. the server restarted). No need to wait.
+                stats.retry("login")
+                continue
+
+            reason = "connection" if r is None else str(r.status_code) if r.status_code in RETRY_STATUS else None
+            if reason is None or attempt == RETRY_ATTEMPTS:
+                break
+            stats.retry(reason)
+            # If the run is cancelled in the meantime, the last attempt is what counts.
+            if stop.wait(backoff(attempt, RETRY_BASE_DELAY, RETRY_MAX_DELAY, r.headers.get("retry-after") if r is not None else None)):
+                break
+
+        if error is not None:
+            raise error
+        return r
+
+    def start(pool: ThreadPoolExecutor, bar: ProgressBar, task: list[tuple[str, str, os.stat_result, str]]) -> None:
+        in_flight.acquire()
+        bar.add(len(task), sum(st.st_size for file, remote, st, digest in task))
+
+        encoding = server_info.get("encoding")
+        if len(task) > 1:
+            # Batches are either all worth compressing or none of them are. (see send)
+            encoding = encoding if compression.worth_compressing(task[0][0]) else None
+            future = pool.submit(timed, task, upload_batch, session, config, top_dir, [(file, remote) for file, remote, st, digest in task], encoding)
+        else:
+            file, remote, st, digest = task[0]
+            if server_info["store"] == "chunk":
+                future = pool.submit(timed, task, upload_chunked, session, config, file, remote, st, digest, encoding)
+            elif "delta" in server_info.get("features", []) and st.st_size >= DELTA_THRESHOLD and index.get(remote):
+                # Uploaded before, so the server most likely has an older version to send the changes against.
+                future = pool.submit(timed, task, upload_delta, session, config, file, remote, st, digest, encoding)
+            elif st.st_size >= SESSION_THRESHOLD:
+                future = pool.submit(timed, task, upload_session, session, config, file, remote, st, digest, encoding)
+            elif "stream" in server_info.get("features", []):
+                future = pool.submit(timed, task, upload_stream, session, config, file, remote, st, digest, encoding)
+            else:
+                future = pool.submit(timed, task, upload_file, session, config, file, remote, st)
+        future.add_done_callback(lambda future: results.put(("done", future, task)))
+
+    def produce(pool: ThreadPoolExecutor, bar: ProgressBar) -> None:
+        started = 0
+        scanned = False
+        # Hashed files waiting to be checked with the server.
+        checking, checking_since = [], 0.0
+        # Small files waiting to fill a batch. Files worth compressing are batched apart from the rest, so
+        # photos and archives aren't compressed again just because they share a batch with text files.
+        batches: dict[bool, list] = {True: [], False: []}
+        batch_sizes = {True: 0, False: 0}
+
+        def send(file: str, remote: str, st: os.stat_result, digest: str) -> None:
+            nonlocal started
+            # Small files are grouped into batches, so they share one request and one manifest update.
+            if st.st_size >= BATCH_FILE_SIZE:
+                start(pool, bar, [(file, remote, st, digest)])
+                started += 1
+                return
+
+            kind = server_info.get("encoding") is not None and compression.worth_compressing(file)
+            if batches[kind] and (len(batches[kind]) >= BATCH_MAX_FILES or batch_sizes[kind] + st.st_size > BATCH_MAX_BYTES):
+                start(pool, bar, batches[kind])
+                started += 1
+                batches[kind], batch_sizes[kind] = [], 0
+            batches[kind].append((file, remote, st, digest))
+            batch_sizes[kind] += st.st_size
+
+        def check() -> None:
+            nonlocal checking
+            # Ask the server which of these files it already has. (Ex. a fresh machine with a partly synced tree)
+            missing = find_missing(session, config, [(remote, digest) for file, remote, st, digest in checking])
+            for file, remote, st, digest in checking:
+                if remote in missing:
+                    send(file, remote, st, digest)
+                else:
+                    results.put(("skip", file, remote, st, digest))
+            checking = []
+
+        def changed() -> Iterator[tuple[tuple[str, str, os.stat_result], str, os.stat_result]]:
+            # The files that need hashing.
+            for entry in stats.timeIter("scan", files):
+                if stop.is_set():
+                    return
+
+                file = entry if isinstance(entry, str) else entry.path
+                remote = remote_path(file, upload_path, top_dir)
+                try:
+                    with stats.phase("stat"):
+                        st = entry.stat() if isinstance(entry, os.DirEntry) else os.stat(file)
+                except FileNotFoundError:
+                    # Removed since it was found.
+                    continue
+                except OSError:
+                    results.put(("fail", file, remote))
+                    continue
+
+                # Cheap check first. Anything that was only touched is skipped after hashing.
+                if not args.force and index.isUnchanged(remote, st):
+                    results.put(("skip", file, remote, None, None))
                     continue
-                elif i != size:
-                    print(f"{indent}    ├── {subcontents}")
+                yield (file, remote, st), file, st
+
+        try:
+            for (file, remote, st), digest in hasher.imap(changed()):
+                if stop.is_set():
+                    return
+                if isinstance(digest, FileNotFoundError):
+                    continue
+                if isinstance(digest, OSError):
+                    results.put(("fail", file, remote))
+                    continue
+
+                known = index.get(remote)
+                if not args.force and known and known["hash"] == digest:
+                    results.put(("skip", file, remote, st, digest))
+                elif args.force:
+                    send(file, remote, st, digest)
                 else:
-                    print(f"{indent}    └── {subcontents}")
+                    if not checking:
+                        checking_since = time.monotonic()
+                    checking.append((file, remote, st, digest))
+                    # Check in big groups, but don't hold uploads back for long while a slow scan continues.
+                    if len(checking) >= CHECK_BATCH or time.monotonic() - checking_since > CHECK_DELAY:
+                        check()
+
+            if checking:
+                check()
+            for batch in batches.values():
+                if batch:
+                    start(pool, bar, batch)
+                    started += 1
+            scanned = True
+        finally:
+            # The hash cache is only used by this thread, so it is saved here.
+            try:
+                with stats.phase("index"):
+                    hasher.save(prune=full_scan and scanned)
+            finally:
+                results.put(("end", started))
+
+    try:
+        with ProgressBar(0, "Uploading...") as bar, ThreadPoolExecutor(args.jobs) as pool:
+            producer = threading.Thread(target=produce, args=(pool, bar), daemon=True)
+            producer.start()
+            if upload_limit is not None:
+                threading.Thread(target=probe_latency, args=(stop,), daemon=True).start()
+
+            # Results are handled here, on the main thread, so printing and the index stay in order.
+            started, finished = None, 0
+            while started is None or finished < started:
+                result = results.get()
+
+                if result[0] == "end":
+                    started = result[1]
+                    continue
+
+                if result[0] == "skip":
+                    file, remote, st, digest = result[1:]
+                    if st is not None:
+                        index.update(remote, st, digest)
+                        journal.record(remote, "done", st, digest)
+                    skipped += 1
+                    continue
+
+                if result[0] == "fail":
+                    # Couldn't even be read.
+                    print(f"Uploading {result[1]}... FAILED")
+                    jobs.append({"job": len(jobs), "status": 0})
+                    journal.record(result[2], "failed", error="Could not read the file.")
+                    continue
+
+                future, task = result[1:]
+                finished += 1
+                in_flight.release()
+
+                try:
+                    r = future.result()
+                    error = None if r.status_code == 200 else f"HTTP {r.status_code}"
+                except OSError as e:
+                    r, error = None, str(e) or type(e).__name__
+
+                if r is not None and r.status_code == 404:
+                    print("FAILED: Unable to locate user backup storage.")
+                    stop.set()
+                    pool.shutdown(cancel_futures=True)
+                    sys.exit()
+
+                # Work out which files made it. Batches report every file they stored.
+                if r is None or r.status_code != 200:
+                    stored = set()
+                elif len(task) == 1:
+                    stored = {task[0][1]}
+                else:
+                    stored = set(r.json()["stored"])
+
+                for file, remote, st, digest in task:
+                    if remote in stored:
+                        print(f"Uploading {file}... OK!")
+                        jobs.append({"job": len(jobs), "status": 1})
+                        index.update(remote, st, digest)
+                        journal.record(remote, "done", st, digest)
+                    else:
+                        print(f"Uploading {file}... FAILED")
+                        jobs.append({"job": len(jobs), "status": 0})
+                        journal.record(remote, "failed", st, digest, error or "Rejected by the server.")
+                    bar.bar(st.st_size)
+    finally:
+        stop.set()
+        # Keep whatever was uploaded, even if the run was cut short. Once the index has it, the journal doesn't need to.
+        with stats.phase("index"):
+            index.save()
+            journal.checkpoint()
+
+    return jobs, skipped
+
+def summary_counts(jobs: list[dict], skipped: int) -> dict:
+    """
+    Count up how the upload jobs went.
+    """
+    success = 0
+    failed = 0
+    total = skipped
+
+    for job in jobs:
+        if job["status"] == 1:
+            success += 1
+        elif job["status"] == 0:
+            failed += 1
+        total += 1
+
+    return {"finished": success, "unchanged": skipped, "failed": failed, "total": total}
+
+def print_summary(jobs: list[dict], skipped: int) -> None:
+    counts = summary_counts(jobs, skipped)
+    print(f"\nFinished uploading: {counts["finished"]} finished | {counts["unchanged"]} unchanged | {counts["failed"]} failed | {counts["total"]} total")
+
+def take_snapshot(config: dict, label: str) -> None:
+    """
+    Snapshot everything the server has for the user right now.
+    """
+    print("Taking snapshot...", end=" ")
+    sys.stdout.flush()
+    try:
+        r = requests.post(BASE_URL+"fs/snapshots", params={**auth_params(config), "label": label})
+    except requests.ConnectionError:
+        print("FAILED: Could not reach the server.")
+        return
+
+    if r.status_code == 404 and r.json().get("detail") == "Not Found":
+        print("FAILED: This server does not support snapshots.")
+    elif r.status_code != 200:
+        print(f"FAILED: ({r.json()["detail"]})")
+    else:
+        data = r.json()
+        print(f"OK! ({data["snapshot"]["id"]})")
+        if data["pruned"]:
+            print(f"Removed {len(data["pruned"])} old snapshot(s): {", ".join(data["pruned"])}")
+
+def write_stats(mode: str, **results) -> None:
+    """
+    Show the run's timings (--stats) and/or write them to the report file (--report).
+    """
+    extra = {"concurrency": upload_limit.report()} if upload_limit is not None and mode != "restore" else {}
+    if args.stats:
+        print()
+        print(stats.summary())
+        if extra:
+            concurrency = extra["concurrency"]
+            decreases = ", ".join(f"{reason} {times}" for reason, times in concurrency["decreases"].items()) or "none"
+            print(f"  uploads at once: ended at {concurrency['limit']}, peaked at {concurrency['peak']} (of {concurrency['maximum']}), cut back for: {decreases}")
+    if args.report:
+        report = stats.report(version=VERSION, server=BASE_URL, mode=mode, path=args.path, jobs=args.jobs, results=results, **extra)
+        with open(args.report, "w") as f:
+            json.dump(report, f, indent=2)
+
+def make_hasher() -> Hasher:
+    """
+    A Hasher using --hash-workers threads and the hash cache. Time spent hashing counts towards the "hash" phase.
+    """
+    return Hasher(args.hash_workers, HashCache(HASH_CACHE_PATH), lambda seconds, size: stats.add("hash", seconds, size))
+
+def remote_path(file: str, upload_path: str, top_dir: str) -> str:
+    """
+    Work out where a local file inside `upload_path` will be stored on the server.
+
+    ex. `/home/me/Documents/a/b.txt` -> `Documents/a/b.txt`
+    """
+    rel = os.path.relpath(file, upload_path).replace("\\", "/")
+    return f"{top_dir}/{rel}"
 
 def cls():
     os.system('cls' if os.name=='nt' else 'clear')
@@ -185,20 +1149,45 @@ if args.version:
     print(f"YourBackupTool {VERSION}")
     sys.exit(0)
 
-if args.get:
+if args.snapshots:
     print("Checking server...", end=" ")
     makeAPIRequest()
 
     print("Checking user...", end=" ")
     config = authorizeUser()
 
-    print("Fetching file manifest...", end=" ")
-    manifest = makeAPIRequest(f"fs/getmanifest?usr={config["username"]}&psw={config["password"]}")
+    r = requests.get(BASE_URL+"fs/snapshots", params=auth_params(config))
+    if r.status_code != 200:
+        print(f"FAILED: Could not list snapshots. ({r.json()["detail"]})")
+        sys.exit(1)
+
+    snapshots = r.json()["snapshots"]
+    if not snapshots:
+        print("\nNo snapshots yet. Take one with --snapshot.")
+    else:
+        print(f"\n{"ID":<20} {"Created":<20} {"Files":>8} {"Size":>12}  Label")
+        for info in snapshots:
+            created = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(info["created"]))
+            print(f"{info["id"]:<20} {created:<20} {info["files"]:>8} {info["bytes"] / 1024 / 1024:>9.1f} MB  {info["label"]}")
+    sys.exit(0)
+
+if args.get is not None:
+    print("Checking server...", end=" ")
+    makeAPIRequest()
+
+    print("Checking user...", end=" ")
+    config = authorizeUser()
 
-    print("\n\n= = Current Backup Storage Contents ==")
+    get_path = args.get.replace("\\", "/").strip("/")
+    if args.at:
+        print(f"\n\n= = Backup Storage Contents (snapshot {args.at}) ==")
+    else:
+        print("\n\n= = Current Backup Storage Contents ==")
 
-    # Print the manifest in tree form.
-    print_tree(manifest)
+    # Print the manifest in tree form, fetching each folder as the tree gets to it.
+    with requests.Session() as session:
+        fetch = lambda path: iter_folder(session, config, path, args.at)
+        print_tree(get_path or "root", fetch(get_path), fetch)
     # pprint(manifest, sort_dicts=True, indent=2)
 
     sys.exit(0)
@@ -253,9 +1242,99 @@ if not args.path:
     print("Please supply a path!")
     sys.exit(1)
 
+if args.jobs < 1:
+    print("--jobs must be at least 1!")
+    sys.exit(1)
+
 # Force the path formatting.
 args.path = os.path.abspath(args.path)
 
+if args.restore is not None:
+    restore_path = args.restore.replace("\\", "/").strip("/")
+    print(f"YBT will now restore '{restore_path or "root"}' into '{args.path}'")
+
+    print("Checking server...", end=" ")
+    makeAPIRequest()
+
+    print("Checking user...", end=" ")
+    config = authorizeUser()
+
+    session = make_session(args.jobs)
+    print("Fetching file manifest...", end=" ")
+    sys.stdout.flush()
+    remote_files = dict(iter_remote_files(session, config, restore_path, args.at))
+    print("OK!")
+
+    # Everything inside the chosen folder (or just the chosen file).
+    to_restore = {}
+    skipped = 0
+    # Local files that might already match, and the hasher to check them with.
+    compare = []
+    hasher = make_hasher()
+    for remote, meta in remote_files.items():
+        if restore_path and remote != restore_path and not remote.startswith(restore_path + "/"):
+            continue
+
+        # Never write outside of the chosen folder, whatever the server says.
+        parts = remote.split("/")
+        if ".." in parts or "" in parts:
+            continue
+        local = os.path.join(args.path, *parts)
+
+        # Skip files that are already the same locally.
+        if os.path.isfile(local) and meta.get("hash"):
+            st = os.stat(local)
+            if st.st_size == meta.get("size") and st.st_mtime == meta.get("mtime"):
+                skipped += 1
+                continue
+            if st.st_size == meta.get("size"):
+                # Only touched, maybe. Hashed below, all at once.
+                compare.append(((remote, meta, local), local, st))
+                continue
+        to_restore[remote] = (meta, local)
+
+    for (remote, meta, local), digest in hasher.imap(compare):
+        if digest == meta["hash"]:
+            skipped += 1
+        else:
+            to_restore[remote] = (meta, local)
+    hasher.save()
+
+    if not to_restore and not skipped:
+        print("FAILED: Nothing to restore there!")
+        sys.exit(1)
+
+    success = 0
+    failed = 0
+    try:
+        # The ProgressBar cannot show an empty list.
+        if to_restore:
+            with ProgressBar(0, "Restoring...") as bar, ThreadPoolExecutor(args.jobs) as pool:
+                bar.add(len(to_restore), sum(meta.get("size", 0) for meta, local in to_restore.values()))
+                futures = {pool.submit(restore_file, session, config, remote, meta, local, args.at): remote
+                           for remote, (meta, local) in to_restore.items()}
+
+                for future in as_completed(futures):
+                    remote = futures[future]
+                    try:
+                        ok = future.result()
+                    except (OSError, requests.RequestException):
+                        ok = False
+
+                    if ok:
+                        print(f"Restoring {remote}... OK!")
+                        success += 1
+                    else:
+                        print(f"Restoring {remote}... FAILED")
+                        failed += 1
+                    bar.bar(to_restore[remote][0].get("size", 0))
+    finally:
+        session.close()
+
+    print(f"\nFinished restoring: {success} restored | {skipped} unchanged | {failed} failed | {success + skipped + failed} total")
+    write_stats("restore", restored=success, unchanged=skipped, failed=failed)
+    sys.exit(0)
+
 upload_path = args.path.replace("\\", "/")
 endpath = upload_path.split("/")[-1]
 
@@ -268,6 +1347,9 @@ if not os.path.exists(upload_path):
 elif regex:
     print(f"FAILED: Path violates the following rule(s): {", ".join(regex)}")
     sys.exit(1)
+elif args.watch and not os.path.isdir(upload_path):
+    print("FAILED: --watch only works with folders!")
+    sys.exit(1)
 
 print("OK!")
 
@@ -286,21 +1368,43 @@ print(f"\nYBT will now upload '{endpath}'")
 
 # Begin the upload procedure.
 jobs = []
+# Files that did not need uploading because the server already has them.
+skipped = 0
 if os.path.isfile(upload_path):
     print("\npath is file... entering single upload mode.")
     print(f"Uploading {upload_path}...", end=" ")
     sys.stdout.flush()
     jobs.append({"job": 1, "status": -1})
 
-    file = {'file': open(upload_path, 'rb')}
-
     if args.top:
         args.top = args.top.replace("\\", "/")
         dirfr = args.top.removeprefix("/")
     else:
         dirfr = ""
 
-    r = requests.post(BASE_URL+f"fs/put?usr={config["username"]}&psw={config["password"]}&dirfr={dirfr}", files=file)
+    st = os.stat(upload_path)
+    remote = "/".join(filter(None, [dirfr, os.path.basename(upload_path)]))
+    with make_session(SESSION_INFLIGHT) as session:
+        server_info = get_server_info(session)
+        began = time.perf_counter()
+        send_delta = "delta" in server_info.get("features", []) and st.st_size >= DELTA_THRESHOLD
+        if send_delta or st.st_size >= SESSION_THRESHOLD:
+            hasher = make_hasher()
+            digest = hasher.hash(upload_path, st)
+            hasher.save()
+
+        if send_delta:
+            # If the server has an older version, only what changed is sent.
+            r = upload_delta(session, config, upload_path, remote, st, digest, server_info.get("encoding"))
+        elif st.st_size >= SESSION_THRESHOLD:
+            # Large files go through a resumable upload session.
+            r = upload_session(session, config, upload_path, remote, st, digest, server_info.get("encoding"))
+        elif "stream" in server_info.get("features", []):
+            r = upload_stream(session, config, upload_path, remote, st, encoding=server_info.get("encoding"))
+        else:
+            with open(upload_path, 'rb') as f:
+                r = session.post(BASE_URL+"fs/put", params={**auth_params(config), "dirfr": dirfr, "mtime": st.st_mtime}, files={'file': f})
+        stats.upload([(upload_path, st.st_size)], time.perf_counter() - began)
     if r.status_code == 200:
         print("OK!")
         jobs[0]["status"] = 1
@@ -312,49 +1416,66 @@ if os.path.isfile(upload_path):
         jobs[0]["status"] = 0
 
 if os.path.isdir(upload_path):
-    path_files = []
     print("\npath is directory... entering multiple upload mode.")
-    
-    # Get EVERY file inside the directory.
-    for path, subdirs, files in os.walk(upload_path):
-        for name in files:
-            path_files.append(os.path.join(path, name))
 
     # Get the top directory to upload into.
     top_dir = upload_path.split("/")[-1]
 
-    with ProgressBar(path_files, "Uploading...") as bar:
-        for i, file in enumerate(path_files):
-            print(f"Uploading {file}...", end=" ")
-            sys.stdout.flush()
-    
-            # DirectoryFromRoot. This will place the file in subfolders instead of just in root.
-            dirfr: str = top_dir + "/" + os.path.dirname(file.split(upload_path)[1]).removeprefix("\\")
-            jobs.append({"job": i, "status": -1})
-    
-            file = {'file': open(file, 'rb')}
-            r = requests.post(BASE_URL+f"fs/put?usr={config["username"]}&psw={config["password"]}&dirfr={dirfr}", files=file)
-    
-            if r.status_code == 200:
-                print("OK!")
-                jobs[i]["status"] = 1
-            elif r.status_code == 404:
-                print(f"FAILED: Unable to locate user backup storage.")
-                sys.exit()
-            else:
-                print("FAILED")
-                jobs[i]["status"] = 0
-            bar.bar()
-
-success = 0
-failed = 0
-total = 0
-
-for job in jobs:
-    if job["status"] == 1:
-        success += 1
-    elif job["status"] == 0:
-        failed += 1
-    total += 1
-
-print(f"\nFinished uploading: {success} finished | {failed} failed | {total} total")
+    index = FileIndex(INDEX_PATH, BASE_URL, config["username"])
+    hasher = make_hasher()
+
+    # If the last upload of this folder was cut short, the journal has what it finished (even if the index doesn't).
+    journal = Journal(JOURNAL_PATH)
+    resumed = journal.open({"server": BASE_URL, "username": config["username"], "path": os.path.abspath(upload_path)}, args.resume)
+    if args.resume:
+        done = {remote: entry for remote, entry in resumed.items() if entry["status"] == "done"}
+        index.merge(done)
+        if resumed:
+            print(f"Resuming the last upload: {len(done)} file(s) were already done, {len(resumed) - len(done)} failed and will be tried again.")
+        else:
+            print("Nothing to resume. Uploading as usual.")
+
+    # All uploads share one pooled session, so connections are kept alive and reused.
+    session = make_session(args.jobs * SESSION_INFLIGHT)
+
+    # Servers using the chunk store only need the chunks they are missing.
+    server_info = get_server_info(session)
+
+    # Start watching before the first sync, so nothing that changes during it is missed.
+    watch = open_watcher(upload_path, WATCH_DEBOUNCE) if args.watch else None
+    try:
+        jobs, skipped = sync_files(session, server_info, config, index, hasher, journal, upload_path, top_dir, walk_files(upload_path), full_scan=True)
+
+        if watch is not None:
+            print_summary(jobs, skipped)
+            if args.snapshot is not None:
+                take_snapshot(config, args.snapshot)
+            write_stats("watch", **summary_counts(jobs, skipped))
+            print(f"\nWatching '{upload_path}' for changes. Press Ctrl+C to stop.")
+
+            # YBT's own files can live in the watched folder. Uploading them would only change them again.
+            ignored = {os.path.abspath(INDEX_PATH), os.path.abspath(HASH_CACHE_PATH), os.path.abspath(SESSIONS_PATH), os.path.abspath(JOURNAL_PATH)}
+            for changed in watch.changes():
+                if changed is None:
+                    # Too much changed at once to keep track of. The index makes a full pass cheap anyway.
+                    files = list(walk_files(upload_path))
+                else:
+                    files = sorted(file for file in changed if file not in ignored and not file.endswith(PART_SUFFIX) and os.path.isfile(file))
+                if not files:
+                    continue
+
+                print()
+                jobs, skipped = sync_files(session, server_info, config, index, hasher, journal, upload_path, top_dir, files, full_scan=changed is None)
+                print_summary(jobs, skipped)
+                # Timings add up over the whole watch.
+                write_stats("watch", **summary_counts(jobs, skipped))
+    finally:
+        session.close()
+        journal.close()
+        if watch is not None:
+            watch.close()
+
+print_summary(jobs, skipped)
+if args.snapshot is not None:
+    take_snapshot(config, args.snapshot)
+write_stats("upload", **summary_counts(jobs, skipped))
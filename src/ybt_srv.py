@@ -23,22 +23,121 @@ import json
 import uvicorn
 import logging
 import argparse
+import posixpath
+import threading
+import tarfile
 import hashlib
-from fastapi import FastAPI, HTTPException, File, UploadFile
+import time
+import queue
+import contextvars
+from typing import BinaryIO
+from fastapi import FastAPI, HTTPException, File, UploadFile, Body, Request
+from fastapi.responses import FileResponse, StreamingResponse, Response, JSONResponse
+from fastapi.concurrency import run_in_threadpool
+from starlette.requests import ClientDisconnect
+from pydantic import BaseModel
+
+import chunker
+import delta
+import compression
+from storage import MirrorStore, ChunkStore, PackStore, HASH_NAME
+from uploads import UploadSession
+from manifest import Manifest, ManifestFile, Folder
+from auth import Accounts, Tokens
+from genuid import generate_uid
+from metrics import REGISTRY, Counter, Gauge, Histogram
+from snapshots import SnapshotStore
 
 # Force YBT to run inside the src folder.
 os.chdir(os.path.dirname(__file__))
 
 parser = argparse.ArgumentParser()
 parser.add_argument("-t", "--test", action="store_true", help="Run in testing mode: Uvicorn Host will be set to localhost instead of 0.0.0.0 (port forward host).")
+parser.add_argument("--fs", default="./fs", help="Where to keep accounts and files (relative paths are from the src folder). Defaults to ./fs")
+parser.add_argument("--port", type=int, default=8000, help="Port to listen on. Defaults to 8000.")
+parser.add_argument("--timing-log", help="Append how long every request took (as JSON lines) to this file. Used by the benchmarks.")
+parser.add_argument("--keep-last", type=int, metavar="N", help="Snapshot retention: keep the newest N snapshots of each user.")
+parser.add_argument("--keep-daily", type=int, metavar="N", help="Snapshot retention: keep the newest snapshot of each of the last N days.")
+parser.add_argument("--keep-weekly", type=int, metavar="N", help="Snapshot retention: keep the newest snapshot of each of the last N weeks.")
+parser.add_argument("--keep-monthly", type=int, metavar="N", help="Snapshot retention: keep the newest snapshot of each of the last N months.")
+parser.add_argument("--store", choices=["mirror", "chunk", "pack"], default="mirror", help="How file contents are stored. mirror: plain files under fs/USERNAME (default). chunk: deduplicated chunks shared by every user. pack: like mirror, but small files are kept together in large pack files.")
+parser.add_argument("--compress-at-rest", choices=compression.CODECS, metavar="CODEC", help=f"Keep stored files compressed with CODEC ({', '.join(compression.CODECS)}). Files that don't compress well are kept as they are. Only for the mirror and pack stores.")
 args = parser.parse_args()
 
 # VARS #
 
-USR_MANIFEST = "./fs/manifest.json"
+FS_PATH = args.fs
+USR_MANIFEST = os.path.join(FS_PATH, "manifest.json")
+# Shared by every user when running with `--store chunk`.
+CHUNK_DIR = os.path.join(FS_PATH, ".chunks")
+
+# Login tokens expire after going unused for this long. (seconds)
+TOKEN_TTL = 60 * 60
+
+# Upload sessions that haven't been touched in this long are removed. (seconds)
+SESSION_MAX_AGE = 7 * 24 * 60 * 60
+# The largest piece a client can send to an upload session at once.
+SESSION_MAX_PIECE = 64 * 1024 * 1024
+
+# Streamed uploads are written to disk in pieces of about this size. (bytes)
+STREAM_BUFFER = 1024 * 1024
+# Temporary files left behind (ex. by a crash) are removed after this long. (seconds)
+TEMP_MAX_AGE = 24 * 60 * 60
+# Signatures of stored files (for delta uploads) are kept until they go unused for this long. (seconds)
+SIGNATURE_MAX_AGE = 7 * 24 * 60 * 60
+
+# Which snapshots to keep (see snapshots.retained). With no --keep-* options, every snapshot is kept.
+RETENTION = {"last": args.keep_last, "daily": args.keep_daily, "weekly": args.keep_weekly, "monthly": args.keep_monthly}
+# Unused chunks are only removed once they haven't been touched for this long, so uploads in progress keep theirs. (seconds)
+CHUNK_GRACE = 24 * 60 * 60
+# How often packs are checked for space to reclaim, with `--store pack`. (seconds)
+REPACK_INTERVAL = 60 * 60
+# getmanifest lists at most this many of a folder's entries at once.
+MANIFEST_PAGE = 1000
+# How often loaded manifests are checked for journals old enough to compact, so idle users' are too. (seconds)
+COMPACT_INTERVAL = 60
+
+# Time spent on the current request, by phase (ex. "manifest"). Reported in the Server-Timing header.
+request_timings: contextvars.ContextVar[dict[str, float] | None] = contextvars.ContextVar("request_timings", default=None)
+# Lines waiting to be appended to the `--timing-log` file, by timing_log_loop, so requests never wait on the disk.
+timing_lines: queue.SimpleQueue[str] = queue.SimpleQueue()
+
+def add_timing(name: str, seconds: float) -> None:
+    """
+    Count `seconds` towards the current request's `name` phase. Does nothing outside a request.
+    """
+    timings = request_timings.get()
+    if timings is not None:
+        timings[name] = timings.get(name, 0.0) + seconds
+
+# METRICS #
+
+REQUESTS = Counter("ybt_requests_total", "Requests served.", ["method", "route", "status"])
+REQUEST_TIME = Histogram("ybt_request_duration_seconds", "How long requests took, from arriving to the response being ready.", ["method", "route"])
+RECEIVED_BYTES = Counter("ybt_received_bytes_total", "Request body bytes received.", ["route"])
+UPLOADS_IN_FLIGHT = Gauge("ybt_uploads_in_flight", "Uploads being received right now.")
+AUTH_TIME = Histogram("ybt_auth_duration_seconds", "How long checking a password or token took.")
+WRITE_TIME = Histogram("ybt_storage_write_duration_seconds", "How long storing an uploaded file took.")
+MANIFEST_LOAD_TIME = Histogram("ybt_manifest_load_duration_seconds", "How long reading a manifest from disk took.")
+MANIFEST_DUMP_TIME = Histogram("ybt_manifest_dump_duration_seconds", "How long saving changes to a manifest took.")
+# Worked out when the metrics are read, for every user whose manifest is loaded.
+MANIFEST_FILES = Gauge("ybt_manifest_files", "Files in each user's manifest.", ["user"],
+                       function=lambda: {(name,): len(mf.manifest) for name, mf in FileSystem.loadedManifests().items()}) # type: ignore
+MANIFEST_BYTES = Gauge("ybt_manifest_bytes", "Size of each user's manifest on disk (snapshot and journal).", ["user"],
+                       function=lambda: {(name,): mf.size for name, mf in FileSystem.loadedManifests().items()})
+
+# Requests that carry an upload, by method. Paths ending in "/" also match anything under them.
+UPLOAD_PATHS = {
+    "POST": ("/api/fs/put", "/api/fs/putbatch"),
+    "PUT": ("/api/fs/file", "/api/fs/delta", "/api/chunks/", "/api/fs/session/"),
+}
 
 # CLASSES #
 
+# Loaded once, and kept in memory.
+accounts = Accounts(USR_MANIFEST)
+tokens = Tokens(TOKEN_TTL)
+
 class User():
     """
     User class.
@@ -46,33 +145,35 @@ class User():
     Contains a FileSystem object for organized file management.
 
     Calls the authUser() method on creation, but this can be used again. 
+
+    A login token (see /api/users/login) can be given instead of the password.
     """
-    def __init__(self, username: str, password: str) -> None:
+    def __init__(self, username: str, password: str | None = None, token: str | None = None) -> None:
         self.name = username
         self.password = password
         self.fs = FileSystem(self)
 
         # Authorize the user.
-        if not self.authUser(username, password):
+        start = time.perf_counter()
+        authed = self.authUser(username, password, token)
+        AUTH_TIME.observe(time.perf_counter() - start)
+        add_timing("auth", time.perf_counter() - start)
+        if not authed:
             raise PermissionError("User failed to auth.")
 
-    def authUser(self, usr: str, psw: str):
+    def authUser(self, usr: str, psw: str | None = None, token: str | None = None):
         """
         Authorize the user.
 
-        Returns True if the username and password is correct.
+        Returns True if the username and password (or token) is correct.
 
         Returns False if the user cannot be found or has an invalid password.
         """
-        with open(USR_MANIFEST, "r") as f:
-            manifest = json.load(f)
-
-        psw = hashlib.sha384(psw.encode()).hexdigest()
-
-        for user in manifest["users"]:
-            if user["password"] == psw and user["username"] == usr:
-                return True
-        return False
+        if token is not None:
+            return tokens.resolve(token) == usr
+        if psw is None:
+            return False
+        return accounts.check(usr, psw)
 
 
 class FileSystem():
@@ -85,96 +186,525 @@ class FileSystem():
 
     All read/write requests should be made from here.
     """
+    # One manifest lock per user, shared by every FileSystem made for them.
+    __locks: dict[str, threading.Lock] = {}
+    __locks_lock = threading.Lock()
+    # Loaded manifests, by user. Kept between requests so they are only read from disk once.
+    __manifests: dict[str, ManifestFile] = {}
+
     def __init__(self, user: User) -> None:
         # Internal user variable. Not meant to be accessed from outside.
         self.__user = user
 
-        self.__BASE_PATH = f"./fs/{self.__user.name}"
-        self.__man_path = os.path.join(self.__BASE_PATH, f"manifest.json")
-        pass
+        self.__BASE_PATH = os.path.join(FS_PATH, self.__user.name)
+
+        # Server-only data for this user. Uploads can never be placed in here.
+        self.dataPath = os.path.join(self.__BASE_PATH, ".ybt")
+        self.uploadsPath = os.path.join(self.dataPath, "uploads")
+        self.tempPath = os.path.join(self.dataPath, "tmp")
+        self.signaturesPath = os.path.join(self.dataPath, "signatures")
+
+        # Where the contents of the user's files actually go.
+        if args.store == "chunk":
+            self.store = ChunkStore(self.__BASE_PATH, CHUNK_DIR)
+        elif args.store == "pack":
+            self.store = PackStore(self.__BASE_PATH, args.compress_at_rest)
+        else:
+            self.store = MirrorStore(self.__BASE_PATH, args.compress_at_rest)
+        self.snapshots = SnapshotStore(os.path.join(self.dataPath, "snapshots"), self.store)
 
     class NoSuchUser(BaseException):
         def __init__(self, *args: object) -> None:
             super().__init__(*args)
 
-    def loadManifest(self) -> dict:
+    def lock(self) -> threading.Lock:
+        """
+        Returns the lock guarding this user's manifest.
+
+        Hold it while using the manifest, since uploads can run in parallel and the loaded manifest is shared.
+        """
+        return FileSystem.userLock(self.__user.name)
+
+    @staticmethod
+    def userLock(name: str) -> threading.Lock:
+        """
+        Same as lock, for any user by name.
+        """
+        with FileSystem.__locks_lock:
+            return FileSystem.__locks.setdefault(name, threading.Lock())
+
+    def resolvePath(self, dirfr: str, filename: str) -> str:
+        """
+        Join DirFR and a file name into a clean path from root. (ex. `docs/notes/a.txt`)
+
+        Raises ValueError if the path would end up outside of the user's folder, or inside the server's `.ybt` folder.
+        """
+        # To prevent weird bugs, replace all backslashes with slashes.
+        dirfr = dirfr.replace("\\", "/").removeprefix("/")
+        filename = filename.replace("\\", "/")
+
+        # path.join doesn't work with a leading slash.
+        if dirfr.startswith("/") or filename.startswith("/"):
+            raise ValueError("Invalid path name.")
+
+        relpath = posixpath.normpath(posixpath.join(dirfr, filename))
+        if relpath in ("", ".") or relpath.split("/")[0] in ("..", ".ybt"):
+            raise ValueError("Invalid path name.")
+        return relpath
+
+    def tempFile(self) -> str:
+        """
+        Returns the path of a new temporary file, on the same disk as the user's folder so it can be moved into place.
+
+        Also clears out old temporary files that were never cleaned up.
+        """
+        os.makedirs(self.tempPath, exist_ok=True)
+        for name in os.listdir(self.tempPath):
+            path = os.path.join(self.tempPath, name)
+            try:
+                if time.time() - os.path.getmtime(path) > TEMP_MAX_AGE:
+                    os.remove(path)
+            except FileNotFoundError:
+                pass
+
+        return os.path.join(self.tempPath, generate_uid())
+
+    def signature(self, relpath: str, meta: dict) -> list[list]:
+        """
+        Returns the signature of a stored file, for delta uploads. (see delta.signature)
+
+        Signatures are saved by the file's hash, so each version of a file is only read through once. Also clears
+        out signatures that haven't been used in a while.
+        """
+        os.makedirs(self.signaturesPath, exist_ok=True)
+        path = os.path.join(self.signaturesPath, f"{meta['hash']}.json")
+        try:
+            with open(path, "r") as f:
+                blocks = json.load(f)
+            os.utime(path)
+            return blocks
+        except (FileNotFoundError, ValueError):
+            pass
+
+        for name in os.listdir(self.signaturesPath):
+            old = os.path.join(self.signaturesPath, name)
+            try:
+                if time.time() - os.path.getmtime(old) > SIGNATURE_MAX_AGE:
+                    os.remove(old)
+            except FileNotFoundError:
+                pass
+
+        with self.store.open(relpath, meta) as f:
+            blocks = delta.signature(f)
+
+        tmp = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(blocks, f, separators=(",", ":"))
+        os.replace(tmp, path)
+        return blocks
+
+    def writeFile(self, relpath: str, stream: BinaryIO, mtime: float | None = None) -> dict:
+        """
+        Store the contents of `stream` as `relpath`, using the server's storage backend.
+
+        If supplied, mtime is applied to the stored copy so it matches the client's.
+
+        Returns the size, mtime and hash of the stored copy (plus anything the backend needs to read it back),
+        ready for recordFiles.
+        """
+        start = time.perf_counter()
+        meta = self.store.write(relpath, stream, mtime)
+        WRITE_TIME.observe(time.perf_counter() - start)
+        add_timing("write", time.perf_counter() - start)
+        return meta
+
+    def recordFiles(self, entries: dict[str, dict]) -> list[str]:
+        """
+        Add stored files (path from root -> metadata) to the user's manifest and save it.
+
+        Takes the user's lock, so it is safe to call while other uploads are running.
+
+        Returns the paths that could not be added, because a file or folder with the same name was in the way.
+        """
+        start = time.perf_counter()
+        # Stored data must be on disk before the manifest points at it.
+        self.store.sync()
+        with self.lock():
+            self.loadManifest()
+            dump_start = time.perf_counter()
+            failed = self.__manifestFile().record([{"op": "add", "path": relpath, "meta": meta} for relpath, meta in entries.items()])
+            MANIFEST_DUMP_TIME.observe(time.perf_counter() - dump_start)
+        add_timing("manifest", time.perf_counter() - start)
+        return failed
+
+    def loadManifest(self) -> Manifest:
         """
         Attempts to load the user's fs Manifest.
 
-        Returns the Manifest data if it can be found and raises NoSuchUser elsewise.
+        The same Manifest is returned every time (it is only read from disk once), so hold the user's lock while using it.
+
+        Returns the Manifest if it can be found and raises NoSuchUser elsewise.
         """
+        manifest_file = self.__manifestFile()
+        if manifest_file.manifest is not None:
+            return manifest_file.manifest
+
+        start = time.perf_counter()
         try:
-            with open(self.__man_path, "r") as f:
-                return json.load(f)
+            manifest = manifest_file.load()
         except FileNotFoundError:
             raise self.NoSuchUser(f"User '{self.__user.name}' does not exist, or their manifest is missing.")
+        MANIFEST_LOAD_TIME.observe(time.perf_counter() - start)
+        return manifest
     
-    def dumpManifest(self, data: dict) -> dict:
+    def dumpManifest(self, data: Manifest) -> Manifest:
         """
         Same as loadManifest, but dumps instead.
+
+        Replaces the whole manifest. Use recordFiles for adding files, which only writes what changed.
         """
+        manifest_file = self.__manifestFile()
+        manifest_file.manifest = data
+        start = time.perf_counter()
         try:
-            with open(self.__man_path, "w") as f:
-                json.dump(data, f, indent=2)
-                return data
+            manifest_file.compact()
+            MANIFEST_DUMP_TIME.observe(time.perf_counter() - start)
+            return data
         except FileNotFoundError:
             raise self.NoSuchUser(f"User '{self.__user.name}' does not exist, or their manifest is missing.")
 
+    @staticmethod
+    def loadedManifests() -> dict[str, ManifestFile]:
+        """
+        Returns the manifests that are loaded in memory, by user.
+        """
+        with FileSystem.__locks_lock:
+            return {name: manifest_file for name, manifest_file in FileSystem.__manifests.items() if manifest_file.manifest is not None}
+
+    def __manifestFile(self) -> ManifestFile:
+        return FileSystem.manifestFile(self.__user.name)
+
+    @staticmethod
+    def manifestFile(name: str) -> ManifestFile:
+        """
+        Returns a user's ManifestFile by name, whether or not they exist. Hold the user's lock while using it.
+        """
+        with FileSystem.__locks_lock:
+            if name not in FileSystem.__manifests:
+                FileSystem.__manifests[name] = ManifestFile(os.path.join(FS_PATH, name, "manifest.json"),
+                                                           os.path.join(FS_PATH, name, ".ybt"))
+            return FileSystem.__manifests[name]
+
+# MODELS #
+
+class FileCheck(BaseModel):
+    """
+    A file the client wants to upload, and the hash of its contents.
+    """
+    path: str
+    hash: str
+
+class CheckRequest(BaseModel):
+    files: list[FileCheck]
+
+class ChunkList(BaseModel):
+    chunks: list[str]
+
+class CommitRequest(BaseModel):
+    """
+    A file made of chunks the server already has.
+    """
+    path: str
+    size: int
+    hash: str
+    mtime: float | None = None
+    chunks: list[str]
+
+# FUNCTIONS #
+
+def parse_range(header: str, size: int) -> tuple[int, int] | None:
+    """
+    Parse an HTTP Range header for a file of `size` bytes.
+
+    Returns the [start, end) range asked for, or None if the whole file should be sent instead
+    (ex. the header is malformed, or asks for more than one range).
+
+    Raises ValueError if the range is outside of the file.
+    """
+    unit, _, spec = header.partition("=")
+    if unit.strip() != "bytes" or "," in spec:
+        return None
+
+    first, _, last = spec.strip().partition("-")
+    try:
+        if not first:
+            # The last N bytes.
+            start, end = max(size - int(last), 0), size
+        else:
+            start, end = int(first), min(int(last) + 1, size) if last else size
+    except ValueError:
+        return None
+
+    if start >= size or start >= end:
+        raise ValueError("Range not satisfiable.")
+    return start, end
+
+def content_encoding(request: Request) -> str | None:
+    """
+    Returns the codec the request body is compressed with (see compression), or None if it isn't.
+
+    Raises HTTPException 415 if this server can't decompress it.
+    """
+    codec = request.headers.get("content-encoding", "identity").strip().lower()
+    if codec == "identity":
+        return None
+    if codec not in compression.CODECS:
+        raise HTTPException(415, f"Unsupported Content-Encoding '{codec}'.")
+    return codec
+
+# Only one chunk collection runs at a time.
+collect_lock = threading.Lock()
+
+def collect_chunks() -> None:
+    """
+    Remove chunks that no user's manifest or snapshot uses anymore. (chunk store only)
+
+    Goes through every user, so it is meant to run in the background. Does nothing if it is already running.
+    """
+    if not collect_lock.acquire(blocking=False):
+        return
+    try:
+        in_use = set()
+        for name in os.listdir(FS_PATH):
+            base = os.path.join(FS_PATH, name)
+            if name.startswith(".") or not os.path.isdir(base):
+                continue
+
+            with FileSystem.userLock(name):
+                try:
+                    manifest = FileSystem.manifestFile(name).load()
+                except FileNotFoundError:
+                    continue
+                for relpath, meta in manifest.files():
+                    in_use.update(meta.get("chunks", ()))
+            in_use.update(SnapshotStore(os.path.join(base, ".ybt", "snapshots")).chunksInUse())
+
+        removed, size = ChunkStore(FS_PATH, CHUNK_DIR).collect(in_use, CHUNK_GRACE)
+        print(f"Removed {removed} unused chunk(s), {size} bytes.")
+    finally:
+        collect_lock.release()
+
+def repack_all() -> None:
+    """
+    Reclaim space in every user's packs. (pack store only, see PackStore.repackManifest)
+    """
+    for name in os.listdir(FS_PATH):
+        base = os.path.join(FS_PATH, name)
+        if name.startswith(".") or not os.path.isdir(base):
+            continue
+
+        packs, freed = PackStore(base).repackManifest(FileSystem.manifestFile(name), FileSystem.userLock(name))
+        if packs:
+            print(f"Repacked {len(packs)} pack(s) for {name}, freed {freed} bytes.")
+
+def repack_loop() -> None:
+    while True:
+        time.sleep(REPACK_INTERVAL)
+        try:
+            repack_all()
+        except OSError as e:
+            print(f"Repacking failed: {e}")
+
+def compact_loop() -> None:
+    while True:
+        time.sleep(COMPACT_INTERVAL)
+        for name, manifest_file in FileSystem.loadedManifests().items():
+            with FileSystem.userLock(name):
+                try:
+                    manifest_file.compactIfDue()
+                except OSError as e:
+                    print(f"Compacting {name}'s manifest failed: {e}")
+
 # API #
 
 app = FastAPI()
 
+class TimeRequest:
+    """
+    Records how long each request took (see /api/metrics), and reports it in a `Server-Timing` header and in the
+    `--timing-log` file if set.
+
+    A plain ASGI middleware rather than `@app.middleware("http")`, which would stream every response through itself
+    and so stop file downloads from being sent with sendfile.
+    """
+    def __init__(self, app) -> None:
+        self.app = app
+
+    async def __call__(self, scope, receive, send) -> None:
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        timings: dict[str, float] = {}
+        # Endpoints run in a copy of this context, but share the dict, so their timings show up here.
+        request_timings.set(timings)
+
+        method = scope["method"]
+        path = scope["path"]
+        upload = any(path == prefix or (prefix.endswith("/") and path.startswith(prefix)) for prefix in UPLOAD_PATHS.get(method, ()))
+        if upload:
+            UPLOADS_IN_FLIGHT.inc()
+
+        start = time.perf_counter()
+        async def timed(message):
+            if message["type"] == "http.response.start":
+                timings["total"] = time.perf_counter() - start
+                self.record(scope, message["status"], timings)
+                server_timing = ", ".join(f"{name};dur={seconds * 1000:.2f}" for name, seconds in timings.items())
+                message = {**message, "headers": [*message.get("headers", []), (b"server-timing", server_timing.encode())]}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, timed)
+        finally:
+            if upload:
+                UPLOADS_IN_FLIGHT.dec()
+
+    @staticmethod
+    def record(scope, status: int, timings: dict[str, float]) -> None:
+        # Label by route (ex. /api/chunks/{digest}) rather than path, so there is a fixed number of labels.
+        route = scope.get("route")
+        route = route.path if route is not None else "unmatched"
+        REQUESTS.inc(scope["method"], route, str(status))
+        REQUEST_TIME.observe(timings["total"], scope["method"], route)
+        received = scope.get("ybt.received")
+        if received:
+            RECEIVED_BYTES.inc(route, amount=received[0])
+
+        if args.timing_log:
+            phases = {name: seconds for name, seconds in timings.items() if name != "total"}
+            timing_lines.put(json.dumps({
+                "method": scope["method"],
+                "path": scope["path"],
+                "status": status,
+                "time": timings["total"],
+                "phases": phases
+            }))
+
+def timing_log_loop() -> None:
+    """
+    Append queued lines to the `--timing-log` file, flushing whenever the queue runs dry.
+    """
+    with open(args.timing_log, "a") as f:
+        while True:
+            f.write(timing_lines.get() + "\n")
+            if timing_lines.empty():
+                f.flush()
+
+class CountReceived:
+    """
+    Counts the request body bytes the app actually reads, in `scope["ybt.received"]` (a one item list).
+
+    Compressed and delta uploads are sent chunked, without a Content-Length, so that can't be relied on.
+    """
+    def __init__(self, app) -> None:
+        self.app = app
+
+    async def __call__(self, scope, receive, send) -> None:
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        received = scope["ybt.received"] = [0]
+        async def counted():
+            message = await receive()
+            if message["type"] == "http.request":
+                received[0] += len(message.get("body", b""))
+            return message
+        await self.app(scope, counted, send)
+
+app.add_middleware(TimeRequest)
+# Added after TimeRequest, so it wraps it and the count is there by the time TimeRequest reads it.
+app.add_middleware(CountReceived)
 
 @app.get("/api")
 def root():
     return "Hello, world!"
 
+@app.get("/api/info")
+def info():
+    """
+    Server Info.
+
+    Tells clients how this server stores files, so they can pick the best way to upload them.
+    """
+    return {
+        "store": args.store,
+        "chunking": {
+            "min": chunker.MIN_SIZE,
+            "max": chunker.MAX_SIZE,
+            "anchor": chunker.ANCHOR,
+            "window": chunker.WINDOW,
+            "bits": chunker.BOUNDARY_BITS
+        },
+        # Codecs request bodies can be compressed with. (as their Content-Encoding)
+        "compression": compression.CODECS,
+        # Optional endpoints this server has.
+        "features": ["stream", "download", "snapshots"] + (["delta"] if args.store != "chunk" else [])
+    }
+
+@app.get("/api/metrics")
+def metrics(request: Request):
+    """
+    Metrics.
+
+    Request counts and timings, upload and manifest stats, in the Prometheus text format.
+
+    Only answered for requests from this machine, since it shows usernames. Scrape it locally (or through a proxy).
+    """
+    if request.client is None or request.client.host not in ("127.0.0.1", "::1"):
+        raise HTTPException(403, "Metrics are only available from localhost.")
+    return Response(REGISTRY.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
 @app.post("/api/users/create")
 def cuser(usr: str, psw: str):
-    # Load the UserManifest
-    with open(USR_MANIFEST, "r") as f:
-        data = json.load(f)
-    
-    for user in data["users"]:
-        if user["username"] == usr:
-            raise HTTPException(409, "Account already exists.")
+    # Names become folder names, and names starting with a dot are reserved for the server.
+    if not usr or usr.startswith(".") or "/" in usr or "\\" in usr:
+        raise HTTPException(422, "Invalid username.")
 
     # Add the new user to the UserManifest
-    with open(USR_MANIFEST, "w") as f:
-        data["users"].append({"username": usr, "password": hashlib.sha384(psw.encode()).hexdigest()})
-
-        json.dump(data, f, indent=2)
+    if not accounts.add(usr, psw):
+        raise HTTPException(409, "Account already exists.")
 
     # Create the user's directory.
-    os.mkdir(f"./fs/{usr}")
+    os.mkdir(os.path.join(FS_PATH, usr))
 
     # Create their manifest.
-    with open(f"./fs/{usr}/manifest.json", "w") as f:
-        # Files are organized like so:
-        # dict_keys = directory
-        # dict_values = files
-        #
-        # Root is the top level folder.
-        json.dump({
-            "root": []
-        }, f, indent=2)
+    with open(os.path.join(FS_PATH, usr, "manifest.json"), "w") as f:
+        json.dump(Manifest().toDict(), f, indent=2)
 
     return 200
 
 @app.get("/api/users/auth")
 def guser(usr: str, psw: str):
-    # Load the UserManifest
-    with open(USR_MANIFEST, "r") as f:
-        data = json.load(f)
-    
-    for user in data["users"]:
-        if user["username"] == usr and user["password"] == hashlib.sha384(psw.encode()).hexdigest():
-            return {"content": "Authed user!"}
+    if accounts.check(usr, psw):
+        return {"content": "Authed user!"}
     
     raise HTTPException(401, "Failed to auth.")
 
+@app.post("/api/users/login")
+def login(usr: str, psw: str):
+    """
+    Login.
+
+    Returns a token that can be sent instead of the password (as `token`) to the /api/fs and /api/chunks endpoints.
+    It expires once it goes unused for `expires` seconds.
+    """
+    if not accounts.check(usr, psw):
+        raise HTTPException(401, "Failed to auth.")
+
+    return {"token": tokens.issue(usr), "expires": TOKEN_TTL}
+
 @app.post("/api/fs/put")
-def putfile(usr: str, psw: str, dirfr: str = "", file: UploadFile = File(...)):
+def putfile(usr: str, psw: str | None = None, token: str | None = None, dirfr: str = "", mtime: float | None = None, file: UploadFile = File(...)):
     """
     Put File.
 
@@ -184,43 +714,34 @@ def putfile(usr: str, psw: str, dirfr: str = "", file: UploadFile = File(...)):
     DirFR (Directory From Root) allows for folder creation. It will be appended before the file name.
 
     ex. / = `fs/NAME/FILE`, /docs = `fs/NAME/docs/FILE`
+
+    If supplied, mtime is applied to the stored copy so it matches the client's.
     """
     try:
-        user = User(usr, psw)
+        user = User(usr, psw, token)
     except PermissionError:
         raise HTTPException(401, "Failed to auth.")
 
-    # Load the user's manifest.
+    # Make sure the user's manifest can be loaded before accepting anything.
     try:
-        manifest = user.fs.loadManifest()
+        with user.fs.lock():
+            user.fs.loadManifest()
     except FileSystem.NoSuchUser:
         raise HTTPException(404, "Could not load user manifest. Aborting.")
 
-    # path.join doesn't work with a leading slash.
-    dirfr = dirfr.removeprefix("/")
-    if dirfr.startswith("/"):
-        return HTTPException(422, "Invalid path name.")
-
     # Figure out the correct path based on the contents of dirfr.
-    path: str = os.path.join(f"./fs/{user.name}", os.path.join(dirfr, file.filename)) # type: ignore
-    # To prevent weird bugs, replace all backslashes with slashes.
-    path = path.replace("\\", "/")
-    dirfr = dirfr.replace("\\", "/")
-
-    # Make parent dirs if they don't exist already.
-    if not os.path.exists(f"./fs/{user.name}/{dirfr}"):
-        os.makedirs(f"./fs/{user.name}/{dirfr}")
+    try:
+        relpath = user.fs.resolvePath(dirfr, file.filename) # type: ignore
+    except ValueError:
+        raise HTTPException(422, "Invalid path name.")
 
     # Reject root level manifest.json files to prevent replacement.
-    # print(path)
-    if path == f"./fs/{user.name}/manifest.json":
+    if relpath == "manifest.json":
         raise HTTPException(409, "Cannot upload root-level 'manifest.json' file!")
 
-    # Download the file.    
+    # Download the file.
     try:
-        with open(path, 'wb') as f:
-            while contents := file.file.read(1024 * 1024):
-                f.write(contents)
+        meta = user.fs.writeFile(relpath, file.file, mtime)
     except Exception as e:
         # print(e)
         raise HTTPException(400, f"There was an error uploading the file: {e}")
@@ -229,88 +750,732 @@ def putfile(usr: str, psw: str, dirfr: str = "", file: UploadFile = File(...)):
 
     # Finally, return a success message and update the manifest.
 
-    # Loop through all the sub dirs minus the three leading dirs since we know those lead to root. (fs/USER)
-    # This gets its own variable because I type it out too much lol
-    base_split = path.split("/")[2:]
-    # TThe first value should be "root". AKA ./fs/USER/
-    base_split[0] = ""
-
-    dirs = []
-    # For Manifest assembling. This starts at root.
-    current_manifest_entry = manifest["root"]
-    for i, dir in enumerate(base_split):
-        dirs.append(dir)
-        joined_path = f"./fs/{user.name}/{'/'.join(dirs)}"
-        
-        # Use the joined path to determine whether the path is a directory or a file.
-        is_dir = os.path.isdir(joined_path)
-        is_file = os.path.isfile(joined_path)
-        is_root = True if i == 0 else False
-
-        # print(f"File/Directory: {dir}")
-        # print(f"Joined path: {joined_path}")
-        # print(f"Is dir: {os.path.isdir(joined_path)}")
-        # print(f"Is file: {os.path.isfile(joined_path)}")
-        # print(f"Is root: {is_root}\n\n")
-
-        # The path is a directory.
-        if is_dir:
-            # Root already exists. We don't need to make another one.
-            if dir == "":
-                continue
-            
-            # print(manifest)
-            # print(current_manifest_entry)
-            # current_manifest_entry: list
-
-            # Check if the folder exists already. If it does, move into it.
-            exists = False
-            for i, subdir in enumerate(current_manifest_entry):
-                subdir: dict
-                if type(subdir) == dict and dir in list(subdir.keys()):
-                    current_manifest_entry = current_manifest_entry[i][dir]
-                    exists = True
-                    break
-            if exists:
-                continue
+    if user.fs.recordFiles({relpath: meta}):
+        raise HTTPException(409, "A file or folder with the same name is in the way.")
 
-            # Add the folder into the manifest.
-            current_manifest_entry.append({dir: []})
-
-            # Move the current_manifest_entry inside the list.
-            current_manifest_entry = current_manifest_entry[-1][dir]
-        # The path is a file.
-        elif is_file:
-            # If the file already exists in the manifest, there is no point adding it again.
-            exists = False
-            for subfile in current_manifest_entry:
-                if dir == subfile:
-                    exists = True
-                    break
-            if exists:
-                continue
+    return {"message": f"Successfully uploaded {file.filename}"}
+
+@app.put("/api/fs/file")
+async def putstream(request: Request, usr: str, path: str, psw: str | None = None, token: str | None = None, mtime: float | None = None, hash: str | None = None,
+                    size: int | None = None):
+    """
+    Put File (streamed).
 
-            current_manifest_entry.append(dir)
+    Same as putfile, but the request body is the raw contents of the file, and `path` is where it goes (from root).
 
-    user.fs.dumpManifest(manifest)
-    # for dir in path.split("/")[:len(path.split("/"))-1]:
-    #     print(dir)
+    The body is written straight to a temporary file as it arrives, then flushed to disk and moved into place, so
+    every byte is only written once and a failed upload never replaces the last good copy.
 
-    return {"message": f"Successfully uploaded {file.filename}"}
+    If supplied, the file is only stored if it matches `hash` and is `size` bytes. An upload stops as soon as it
+    grows past `size`. Compressed bodies must give `size`, so a small body can't expand to fill the disk.
+    """
+    try:
+        user = User(usr, psw, token)
+    except PermissionError:
+        raise HTTPException(401, "Failed to auth.")
+
+    try:
+        relpath = user.fs.resolvePath(os.path.dirname(path), os.path.basename(path))
+    except ValueError:
+        raise HTTPException(422, "Invalid path name.")
+
+    if relpath == "manifest.json":
+        raise HTTPException(409, "Cannot upload root-level 'manifest.json' file!")
+
+    # Make sure the user's manifest can be loaded before accepting anything.
+    def check_manifest() -> None:
+        with user.fs.lock():
+            user.fs.loadManifest()
+    try:
+        await run_in_threadpool(check_manifest)
+    except FileSystem.NoSuchUser:
+        raise HTTPException(404, "Could not load user manifest. Aborting.")
+
+    decoder = compression.Decoder(content_encoding(request))
+    if decoder.codec is not None and size is None:
+        raise HTTPException(411, "Compressed uploads must give their size.")
+    tmp = await run_in_threadpool(user.fs.tempFile)
+    h = hashlib.new(HASH_NAME)
+
+    written = 0
+
+    def write(f: BinaryIO, data: bytes) -> None:
+        nonlocal written
+        for piece in decoder.decompress(data, STREAM_BUFFER):
+            written += len(piece)
+            if size is not None and written > size:
+                raise ValueError("File is larger than its declared size.")
+            f.write(piece)
+            h.update(piece)
+
+    try:
+        with open(tmp, "wb") as f:
+            # Disk work (and decompressing) happens off the event loop, a buffer at a time.
+            buffer = bytearray()
+            async for data in request.stream():
+                buffer += data
+                if len(buffer) >= STREAM_BUFFER:
+                    await run_in_threadpool(write, f, bytes(buffer))
+                    buffer.clear()
+            await run_in_threadpool(write, f, bytes(buffer))
+            tail = decoder.close()
+            f.write(tail)
+            h.update(tail)
+            written += len(tail)
+
+            await run_in_threadpool(f.flush)
+            await run_in_threadpool(os.fsync, f.fileno())
+
+        if size is not None and written != size:
+            raise HTTPException(422, "File is not its declared size.")
+        if hash is not None and h.hexdigest() != hash:
+            raise HTTPException(422, "File does not match its hash.")
+
+        start = time.perf_counter()
+        meta = await run_in_threadpool(user.fs.store.place, relpath, tmp, h.hexdigest(), mtime, False)
+        WRITE_TIME.observe(time.perf_counter() - start)
+        add_timing("write", time.perf_counter() - start)
+    except ValueError as e:
+        raise HTTPException(422, str(e))
+    except ClientDisconnect:
+        raise HTTPException(400, "Upload was cut short.")
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+    try:
+        if await run_in_threadpool(user.fs.recordFiles, {relpath: meta}):
+            raise HTTPException(409, "A file or folder with the same name is in the way.")
+    except FileSystem.NoSuchUser:
+        raise HTTPException(404, "Could not load user manifest. Aborting.")
+
+    return {"message": f"Successfully uploaded {relpath}"}
+
+@app.post("/api/fs/putbatch")
+def putbatch(usr: str, psw: str | None = None, token: str | None = None, dirfr: str = "", file: UploadFile = File(...)):
+    """
+    Put Batch.
+
+    Same as putfile, but the attached file is a tar archive (optionally compressed) of many files.
+
+    Every regular file inside is placed at `DirFR/NAME_IN_ARCHIVE`, keeping its mtime. The archive is
+    unpacked as it is read, and the manifest is only updated once for the whole batch.
+
+    Returns the paths that were stored, and the ones that were rejected.
+    """
+    try:
+        user = User(usr, psw, token)
+    except PermissionError:
+        raise HTTPException(401, "Failed to auth.")
+
+    # Make sure the user's manifest can be loaded before accepting anything.
+    try:
+        with user.fs.lock():
+            user.fs.loadManifest()
+    except FileSystem.NoSuchUser:
+        raise HTTPException(404, "Could not load user manifest. Aborting.")
+
+    stored = {}
+    failed = []
+    try:
+        with tarfile.open(fileobj=file.file, mode="r|*") as tar:
+            for member in tar:
+                # Folders are created as needed. Links and devices are never accepted.
+                if not member.isfile():
+                    continue
+
+                try:
+                    relpath = user.fs.resolvePath(dirfr, member.name)
+                except ValueError:
+                    failed.append(member.name)
+                    continue
+                if relpath == "manifest.json":
+                    failed.append(member.name)
+                    continue
+
+                stored[relpath] = user.fs.writeFile(relpath, tar.extractfile(member), member.mtime) # type: ignore
+    except (tarfile.TarError, OSError) as e:
+        # Keep whatever made it in, but let the client know the batch was cut short.
+        if not stored:
+            raise HTTPException(400, f"There was an error uploading the batch: {e}")
+        failed.append(f"ERROR: {e}")
+    finally:
+        file.file.close()
+
+    # Update the manifest once for the whole batch.
+    for relpath in user.fs.recordFiles(stored):
+        stored.pop(relpath)
+        failed.append(relpath)
+
+    return {"message": f"Successfully uploaded {len(stored)} file(s)", "stored": list(stored.keys()), "failed": failed}
+
+@app.post("/api/chunks/missing")
+def missingchunks(usr: str, body: ChunkList, psw: str | None = None, token: str | None = None):
+    """
+    Missing Chunks.
+
+    Takes a list of chunk hashes and returns the ones the server does not have yet.
+
+    Only available with `--store chunk`.
+    """
+    try:
+        user = User(usr, psw, token)
+    except PermissionError:
+        raise HTTPException(401, "Failed to auth.")
+
+    if not isinstance(user.fs.store, ChunkStore):
+        raise HTTPException(400, "This server does not use the chunk store.")
+
+    try:
+        return {"missing": user.fs.store.missingChunks(body.chunks)}
+    except ValueError:
+        raise HTTPException(422, "Invalid chunk hash.")
+
+@app.put("/api/chunks/{digest}")
+def putchunk(request: Request, digest: str, usr: str, psw: str | None = None, token: str | None = None, data: bytes = Body(..., media_type="application/octet-stream")):
+    """
+    Put Chunk.
+
+    The request body is the chunk (compressed, if it has a Content-Encoding). It is only stored if it matches
+    `digest`.
+
+    Only available with `--store chunk`.
+    """
+    try:
+        user = User(usr, psw, token)
+    except PermissionError:
+        raise HTTPException(401, "Failed to auth.")
+
+    if not isinstance(user.fs.store, ChunkStore):
+        raise HTTPException(400, "This server does not use the chunk store.")
+
+    if len(data) > chunker.MAX_SIZE:
+        raise HTTPException(413, "Chunk is too large.")
+
+    try:
+        data = compression.decompress(content_encoding(request), data, chunker.MAX_SIZE)
+        user.fs.store.putChunk(digest, data)
+    except ValueError as e:
+        raise HTTPException(422, str(e))
+
+    return {"message": f"Successfully uploaded chunk {digest}"}
+
+@app.post("/api/fs/commit")
+def commitfile(usr: str, body: CommitRequest, psw: str | None = None, token: str | None = None):
+    """
+    Commit File.
+
+    Places a file made of chunks that were already uploaded with putchunk (or are shared with other files).
+
+    Only available with `--store chunk`.
+    """
+    try:
+        user = User(usr, psw, token)
+    except PermissionError:
+        raise HTTPException(401, "Failed to auth.")
+
+    if not isinstance(user.fs.store, ChunkStore):
+        raise HTTPException(400, "This server does not use the chunk store.")
+
+    try:
+        relpath = user.fs.resolvePath(os.path.dirname(body.path), os.path.basename(body.path))
+    except ValueError:
+        raise HTTPException(422, "Invalid path name.")
+
+    if relpath == "manifest.json":
+        raise HTTPException(409, "Cannot upload root-level 'manifest.json' file!")
+
+    try:
+        meta = user.fs.store.commit(body.chunks, body.size, body.hash, body.mtime)
+    except ValueError as e:
+        raise HTTPException(422, str(e))
+    except FileNotFoundError as e:
+        raise HTTPException(409, str(e))
+
+    try:
+        if user.fs.recordFiles({relpath: meta}):
+            raise HTTPException(409, "A file or folder with the same name is in the way.")
+    except FileSystem.NoSuchUser:
+        raise HTTPException(404, "Could not load user manifest. Aborting.")
+
+    return {"message": f"Successfully uploaded {relpath}"}
+
+@app.post("/api/fs/session")
+def opensession(usr: str, path: str, size: int, hash: str, psw: str | None = None, token: str | None = None, mtime: float | None = None):
+    """
+    Open Session.
+
+    Starts a resumable upload of a `size` byte file that will be stored as `path` (from root).
+
+    Send the file in pieces with putsession, then finish with commitsession. The final file must match `hash`.
+    """
+    try:
+        user = User(usr, psw, token)
+    except PermissionError:
+        raise HTTPException(401, "Failed to auth.")
+
+    try:
+        relpath = user.fs.resolvePath(os.path.dirname(path), os.path.basename(path))
+    except ValueError:
+        raise HTTPException(422, "Invalid path name.")
+
+    if relpath == "manifest.json":
+        raise HTTPException(409, "Cannot upload root-level 'manifest.json' file!")
+    if size < 0:
+        raise HTTPException(422, "Invalid file size.")
+
+    # Clear out sessions that were abandoned.
+    UploadSession.prune(user.fs.uploadsPath, SESSION_MAX_AGE)
+
+    session = UploadSession.create(user.fs.uploadsPath, relpath, size, hash, mtime)
+    return session.info()
+
+@app.get("/api/fs/session/{id}")
+def getsession(id: str, usr: str, psw: str | None = None, token: str | None = None):
+    """
+    Get Session.
+
+    Returns how far along an upload session is. `offset` is the committed offset (everything before it has
+    arrived) and `ranges` lists every byte range that arrived.
+    """
+    try:
+        user = User(usr, psw, token)
+    except PermissionError:
+        raise HTTPException(401, "Failed to auth.")
+
+    try:
+        return UploadSession(user.fs.uploadsPath, id).info()
+    except UploadSession.NoSuchSession as e:
+        raise HTTPException(404, str(e))
+
+@app.put("/api/fs/session/{id}")
+def putsession(request: Request, id: str, usr: str, offset: int, psw: str | None = None, token: str | None = None, data: bytes = Body(..., media_type="application/octet-stream")):
+    """
+    Put Session.
+
+    The request body is a piece of the file (compressed, if it has a Content-Encoding), to be written at `offset`.
+    Pieces can arrive in any order.
+    """
+    try:
+        user = User(usr, psw, token)
+    except PermissionError:
+        raise HTTPException(401, "Failed to auth.")
+
+    if len(data) > SESSION_MAX_PIECE:
+        raise HTTPException(413, "Piece is too large.")
+
+    try:
+        data = compression.decompress(content_encoding(request), data, SESSION_MAX_PIECE)
+        session = UploadSession(user.fs.uploadsPath, id)
+        session.write(offset, data)
+    except UploadSession.NoSuchSession as e:
+        raise HTTPException(404, str(e))
+    except ValueError as e:
+        raise HTTPException(422, str(e))
+
+    return session.info()
+
+@app.post("/api/fs/session/{id}/commit")
+def commitsession(id: str, usr: str, psw: str | None = None, token: str | None = None):
+    """
+    Commit Session.
+
+    Checks that the whole file arrived and matches its hash, then puts it in place and removes the session.
+    """
+    try:
+        user = User(usr, psw, token)
+    except PermissionError:
+        raise HTTPException(401, "Failed to auth.")
+
+    try:
+        session = UploadSession(user.fs.uploadsPath, id)
+        # No pieces are written while the data is checked and moved into place. Those that were waiting find the
+        # session gone afterwards.
+        with session:
+            if session.offset() != session.size:
+                raise HTTPException(409, f"Upload is incomplete. ({session.offset()}/{session.size} bytes)")
+
+            try:
+                meta = user.fs.store.place(session.path, session.dataPath, session.hash, session.mtime)
+            except ValueError as e:
+                # The data is no good, so there is nothing left to resume.
+                session.remove()
+                raise HTTPException(422, str(e))
+            session.remove()
+    except UploadSession.NoSuchSession as e:
+        raise HTTPException(404, str(e))
+    try:
+        if user.fs.recordFiles({session.path: meta}):
+            raise HTTPException(409, "A file or folder with the same name is in the way.")
+    except FileSystem.NoSuchUser:
+        raise HTTPException(404, "Could not load user manifest. Aborting.")
+
+    return {"message": f"Successfully uploaded {session.path}"}
+
+@app.get("/api/fs/signature")
+def getsignature(usr: str, path: str, psw: str | None = None, token: str | None = None):
+    """
+    Get Signature.
+
+    Returns the signature of the file stored at `path` (from root): its hash, size, and the [length, hash] of each of
+    its chunks. A client with a newer version sends only the differences to putdelta. (see delta)
+
+    Not available with `--store chunk`, which only stores new chunks anyway.
+    """
+    try:
+        user = User(usr, psw, token)
+    except PermissionError:
+        raise HTTPException(401, "Failed to auth.")
+
+    if isinstance(user.fs.store, ChunkStore):
+        raise HTTPException(400, "This server uses the chunk store.")
+
+    try:
+        relpath = user.fs.resolvePath(os.path.dirname(path), os.path.basename(path))
+    except ValueError:
+        raise HTTPException(422, "Invalid path name.")
+
+    try:
+        with user.fs.lock():
+            meta = user.fs.loadManifest().get(relpath)
+    except FileSystem.NoSuchUser:
+        raise HTTPException(404, "Could not load user manifest. Aborting.")
+
+    if not isinstance(meta, dict) or not meta.get("hash"):
+        raise HTTPException(404, "No such file.")
+
+    try:
+        blocks = user.fs.signature(relpath, meta)
+    except FileNotFoundError:
+        raise HTTPException(404, "No such file.")
+
+    return {"hash": meta["hash"], "size": meta["size"], "blocks": blocks}
+
+@app.put("/api/fs/delta")
+async def putdelta(request: Request, usr: str, path: str, base: str, hash: str, psw: str | None = None, token: str | None = None, mtime: float | None = None,
+                   size: int | None = None):
+    """
+    Put Delta.
+
+    Same as putstream, but the request body is a delta (see delta) against the stored version of the file with the
+    hash `base`, as described by getsignature. The new version is rebuilt into a temporary file as the delta
+    arrives, and is only moved into place if it matches `hash` (and `size`, if supplied). The delta can be
+    compressed, as long as `size` is given. (see putstream)
+
+    If the stored file is no longer `base`, nothing is changed and 409 is returned. Send the whole file instead.
+    """
+    try:
+        user = User(usr, psw, token)
+    except PermissionError:
+        raise HTTPException(401, "Failed to auth.")
+
+    if isinstance(user.fs.store, ChunkStore):
+        raise HTTPException(400, "This server uses the chunk store.")
+
+    try:
+        relpath = user.fs.resolvePath(os.path.dirname(path), os.path.basename(path))
+    except ValueError:
+        raise HTTPException(422, "Invalid path name.")
+
+    def current() -> dict | None:
+        with user.fs.lock():
+            meta = user.fs.loadManifest().get(relpath)
+        return meta if isinstance(meta, dict) else None
+    try:
+        meta = await run_in_threadpool(current)
+    except FileSystem.NoSuchUser:
+        raise HTTPException(404, "Could not load user manifest. Aborting.")
+
+    if meta is None or meta.get("hash") != base:
+        raise HTTPException(409, "The stored file changed since its signature was made.")
+
+    decoder = compression.Decoder(content_encoding(request))
+    if decoder.codec is not None and size is None:
+        raise HTTPException(411, "Compressed uploads must give their size.")
+
+    def open_base() -> tuple[BinaryIO, str | None]:
+        old = user.fs.store.open(relpath, meta)
+        if not isinstance(old, compression.Reader):
+            return old, None
+        # Compressed files can't seek, so the delta is applied to a decompressed copy.
+        plain = user.fs.tempFile()
+        with old, open(plain, "wb") as f:
+            while data := old.read(1024 * 1024):
+                f.write(data)
+        return open(plain, "rb"), plain
+    try:
+        old, plain = await run_in_threadpool(open_base)
+    except FileNotFoundError:
+        raise HTTPException(409, "The stored file changed since its signature was made.")
+
+    def feed(data: bytes) -> None:
+        for piece in decoder.decompress(data, STREAM_BUFFER):
+            patcher.feed(piece)
+            if size is not None and patcher.copied + patcher.literal > size:
+                raise ValueError("File is larger than its declared size.")
+
+    tmp = await run_in_threadpool(user.fs.tempFile)
+    try:
+        with old, open(tmp, "wb") as f:
+            patcher = delta.Patcher(old, f, HASH_NAME)
+            # Disk work happens off the event loop, a buffer at a time.
+            buffer = bytearray()
+            async for data in request.stream():
+                buffer += data
+                if len(buffer) >= STREAM_BUFFER:
+                    await run_in_threadpool(feed, bytes(buffer))
+                    buffer.clear()
+            await run_in_threadpool(feed, bytes(buffer))
+            feed(b"")
+            patcher.feed(decoder.close())
+            digest = patcher.close()
+
+            await run_in_threadpool(f.flush)
+            await run_in_threadpool(os.fsync, f.fileno())
+
+        if digest != hash:
+            # Most likely the stored file was replaced while the delta was being applied.
+            raise HTTPException(422, "File does not match its hash.")
+
+        start = time.perf_counter()
+        meta = await run_in_threadpool(user.fs.store.place, relpath, tmp, digest, mtime, False)
+        WRITE_TIME.observe(time.perf_counter() - start)
+        add_timing("write", time.perf_counter() - start)
+    except ValueError as e:
+        raise HTTPException(422, str(e))
+    except ClientDisconnect:
+        raise HTTPException(400, "Upload was cut short.")
+    finally:
+        for path in (tmp, plain):
+            if path is not None and os.path.exists(path):
+                os.remove(path)
+
+    try:
+        if await run_in_threadpool(user.fs.recordFiles, {relpath: meta}):
+            raise HTTPException(409, "A file or folder with the same name is in the way.")
+    except FileSystem.NoSuchUser:
+        raise HTTPException(404, "Could not load user manifest. Aborting.")
+
+    return {"message": f"Successfully uploaded {relpath}", "copied": patcher.copied, "sent": patcher.literal}
+
+@app.get("/api/fs/file")
+def getfile(request: Request, usr: str, path: str, psw: str | None = None, token: str | None = None, snapshot: str | None = None):
+    """
+    Get File.
+
+    Returns the contents of the file stored at `path` (from root), streamed from disk. Set `snapshot` to get it
+    as it was in that snapshot instead.
+
+    Supports `Range` (a single range) so interrupted downloads can be resumed. The ETag is the file's hash, which is
+    also sent as `X-YBT-Hash`, so `If-Range` can be used to make sure the file didn't change in between.
+    """
+    try:
+        user = User(usr, psw, token)
+    except PermissionError:
+        raise HTTPException(401, "Failed to auth.")
+
+    try:
+        relpath = user.fs.resolvePath(os.path.dirname(path), os.path.basename(path))
+    except ValueError:
+        raise HTTPException(422, "Invalid path name.")
+
+    try:
+        with user.fs.lock():
+            manifest = user.fs.loadManifest() if snapshot is None else user.fs.snapshots.load(snapshot)
+            meta = manifest.get(relpath)
+    except FileSystem.NoSuchUser:
+        raise HTTPException(404, "Could not load user manifest. Aborting.")
+    except (ValueError, FileNotFoundError):
+        raise HTTPException(404, "No such snapshot.")
+
+    if not isinstance(meta, dict):
+        raise HTTPException(404, "No such file.")
+
+    headers = {}
+    if meta.get("hash"):
+        headers = {"etag": f'"{meta["hash"]}"', "x-ybt-hash": meta["hash"]}
+
+    # Plain files are sent by the server as is (it handles Range itself, and can use sendfile where supported).
+    local = None
+    if isinstance(user.fs.store, MirrorStore) and "pack" not in meta:
+        local = user.fs.store.localPath(relpath) if snapshot is None else user.fs.snapshots.localPath(snapshot, relpath)
+        if not os.path.isfile(local):
+            raise HTTPException(404, "No such file.")
+        if not meta.get("encoding"):
+            return FileResponse(local, headers=headers)
+    elif "pack" in meta:
+        # Checked before streaming starts, since nothing but a cut-off response can be sent after.
+        try:
+            if not os.path.isfile(user.fs.store.packPath(meta["pack"])): # type: ignore
+                raise FileNotFoundError
+        except FileNotFoundError:
+            raise HTTPException(404, "No such file.")
+
+    size = meta["size"]
+    start, end, status = 0, size, 200
+    if (header := request.headers.get("range")) and request.headers.get("if-range", headers.get("etag")) == headers.get("etag"):
+        try:
+            byte_range = parse_range(header, size)
+        except ValueError:
+            return Response(status_code=416, headers={"content-range": f"bytes */{size}"})
+        if byte_range is not None:
+            start, end = byte_range
+            status = 206
+            headers["content-range"] = f"bytes {start}-{end - 1}/{size}"
+
+    headers["accept-ranges"] = "bytes"
+    headers["content-length"] = str(end - start)
+    # Files kept compressed are sent decompressed.
+    if local is not None:
+        contents = compression.iter_decompressed(local, meta["encoding"], start, end)
+    else:
+        contents = user.fs.store.iterFile(meta, start, end)
+    return StreamingResponse(contents, status_code=status, headers=headers, media_type="application/octet-stream")
 
 @app.get("/api/fs/getmanifest")
-def getmanifest(usr: str, psw: str):
+def getmanifest(request: Request, usr: str, psw: str | None = None, token: str | None = None, path: str = "", depth: int = 1,
+                offset: int = 0, limit: int = MANIFEST_PAGE, files: bool = False, snapshot: str | None = None):
+    """
+    Get Manifest.
+
+    Returns a page of the user's files as a tree of names under "root", plus (if asked for) their metadata by path
+    under "files".
+
+    By default, only the first MANIFEST_PAGE entries of the root folder are listed, and folders are left as
+    `{name: null}`, so a response never grows with the size of the tree.
+
+    args
+    ---
+    `path`: List this folder (from root) instead. A file is listed on its own.
+
+    `depth`: How many levels of folders to list. Folders below that are `{name: null}`, and can be fetched on their own.
+    Defaults to 1.
+
+    `offset`, `limit`: Only list this slice of the folder's own entries. (at most MANIFEST_PAGE) `total` is how many
+    entries it has, and `next` is the offset of the next page (or null if this was the last one).
+
+    `files`: Set to true to include the metadata of the listed files.
+
+    `snapshot`: List the files as they were in this snapshot. (see /api/fs/snapshots)
+
+    The response has an ETag, so sending it back as If-None-Match gets a 304 if nothing changed since.
+    """
     try:
-        user = User(usr, psw)
+        user = User(usr, psw, token)
     except PermissionError:
         raise HTTPException(401, "Failed to auth.")
-    
+
+    if depth < 1 or offset < 0 or limit < 0:
+        raise HTTPException(422, "Invalid depth or page.")
+    limit = min(limit, MANIFEST_PAGE)
+
+    path = path.replace("\\", "/").strip("/")
     try:
-        manifest = user.fs.loadManifest()
+        with user.fs.lock():
+            manifest = user.fs.loadManifest() if snapshot is None else user.fs.snapshots.load(snapshot)
+
+            etag = f'"{manifest.etag}"'
+            if request.headers.get("if-none-match") == etag:
+                return Response(status_code=304, headers={"etag": etag})
+
+            folder = manifest.get(path) if path else manifest.root
+            if folder is None:
+                raise HTTPException(404, "No such file or folder.")
+
+            metas = {} if files else None
+            if not isinstance(folder, Folder):
+                # A single file.
+                entries, total = [posixpath.basename(path)], 1
+                if metas is not None:
+                    metas[path] = folder
+            else:
+                entries = manifest.toLegacy(folder, depth, offset, limit, path + "/" if path else "", metas)
+                total = len(folder.children)
     except FileSystem.NoSuchUser:
         raise HTTPException(500, "Unable to find user's manifest. Try again later.")
+    except (ValueError, FileNotFoundError):
+        raise HTTPException(404, "No such snapshot.")
+
+    # Same layout as always: a tree of names under "root", plus metadata by path.
+    data = {"root": entries, "total": total, "next": offset + len(entries) if offset + len(entries) < total else None}
+    if metas is not None:
+        data["files"] = metas
+
+    # Manifests can be big, so skip FastAPI's conversion of the response. It is already plain JSON data.
+    return JSONResponse(data, headers={"etag": etag})
+
+@app.post("/api/fs/snapshots")
+def createsnapshot(usr: str, psw: str | None = None, token: str | None = None, label: str = ""):
+    """
+    Create Snapshot.
+
+    Freezes the user's files as they are right now. Later uploads never change what a snapshot holds, and
+    getmanifest/file can read from it with `snapshot=ID`.
+
+    Old snapshots are then removed according to the server's retention policy (`--keep-*`). Clients can't remove
+    snapshots themselves, so a misbehaving client can't wipe out the history either.
+
+    Returns the new snapshot's info, and the IDs of the snapshots that were removed.
+    """
+    try:
+        user = User(usr, psw, token)
+    except PermissionError:
+        raise HTTPException(401, "Failed to auth.")
+
+    try:
+        with user.fs.lock():
+            info = user.fs.snapshots.create(user.fs.loadManifest(), label)
+            pruned = user.fs.snapshots.prune(**RETENTION)
+    except FileSystem.NoSuchUser:
+        raise HTTPException(404, "Could not load user manifest. Aborting.")
+
+    # Chunks only used by the removed snapshots can go now.
+    if pruned and args.store == "chunk":
+        threading.Thread(target=collect_chunks, daemon=True).start()
 
-    return manifest
+    return {"snapshot": info, "pruned": pruned}
+
+@app.get("/api/fs/snapshots")
+def listsnapshots(usr: str, psw: str | None = None, token: str | None = None):
+    """
+    List Snapshots.
+
+    Returns the info (ID, creation time, label, file count and size) of every snapshot the user has, oldest first.
+    """
+    try:
+        user = User(usr, psw, token)
+    except PermissionError:
+        raise HTTPException(401, "Failed to auth.")
+
+    return {"snapshots": user.fs.snapshots.listSnapshots()}
+
+@app.post("/api/fs/check")
+def checkfiles(usr: str, body: CheckRequest, psw: str | None = None, token: str | None = None):
+    """
+    Check Files.
+
+    Takes a list of paths (relative to root) and the hash of their contents.
+
+    Returns the paths the server does not already have an identical copy of. Only these need uploading.
+    """
+    try:
+        user = User(usr, psw, token)
+    except PermissionError:
+        raise HTTPException(401, "Failed to auth.")
+
+    missing = []
+    try:
+        with user.fs.lock():
+            manifest = user.fs.loadManifest()
+
+            for file in body.files:
+                entry = manifest.get(posixpath.normpath(file.path.replace("\\", "/").removeprefix("/")))
+                if not isinstance(entry, dict) or entry.get("hash") != file.hash:
+                    missing.append(file.path)
+    except FileSystem.NoSuchUser:
+        raise HTTPException(404, "Could not load user manifest. Aborting.")
+
+    return {"missing": missing}
 
 # # Configure logging to a file
 # logging_config = {
@@ -358,9 +1523,15 @@ if __name__ == "__main__":
                 "users": []
             }, f, indent=2)
 
+    threading.Thread(target=compact_loop, daemon=True).start()
+    if args.timing_log:
+        threading.Thread(target=timing_log_loop, daemon=True).start()
+    if args.store == "pack":
+        threading.Thread(target=repack_loop, daemon=True).start()
+
     # In case 0.0.0.0 does not loop back through localhost
     if not args.test:
-        uvicorn.run(app, host="0.0.0.0")
+        uvicorn.run(app, host="0.0.0.0", port=args.port)
     else:
         print("WARNING: Running in test mode! This server will not be accessible outside of localhost!")
-        uvicorn.run(app)
\ No newline at end of file
+        uvicorn.run(app, port=args.port)
\ No newline at end of file